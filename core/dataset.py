@@ -2,17 +2,17 @@ import numpy as np
 import math
 import networkx as nx
 import pandas as pd
+import scipy.sparse as sp
 from enum import Enum
-from os import path
-from bisect import bisect_right
-from collections.abc import Iterable
-from core.load import read, load_graph
+from os import path, replace
+from core.load import read, read_demands, has_demand_files, load_graph
+from core.load import graph_cache_path, is_graph_cache_valid
 from utils.constants import BIG_NUMBER, WRITE_THRESHOLD
 from utils.utils import expand_sparse_matrix, deserialize_dict
 from utils.utils import create_node_embeddings, sparse_matrix_to_tensor
-from utils.utils import expand_matrix, demands_to_features
+from utils.utils import expand_matrix, demands_to_features, balance_demands
 from utils.graph_utils import adjacency_list, pad_adj_list, neighborhood_adj_lists
-from utils.graph_utils import adj_matrix_to_list, random_walk_neighborhoods
+from utils.graph_utils import adj_matrix_to_list, random_walk_neighborhoods, neighbor_positions
 from sklearn.preprocessing import StandardScaler
 
 
@@ -30,34 +30,38 @@ class Counters:
         self.sort = sort
 
 
-class Sample:
+class SeriesData:
 
-    def __init__(self, demands, graph_name, true_cost):
+    def __init__(self, demands, source_demands, sink_demands, true_costs, graph_name):
+        # N x (V + 1) matrix of node demands. The final column is the dummy (padding) node.
         self.demands = demands
+
+        # N x K_1 and N x K_2 arrays of source and sink demands
+        self.source_demands = source_demands
+        self.sink_demands = sink_demands
+        self.true_costs = true_costs
         self.graph_name = graph_name
-        self.true_cost = true_cost
+
+    def __len__(self):
+        return self.demands.shape[0]
 
 
-class BatchSample:
+class Batch:
 
-    def __init__(self, node_features, demands, true_cost, graph_data):
-        self.node_features = node_features
+    def __init__(self, demands, true_costs, graph_data):
+        # B x (V + 1) x 1 tensor of node demands (including the dummy node)
         self.demands = demands
-        self.adj_lst = graph_data.adj_lst
-        self.adj_mat = graph_data.adj_mat
-        self.inv_adj_lst = graph_data.inv_adj_lst
-        self.out_neighborhoods = graph_data.out_neighborhoods
-        self.in_neighborhoods = graph_data.in_neighborhoods
-        self.embeddings = graph_data.embeddings
-        self.num_nodes = graph_data.num_nodes
+
+        # B x (V + 1) x 2 tensor of node features
+        self.node_features = demands_to_features(demands)
+
+        self.true_costs = true_costs
+        self.graph_data = graph_data
         self.graph_name = graph_data.graph_name
-        self.rev_indices = graph_data.rev_indices
-        self.in_indices = graph_data.in_indices
-        self.opp_indices = graph_data.opp_indices
-        self.common_out_neighbors = graph_data.common_out_neighbors
-        self.edge_lengths = graph_data.edge_lengths
-        self.normalized_edge_lengths = graph_data.normalized_edge_lengths
-        self.true_cost = true_cost
+        self.num_nodes = graph_data.num_nodes
+
+    def __len__(self):
+        return self.demands.shape[0]
 
 
 class GraphData:
@@ -65,10 +69,10 @@ class GraphData:
     def __init__(self, graph, graph_name, k, unique_neighborhoods):
 
         self.graph_name = graph_name
-        self.graph = graph
+        self._graph = graph
 
         # Fetch expanded adjacency matrix
-        self.adj_mat = nx.adjacency_matrix(graph)
+        self.adj_mat = graph.adjacency_matrix()
 
         # Compute adjacency lists
         self.adj_lst, _ = adjacency_list(graph)
@@ -82,90 +86,134 @@ class GraphData:
         self.embeddings = create_node_embeddings(graph=graph, neighborhoods=self.out_neighborhoods)
 
         # Save the true number of nodes in this graph
-        self.num_nodes = graph.number_of_nodes()
+        self.num_nodes = graph.num_nodes
 
         # Compute neighbors which have common outgoing neighbors
         self.common_out_neighbors = self.common_outgoing_neighbors(graph=graph)
 
-    def common_outgoing_neighbors(self, graph):
-        common_out_neighbors = []
+    @property
+    def graph(self):
+        # Graph data restored from the cache does not hold the underlying graph,
+        # so it is only loaded once a caller actually needs it
+        if self._graph is None:
+            self._graph = load_graph(graph_name=self.graph_name)
+        return self._graph
+
+    def save(self, file_path):
+        arrays = {
+            'num_nodes': self.num_nodes,
+            'max_degree': self.max_degree,
+            'max_out_neighborhood_degrees': self.max_out_neighborhood_degrees,
+            'max_in_neighborhood_degrees': self.max_in_neighborhood_degrees,
+            'adj_mat_data': self.adj_mat.data,
+            'adj_mat_indices': self.adj_mat.indices,
+            'adj_mat_indptr': self.adj_mat.indptr,
+            'adj_mat_shape': self.adj_mat.shape,
+            'adj_lst': self.adj_lst,
+            'inv_adj_lst': self.inv_adj_lst,
+            'embeddings': self.embeddings,
+            'common_out_neighbors': self.common_out_neighbors,
+            'in_indices': self.in_indices,
+            'rev_indices': self.rev_indices,
+            'opp_indices': self.opp_indices,
+            'edge_slots': self.edge_slots,
+            'edge_src': self.edge_src,
+            'edge_dst': self.edge_dst,
+            'edge_lengths': self.edge_lengths,
+            'normalized_edge_lengths': self.normalized_edge_lengths
+        }
+
+        for i, (out_lst, in_lst) in enumerate(zip(self.out_neighborhoods, self.in_neighborhoods)):
+            arrays['out_neighborhood_{0}'.format(i)] = out_lst
+            arrays['in_neighborhood_{0}'.format(i)] = in_lst
+
+        # Write to a temporary file first so that concurrent runs never read a partial cache
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+        replace(temp_path, file_path)
 
-        for node in graph.nodes():
-            common = []
-            for neighbor in graph[node]:
-                common += [n for n in graph.predecessors(neighbor) if n != node]
-            common_out_neighbors.append(list(set(common)))
+    def common_outgoing_neighbors(self, graph):
+        # Nodes u != v share an outgoing neighbor exactly when (A A^T)[u, v] is nonzero
+        adj_mat = graph.adjacency_matrix()
+        common = adj_mat.dot(adj_mat.transpose()).tocsr()
+        common.setdiag(0)
+        common.eliminate_zeros()
+        common.sort_indices()
 
-        return common_out_neighbors
+        return [common.indices[common.indptr[node]:common.indptr[node+1]].tolist() for node in range(graph.num_nodes)]
 
     def fetch_edge_lengths(self):
         # Fetch and normalize edge lengths from underlying graph
         self.scaler = StandardScaler()
-        edge_lengths = np.array([length for (_, _, length) in self.graph.edges.data('length')])
+        edge_lengths = self.graph.edge_lengths
         normalized_lengths = self.scaler.fit_transform(edge_lengths.reshape(-1, 1)).reshape(-1)
 
-        edge_len_dict = {}
-        norm_edge_len_dict = {}
-        for i, (src, dst) in enumerate(self.graph.edges(keys=False, data=False)):
-            edge_len_dict[(src, dst)] = edge_lengths[i]
-            norm_edge_len_dict[(src, dst)] = normalized_lengths[i]
-
+        # Edge ids follow the row-major order of the real entries in the adjacency list
         self.edge_lengths = np.zeros_like(self.adj_lst, dtype=float)
         self.normalized_edge_lengths = np.zeros_like(self.adj_lst, dtype=float)
-        for node, _ in enumerate(self.adj_lst):
-            for j, v in enumerate(self.adj_lst[node]):
-
-                if (node, v) not in edge_len_dict:
-                    continue
-
-                self.edge_lengths[node, j] = edge_len_dict[(node, v)]
-                self.normalized_edge_lengths[node, j] = norm_edge_len_dict[(node, v)]
+        self.edge_lengths.reshape(-1)[self.edge_slots] = edge_lengths
+        self.normalized_edge_lengths.reshape(-1)[self.edge_slots] = normalized_lengths
 
     def set_edge_indices(self, adj_lst, inv_adj_lst, max_degree, max_num_nodes):
-        dim0 = np.prod(adj_lst.shape)
-
         # These arrays hold 2D coordinates which are used to gather
         # incoming and outgoing neighbors within tensorflow
-        self.in_indices = np.zeros(shape=(dim0, 2))
-        self.rev_indices = np.zeros(shape=(dim0, 2))
-        self.opp_indices = np.zeros(shape=(dim0, 2))
-
-        index_a = 0
-        index_b = 0
-        for x in range(adj_lst.shape[0]):
-            for y in inv_adj_lst[x]:
-                indexof = np.where(adj_lst[y] == x)[0]
-
-                if len(indexof) > 0:
-                    self.in_indices[index_a, 0] = y
-                    self.in_indices[index_a, 1] = indexof[0]
-                else:
-                    self.in_indices[index_a, 0] = self.num_nodes
-                    self.in_indices[index_a, 1] = max_degree - 1
-
-                index_a += 1
-
-            for y in adj_lst[x]:
-                indexof = np.where(inv_adj_lst[y] == x)[0]
-
-                if len(indexof) > 0:
-                    self.rev_indices[index_b, 0] = y
-                    self.rev_indices[index_b, 1] = indexof[0]
-                else:
-                    self.rev_indices[index_b, 0] = self.num_nodes
-                    self.rev_indices[index_b, 1] = max_degree - 1
+        self.in_indices = neighbor_positions(adj_lst=inv_adj_lst,
+                                             lookup_lst=adj_lst,
+                                             mask_number=self.num_nodes,
+                                             max_degree=max_degree)
+        self.rev_indices = neighbor_positions(adj_lst=adj_lst,
+                                              lookup_lst=inv_adj_lst,
+                                              mask_number=self.num_nodes,
+                                              max_degree=max_degree)
+
+        # Reverse Edge
+        self.opp_indices = neighbor_positions(adj_lst=adj_lst,
+                                              lookup_lst=adj_lst,
+                                              mask_number=self.num_nodes,
+                                              max_degree=max_degree)
+
+        # Edge list over the non-padding slots of the adjacency list. Slots are flattened
+        # positions (node * max_degree + neighbor index) within V x D tensors.
+        self.edge_slots = np.flatnonzero(adj_lst != self.num_nodes)
+        self.edge_src = self.edge_slots // max_degree
+        self.edge_dst = adj_lst.reshape(-1)[self.edge_slots]
+
+
+class CachedGraphData(GraphData):
+    """
+    Preprocessed graph data restored from a cache file written by GraphData.save.
+    """
+
+    def __init__(self, file_path, graph_name):
 
-                # Reverse Edge
-                indexof = np.where(adj_lst[y] == x)[0]
-
-                if len(indexof) > 0:
-                    self.opp_indices[index_b, 0] = y
-                    self.opp_indices[index_b, 1] = indexof[0]
-                else:
-                    self.opp_indices[index_b, 0] = self.num_nodes
-                    self.opp_indices[index_b, 1] = max_degree - 1
-
-                index_b += 1
+        self.graph_name = graph_name
+        self._graph = None
+
+        with np.load(file_path) as cache:
+            self.num_nodes = int(cache['num_nodes'])
+            self.max_degree = int(cache['max_degree'])
+            self.max_out_neighborhood_degrees = cache['max_out_neighborhood_degrees']
+            self.max_in_neighborhood_degrees = cache['max_in_neighborhood_degrees']
+
+            self.adj_mat = sp.csr_matrix((cache['adj_mat_data'], cache['adj_mat_indices'], cache['adj_mat_indptr']),
+                                         shape=tuple(cache['adj_mat_shape']))
+            self.adj_lst = cache['adj_lst']
+            self.inv_adj_lst = cache['inv_adj_lst']
+            self.embeddings = cache['embeddings']
+            self.common_out_neighbors = cache['common_out_neighbors']
+            self.in_indices = cache['in_indices']
+            self.rev_indices = cache['rev_indices']
+            self.opp_indices = cache['opp_indices']
+            self.edge_slots = cache['edge_slots']
+            self.edge_src = cache['edge_src']
+            self.edge_dst = cache['edge_dst']
+            self.edge_lengths = cache['edge_lengths']
+            self.normalized_edge_lengths = cache['normalized_edge_lengths']
+
+            num_levels = len(self.max_out_neighborhood_degrees)
+            self.out_neighborhoods = [cache['out_neighborhood_{0}'.format(i)] for i in range(num_levels)]
+            self.in_neighborhoods = [cache['in_neighborhood_{0}'.format(i)] for i in range(num_levels)]
 
 
 class DatasetManager:
@@ -195,17 +243,32 @@ class DatasetManager:
         self.dataset = {}
         self.graph_data = None
 
+        # All sampling draws from this generator so that batches are reproducible given a seed
+        self.rng = np.random.RandomState(params.get('seed'))
+
     def load_graphs(self):
         num_neighborhoods = self.params['num_neighborhoods']
         unique_neighborhoods = self.params['unique_neighborhoods']
 
+        # Reuse preprocessed graph data if it is available
+        cache_path = graph_cache_path(graph_name=self.params['graph_name'],
+                                      num_neighborhoods=num_neighborhoods,
+                                      unique_neighborhoods=unique_neighborhoods)
+        if is_graph_cache_valid(cache_path=cache_path, graph_name=self.params['graph_name']):
+            self.graph_data = CachedGraphData(file_path=cache_path, graph_name=self.params['graph_name'])
+            self.num_nodes = self.graph_data.num_nodes
+            self.max_degree = self.graph_data.max_degree
+            self.max_out_neighborhood_degrees = self.graph_data.max_out_neighborhood_degrees
+            self.max_in_neighborhood_degrees = self.graph_data.max_in_neighborhood_degrees
+            return
+
         graph = load_graph(graph_name=self.params['graph_name'])
         self.graph_data = GraphData(graph=graph,
                                     graph_name=self.params['graph_name'],
                                     k=num_neighborhoods,
                                     unique_neighborhoods=unique_neighborhoods)
 
-        self.num_nodes = graph.number_of_nodes()
+        self.num_nodes = graph.num_nodes
 
         # Find the maximum outgoing degrees for each neighborhood level
         self.max_out_neighborhood_degrees = [np.max(mat.sum(axis=-1)) for mat in self.graph_data.out_neighborhoods]
@@ -215,8 +278,8 @@ class DatasetManager:
         self.max_in_neighborhood_degrees = np.array(self.max_in_neighborhood_degrees).astype(int)
 
         # Find the maximum outgoing or incoming degree for a single vertex
-        max_out_deg = np.max([d for _, d in graph.out_degree()])
-        max_in_deg = np.max([d for _, d in graph.in_degree()])
+        max_out_deg = np.max(graph.out_degrees())
+        max_in_deg = np.max(graph.in_degrees())
         self.max_degree = int(max(max_out_deg, max_in_deg))
 
         # Expand graph data to ensure consistent sizing
@@ -257,71 +320,95 @@ class DatasetManager:
 
         self.graph_data.fetch_edge_lengths()
 
+        self.graph_data.max_degree = self.max_degree
+        self.graph_data.max_out_neighborhood_degrees = self.max_out_neighborhood_degrees
+        self.graph_data.max_in_neighborhood_degrees = self.max_in_neighborhood_degrees
+        self.graph_data.save(cache_path)
+
     def load(self, series):
         assert series is not None
 
-        if series not in self.dataset:
-            self.dataset[series] = []
-
         graph_name = self.params['graph_name']
         folder = self.data_folders[series]
         num_samples = self.num_samples[series]
-        num_files = int(math.ceil(num_samples / WRITE_THRESHOLD))
 
         print('Started loading {0} {1} samples for graph {2}.'.format(num_samples, series.name, graph_name))
 
-        true_costs = None
+        if has_demand_files(folder):
+            source_demands, sink_demands, header = read_demands(folder)
+            assert header['sources'] == list(self.sources) and header['sinks'] == list(self.sinks)
+        else:
+            # Fall back to the legacy format of pickled shards
+            num_files = int(math.ceil(num_samples / WRITE_THRESHOLD))
+            shards = [read(folder=folder, file_index=file_index) for file_index in range(num_files)]
+            source_demands = np.vstack([shard[0] for shard in shards])
+            sink_demands = np.vstack([shard[1] for shard in shards])
+
+        # Demands are stored in single precision, so they are rebalanced in double precision
+        # before they reach the model or the optimizers
+        source_demands, sink_demands = balance_demands(source_demands, sink_demands)
+
+        true_costs = np.zeros(shape=(num_samples,))
         costs_path = path.join(folder, 'costs.csv')
         if path.exists(costs_path):
-            true_costs = pd.read_csv(costs_path)
-
-        for file_index in range(num_files):
-            # Load demands as Sparse CSR matrices to save memory.
-            demands = read(folder=folder,
-                           file_index=file_index,
-                           sources=self.sources,
-                           sinks=self.sinks,
-                           num_nodes=self.num_nodes)
-
-            if true_costs is not None:
-                lower, upper = file_index * WRITE_THRESHOLD, (file_index + 1) * WRITE_THRESHOLD
-                sample_true_costs = true_costs['Flow Cost'][lower:upper]
-                offset = file_index * WRITE_THRESHOLD
-            else:
-                sample_true_costs = np.zeros(shape=(len(demands),))
-                offset = 0
-
-            self.dataset[series] += [Sample(demands=demand, graph_name=graph_name, true_cost=sample_true_costs[i + offset])
-                                     for i, demand in enumerate(demands)]
+            true_costs = pd.read_csv(costs_path)['Flow Cost'].values[:num_samples]
+
+        # Scatter demands into a dense matrix once so that batches are formed by indexing rows
+        demands = np.zeros(shape=(num_samples, self.num_nodes + 1), dtype=np.float64)
+        demands[:, self.sources] = source_demands
+        demands[:, self.sinks] = sink_demands
+
+        self.dataset[series] = SeriesData(demands=demands,
+                                          source_demands=source_demands,
+                                          sink_demands=sink_demands,
+                                          true_costs=true_costs,
+                                          graph_name=graph_name)
 
         assert len(self.dataset[series]) == num_samples
         print('Completed loading graph {0} for {1}.'.format(graph_name, series.name))
 
-    def create_batches(self, series, batch_size, shuffle):
+    def sample_demands(self, series, index):
         """
-        Generator for batches of a single series using uniform shuffling without replacement.
+        Returns a V x 1 matrix of node demands for the sample at the given index.
         """
+        demands = self.dataset[series].demands[index, :self.num_nodes]
+        return demands.reshape(-1, 1).astype(float)
+
+    def create_batch(self, series, indices):
         data = self.dataset[series]
-        if shuffle:
-            np.random.shuffle(data)
+        return Batch(demands=np.expand_dims(data.demands[indices], axis=-1),
+                     true_costs=data.true_costs[indices],
+                     graph_data=self.graph_data)
 
-        batches = []
-        for i in range(0, len(data), batch_size):
-            batch_data = data[i:i+batch_size]
+    def batch_indices(self, series, batch_size, shuffle):
+        """
+        Generator for the sample indices of each batch in a single series using uniform shuffling
+        without replacement.
+        """
+        indices = np.arange(start=0, stop=len(self.dataset[series]))
+        if shuffle:
+            self.rng.shuffle(indices)
 
-            batch = []
-            for sample in batch_data:
-                demands = sample.demands.todense()
-                node_features = demands_to_features(demands)
-                b = BatchSample(node_features=node_features,
-                                demands=demands,
-                                true_cost=sample.true_cost,
-                                graph_data=self.graph_data)
-                batch.append(b)
+        for i in range(0, len(indices), batch_size):
+            yield indices[i:i+batch_size]
 
-            yield batch
+    def create_batches(self, series, batch_size, shuffle):
+        """
+        Generator for batches of a single series using uniform shuffling without replacement.
+        """
+        for indices in self.batch_indices(series, batch_size, shuffle):
+            yield self.create_batch(series, indices)
 
     def get_train_batch(self, batch_size):
+        indices = self.sample_train_indices(batch_size)
+        return self.create_batch(Series.TRAIN, indices), indices
+
+    def sample_train_indices(self, batch_size):
+        """
+        Selects the samples for the next training batch and returns their indices within the
+        training series. Losses are keyed by these indices (rather than by rank) so that batches
+        sampled ahead of time remain valid when the ranking is re-sorted.
+        """
         assert self.is_train_initialized, 'Training not yet initialized.'
 
         self.counters.samples += batch_size
@@ -335,64 +422,36 @@ class DatasetManager:
             if curr_epoch > 0:
                 self.selection *= self.selection_factor
 
-                # Update probabilities
-                self.probs[0] = 1.0
+                # Update probabilities, which decay geometrically with the rank of each sample
                 factor = 1.0 / math.exp(math.log(self.selection) / self.num_train_points)
-
-                for i in range(1, self.num_train_points):
-                    self.probs[i] = self.probs[i-1] * factor
+                self.probs = np.power(factor, np.arange(self.num_train_points, dtype=float))
                 self.probs = self.probs / np.sum(self.probs)
-
-                for i in range(1, self.num_train_points):
-                    self.cumulative_probs[i] = self.cumulative_probs[i-1] + self.probs[i]
+                self.cumulative_probs = np.cumsum(self.probs)
 
         # Re-sort data based on losses
         sort_threshold = self.params['batch_params']['sort_freq'] * self.num_train_points
         if self.counters.samples - self.counters.sort > sort_threshold:
             self.counters.sort = self.counters.samples
 
-            # Sort samples based on losses
-            samples = list(zip(self.losses, self.indices))
-            samples.sort(key=lambda t: t[0], reverse=True)
-            losses, indices = zip(*samples)
-            self.losses, self.indices = np.array(losses), np.array(indices)
-
-        batch = []
-        indices = []
-        for i in range(batch_size):
-            r = min(np.random.random(), self.cumulative_probs[-1])
-            index = bisect_right(self.cumulative_probs, r, lo=0, hi=len(self.cumulative_probs))
-
-            # Prevent any out of bounds errors
-            if index >= len(self.cumulative_probs):
-                index = len(self.cumulative_probs) - 1
+            # Rank samples by decreasing loss. The stable sort keeps ties in their previous order.
+            order = np.argsort(-self.losses[self.indices], kind='stable')
+            self.indices = self.indices[order]
 
-            data_index = self.indices[index]
+        r = np.minimum(self.rng.random_sample(size=batch_size), self.cumulative_probs[-1])
+        ranks = np.searchsorted(self.cumulative_probs, r, side='right')
 
-            sample = self.dataset[Series.TRAIN][data_index]
+        # Prevent any out of bounds errors
+        ranks = np.minimum(ranks, self.num_train_points - 1)
 
-            demands = sample.demands.todense()
-            node_features = demands_to_features(demands)
-            b = BatchSample(node_features=node_features,
-                            demands=demands,
-                            true_cost=sample.true_cost,
-                            graph_data=self.graph_data)
-            batch.append(b)
-            indices.append(index)
-
-        return batch, indices
+        return self.indices[ranks]
 
     def report_losses(self, losses, indices):
-        if not isinstance(losses, Iterable):
-            losses = [losses]
-
-        for loss, index in zip(losses, indices):
-            self.losses[index] = loss
+        self.losses[indices] = losses
 
     def init(self, num_epochs):
         assert Series.TRAIN in self.dataset
 
-        # Intialize losses
+        # Intialize losses (indexed by sample) and the ranking of samples by decreasing loss
         self.num_train_points = len(self.dataset[Series.TRAIN])
         self.losses = np.full(shape=self.num_train_points, fill_value=BIG_NUMBER)
         self.indices = np.arange(start=0, stop=self.num_train_points, step=1)
@@ -410,10 +469,7 @@ class DatasetManager:
         self.probs = np.full(shape=self.num_train_points, fill_value=1.0/float(self.num_train_points))
 
         # Initialize cumulative probabilities
-        self.cumulative_probs = np.zeros(shape=self.num_train_points, dtype=float)
-        self.cumulative_probs[0] = 1.0 / float(self.num_train_points)
-        for i in range(1, self.num_train_points):
-            self.cumulative_probs[i] = self.cumulative_probs[i-1] + self.probs[i]
+        self.cumulative_probs = np.cumsum(self.probs)
 
         self.is_train_initialized = True
 
@@ -0,0 +1,113 @@
+import numpy as np
+import json
+import os
+from multiprocessing import Pool
+from os import path
+from utils.utils import create_demand_batch, create_filtered_demands, DemandFilter
+from utils.constants import WRITE_THRESHOLD, GENERATION_MANIFEST
+from core.load import write_demands, read_demands
+
+
+SERIES = ['train', 'valid', 'test']
+
+# Per-process state of each pool worker, set once by init_worker
+_worker_state = {}
+
+
+def shard_rng(seed, series, shard):
+    """
+    Returns the random state of a single shard. The state only depends on the master seed
+    and the position of the shard, so shards can be generated in any order.
+    """
+    return np.random.RandomState([seed, SERIES.index(series), shard])
+
+
+def num_shards(num_samples):
+    return int(np.ceil(num_samples / WRITE_THRESHOLD))
+
+
+def init_worker(dataset_folder, seed, num_sources, num_sinks, demand_filter=None):
+    _worker_state['dataset_folder'] = dataset_folder
+    _worker_state['seed'] = seed
+    _worker_state['num_sources'] = num_sources
+    _worker_state['num_sinks'] = num_sinks
+    _worker_state['demand_filter'] = demand_filter
+
+
+def generate_shard(task):
+    """
+    Generates the demands of a single shard and writes them into the demand files of its
+    series. Validation and test demands are filtered against the training demands.
+    """
+    series, shard, num_samples = task
+    state = _worker_state
+
+    rng = shard_rng(state['seed'], series, shard)
+    if series == 'train':
+        source_demands, sink_demands = create_demand_batch(num_sources=state['num_sources'],
+                                                           num_sinks=state['num_sinks'],
+                                                           num_samples=num_samples,
+                                                           rng=rng)
+    else:
+        source_demands, sink_demands = create_filtered_demands(num_sources=state['num_sources'],
+                                                               num_sinks=state['num_sinks'],
+                                                               num_samples=num_samples,
+                                                               demand_filter=state['demand_filter'],
+                                                               rng=rng)
+
+    write_demands(folder=path.join(state['dataset_folder'], series),
+                  source_demands=source_demands,
+                  sink_demands=sink_demands,
+                  offset=shard * WRITE_THRESHOLD)
+    return series, shard
+
+
+def create_train_filter(dataset_folder):
+    source_demands, sink_demands, _ = read_demands(path.join(dataset_folder, 'train'))
+    return DemandFilter(source_demands=source_demands, sink_demands=sink_demands)
+
+
+def load_manifest(dataset_folder):
+    manifest_path = path.join(dataset_folder, GENERATION_MANIFEST)
+    if not path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(dataset_folder, manifest):
+    # Written under a temporary name so that an interrupted write leaves the old manifest intact
+    manifest_path = path.join(dataset_folder, GENERATION_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def generate_shards(tasks, manifest, dataset_folder, initargs, num_workers=1):
+    """
+    Generates the given (series, shard, num_samples) tasks and records each completed shard
+    in the manifest. Shards are independent, so they are collected in completion order.
+    """
+    if len(tasks) == 0:
+        return
+
+    if num_workers > 1:
+        pool = Pool(processes=num_workers, initializer=init_worker, initargs=initargs)
+        results = pool.imap_unordered(generate_shard, tasks)
+    else:
+        pool = None
+        init_worker(*initargs)
+        results = map(generate_shard, tasks)
+
+    try:
+        for series, shard in results:
+            manifest['completed'][series].append(shard)
+            write_manifest(dataset_folder, manifest)
+
+            num_completed = len(manifest['completed'][series])
+            print('Completed {0}/{1} shards for {2}.'.format(num_completed, num_shards(manifest['num_samples'][series]), series))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,197 @@
+import numpy as np
+import os
+import networkx as nx
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigs
+
+
+PAGERANK_MAX_ITERS = 100
+PAGERANK_TOL = 1e-6
+
+
+class CompactGraph:
+    """
+    Array-backed directed graph. Nodes are the integers 0..V-1 and edges are stored in CSR
+    order (sorted by source and then destination), so the position of an edge in the CSR
+    arrays is its edge id. This matches the edge order of graphs returned by load_graph.
+    Incoming edges are indexed by a CSC view which maps back to edge ids.
+
+    A networkx graph is only built on request for plotting.
+    """
+
+    __slots__ = ['name', 'crs', 'num_nodes', 'num_edges', 'indptr', 'indices', 'edge_src',
+                 'in_indptr', 'in_indices', 'in_edge_ids', 'edge_lengths', 'node_x', 'node_y',
+                 '_networkx']
+
+    def __init__(self, num_nodes, edge_src, edge_dst, edge_lengths, node_x, node_y, name=None, crs=None):
+        edge_src = np.asarray(edge_src, dtype=np.int64)
+        edge_dst = np.asarray(edge_dst, dtype=np.int64)
+        order = np.lexsort((edge_dst, edge_src))
+
+        self.name = name
+        self.crs = crs
+        self.num_nodes = int(num_nodes)
+        self.num_edges = len(order)
+
+        self.edge_src = edge_src[order]
+        self.indices = edge_dst[order]
+        self.indptr = np.zeros(shape=(self.num_nodes + 1,), dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(self.edge_src, minlength=self.num_nodes))
+
+        in_order = np.lexsort((self.edge_src, self.indices))
+        self.in_edge_ids = in_order
+        self.in_indices = self.edge_src[in_order]
+        self.in_indptr = np.zeros(shape=(self.num_nodes + 1,), dtype=np.int64)
+        self.in_indptr[1:] = np.cumsum(np.bincount(self.indices, minlength=self.num_nodes))
+
+        self.edge_lengths = np.asarray(edge_lengths, dtype=float)[order]
+        self.node_x = np.asarray(node_x, dtype=float)
+        self.node_y = np.asarray(node_y, dtype=float)
+
+        self._networkx = None
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """
+        Creates a compact graph from a networkx graph with nodes labelled 0..V-1.
+        """
+        edges = np.array([(src, dst) for src, dst in graph.edges()], dtype=np.int64).reshape(-1, 2)
+        lengths = [length for _, _, length in graph.edges.data('length', default=0.0)]
+        return cls(num_nodes=graph.number_of_nodes(),
+                   edge_src=edges[:, 0],
+                   edge_dst=edges[:, 1],
+                   edge_lengths=lengths,
+                   node_x=[x for _, x in graph.nodes(data='x')],
+                   node_y=[y for _, y in graph.nodes(data='y')],
+                   name=graph.graph.get('name'),
+                   crs=graph.graph.get('crs'))
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Reads a graph written by save.
+        """
+        with np.load(file_path) as snapshot:
+            return cls(num_nodes=int(snapshot['num_nodes']),
+                       edge_src=snapshot['edge_src'],
+                       edge_dst=snapshot['edge_dst'],
+                       edge_lengths=snapshot['edge_lengths'],
+                       node_x=snapshot['node_x'],
+                       node_y=snapshot['node_y'],
+                       name=str(snapshot['name']) or None,
+                       crs=str(snapshot['crs']) or None)
+
+    def save(self, file_path, node_ids=None):
+        """
+        Writes the graph arrays to an npz file. The node ids of the original graph can be
+        stored alongside for reference. The file is written under a temporary name and then
+        renamed, so readers never see a partial snapshot.
+        """
+        if node_ids is None:
+            node_ids = np.arange(self.num_nodes)
+
+        with open(file_path + '.tmp', 'wb') as snapshot_file:
+            np.savez(snapshot_file,
+                     num_nodes=self.num_nodes,
+                     node_ids=np.asarray(node_ids, dtype=np.int64),
+                     node_x=self.node_x,
+                     node_y=self.node_y,
+                     edge_src=self.edge_src,
+                     edge_dst=self.indices,
+                     edge_lengths=self.edge_lengths,
+                     name=np.array(self.name if self.name is not None else ''),
+                     crs=np.array(str(self.crs) if self.crs is not None else ''))
+        os.replace(file_path + '.tmp', file_path)
+
+    def out_degrees(self):
+        return np.diff(self.indptr)
+
+    def in_degrees(self):
+        return np.diff(self.in_indptr)
+
+    def successors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node+1]]
+
+    def predecessors(self, node):
+        return self.in_indices[self.in_indptr[node]:self.in_indptr[node+1]]
+
+    def edge_ids(self, src, dst):
+        """
+        Returns the ids of the edges src -> dst for arrays of endpoints, or -1 where
+        there is no such edge.
+        """
+        keys = self.edge_src * self.num_nodes + self.indices
+        queries = np.asarray(src, dtype=np.int64) * self.num_nodes + np.asarray(dst, dtype=np.int64)
+
+        ids = np.minimum(np.searchsorted(keys, queries), self.num_edges - 1)
+        return np.where(keys[ids] == queries, ids, -1)
+
+    def adjacency_matrix(self):
+        data = np.ones(shape=(self.num_edges,), dtype=np.int64)
+        return sp.csr_matrix((data, self.indices, self.indptr), shape=(self.num_nodes, self.num_nodes))
+
+    def incidence_matrix(self):
+        """
+        Returns a V x E matrix with a 1 at the source node and a -1 at the destination
+        node of each edge.
+        """
+        edge_ids = np.arange(self.num_edges)
+        rows = np.concatenate([self.edge_src, self.indices])
+        cols = np.concatenate([edge_ids, edge_ids])
+        data = np.concatenate([np.ones(self.num_edges), -np.ones(self.num_edges)])
+        return sp.csr_matrix((data, (rows, cols)), shape=(self.num_nodes, self.num_edges))
+
+    def eigenvector_centrality(self):
+        """
+        Eigenvector centrality based on incoming edges, as in networkx.eigenvector_centrality_numpy.
+        """
+        adj_mat = self.adjacency_matrix().astype(float)
+        _, eigenvector = eigs(adj_mat.transpose(), k=1, which='LR')
+        largest = eigenvector.flatten().real
+        return largest / (np.sign(largest.sum()) * np.linalg.norm(largest))
+
+    def pagerank(self, alpha=0.85):
+        """
+        PageRank by power iteration, as in networkx.pagerank. Mass on nodes without outgoing
+        edges is spread uniformly.
+        """
+        out_degrees = self.out_degrees().astype(float)
+        is_dangling = out_degrees == 0
+
+        inv_degrees = np.zeros_like(out_degrees)
+        inv_degrees[~is_dangling] = 1.0 / out_degrees[~is_dangling]
+        transitions = sp.diags(inv_degrees).dot(self.adjacency_matrix().astype(float)).tocsr()
+        transitions_T = transitions.transpose().tocsr()
+
+        uniform = np.full(shape=(self.num_nodes,), fill_value=1.0 / self.num_nodes)
+        x = uniform
+        for _ in range(PAGERANK_MAX_ITERS):
+            prev_x = x
+            x = alpha * (transitions_T.dot(x) + np.sum(x[is_dangling]) * uniform) + (1 - alpha) * uniform
+            if np.sum(np.abs(x - prev_x)) < self.num_nodes * PAGERANK_TOL:
+                return x
+
+        raise nx.PowerIterationFailedConvergence(PAGERANK_MAX_ITERS)
+
+    def to_networkx(self):
+        """
+        Returns the graph as an osmnx-compatible MultiDiGraph. The result is cached, so
+        callers which add attributes should copy it first.
+        """
+        if self._networkx is not None:
+            return self._networkx
+
+        graph = nx.MultiDiGraph()
+        graph.add_nodes_from((node, {'x': x, 'y': y, 'demand': 0})
+                             for node, (x, y) in enumerate(zip(self.node_x.tolist(), self.node_y.tolist())))
+
+        # The 'zero' field is dummy data for compatibility with the plotter
+        graph.add_edges_from((src, dst, 0, {'length': length, 'zero': 0})
+                             for src, dst, length in zip(self.edge_src.tolist(), self.indices.tolist(),
+                                                         self.edge_lengths.tolist()))
+
+        graph.graph['crs'] = self.crs
+        graph.graph['name'] = self.name
+
+        self._networkx = graph
+        return graph
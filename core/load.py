@@ -1,14 +1,17 @@
 import osmnx as ox
 import networkx as nx
+import json
 import numpy as np
 import scipy.sparse as sp
 import matplotlib as plt
 from os import path
 from os import mkdir
-from utils.constants import SMALL_NUMBER
+from utils.constants import SMALL_NUMBER, GRAPH_CACHE_FILE, GRAPH_CACHE_VERSION, GRAPH_SNAPSHOT_FILE
+from utils.constants import DEMANDS_HEADER, SOURCE_DEMANDS_FILE, SINK_DEMANDS_FILE, DEMANDS_DTYPE
 from utils.utils import serialize_dict, deserialize_dict, append_row_to_log
 from utils.utils import delete_if_exists
 from core.plot import plot_road_graph
+from core.graph import CompactGraph
 from annoy import AnnoyIndex
 import os
 
@@ -39,6 +42,7 @@ def save_graph(target, graph_name, distance=1000, is_address=True):
 
     # Save graph
     ox.save_graphml(graph_component, filename='graph.graphml', folder=folder_path, gephi=True)
+    save_graph_snapshot(folder_path)
 
     # Save a selection of graph-wide stats.
     stats_file = path.join(folder_path, 'stats.csv')
@@ -66,6 +70,25 @@ def save_graph(target, graph_name, distance=1000, is_address=True):
 def load_graph(graph_name):
     folder_path = path.join('graphs', graph_name)
 
+    # Parsing GraphML is slow, so the canonical graph is kept in a binary snapshot
+    snapshot_path = path.join(folder_path, GRAPH_SNAPSHOT_FILE)
+    if is_graph_cache_valid(cache_path=snapshot_path, graph_name=graph_name):
+        return CompactGraph.load(snapshot_path)
+
+    save_graph_snapshot(folder_path)
+    return CompactGraph.load(snapshot_path)
+
+
+def save_graph_snapshot(folder_path):
+    graph, node_ids = load_graphml(folder_path)
+    graph.save(path.join(folder_path, GRAPH_SNAPSHOT_FILE), node_ids=node_ids)
+
+
+def load_graphml(folder_path):
+    """
+    Reads the GraphML file in the given folder and returns the canonical compact graph
+    along with the original id of each node.
+    """
     graph_data = deserialize_dict(file_path=path.join(folder_path, 'graph_data.pkl.gz'))
     #graph = ox.load_graphml(filename='graph.graphml', folder=folder_path)
     graph = ox.load_graphml(filepath=os.path.join(folder_path,'graph.graphml'))
@@ -74,7 +97,8 @@ def load_graph(graph_name):
     if not nx.is_strongly_connected(graph):
         graph = ox.get_largest_component(graph, strongly=True)
 
-    node_mapping = {node: i for i, node in enumerate(sorted(graph.nodes()))}
+    node_ids = sorted(graph.nodes())
+    node_mapping = {node: i for i, node in enumerate(node_ids)}
     graph = nx.relabel_nodes(graph, node_mapping)
 
     # Ensure nodes and edges are ordered consistently
@@ -96,25 +120,134 @@ def load_graph(graph_name):
     G.graph['name'] = graph_data['name']
     G = ox.project_graph(G, to_crs=graph_data['crs'])
 
-    return G.to_directed()
+    return CompactGraph.from_networkx(G), node_ids
+
+
+def graph_cache_path(graph_name, num_neighborhoods, unique_neighborhoods):
+    cache_folder = path.join('graphs', graph_name, 'cache')
+    if not path.exists(cache_folder):
+        mkdir(cache_folder)
+
+    neighborhood_type = 'unique' if unique_neighborhoods else 'walks'
+    file_name = GRAPH_CACHE_FILE.format(num_neighborhoods, neighborhood_type, GRAPH_CACHE_VERSION)
+    return path.join(cache_folder, file_name)
+
+
+def is_graph_cache_valid(cache_path, graph_name):
+    if not path.exists(cache_path):
+        return False
+
+    # The cache is stale if the graph has been saved again since the cache was written
+    graph_path = path.join('graphs', graph_name, 'graph.graphml')
+    return not path.exists(graph_path) or path.getmtime(graph_path) <= path.getmtime(cache_path)
+
+
+def create_demand_files(folder, num_samples, sources, sinks):
+    """
+    Allocates the columnar demand files for a single data series. Source and sink demands
+    are stored as contiguous N x K float32 arrays which can be memory-mapped when loading.
+    Files are allocated under temporary names and only moved into place by
+    finalize_demand_files, so a partially written series is never read.
+    """
+    # The series is incomplete until it is finalized again
+    delete_if_exists(path.join(folder, DEMANDS_HEADER))
+
+    shapes = [(num_samples, len(sources)), (num_samples, len(sinks))]
+    for file_name, shape in zip([SOURCE_DEMANDS_FILE, SINK_DEMANDS_FILE], shapes):
+        demands = np.lib.format.open_memmap(path.join(folder, file_name + '.tmp'), mode='w+', dtype=DEMANDS_DTYPE, shape=shape)
+        demands.flush()
+        del demands
+
+    header = {
+        'num_samples': int(num_samples),
+        'sources': [int(source) for source in sources],
+        'sinks': [int(sink) for sink in sinks],
+        'dtype': DEMANDS_DTYPE
+    }
+    with open(path.join(folder, DEMANDS_HEADER + '.tmp'), 'w') as header_file:
+        json.dump(header, header_file)
+
+
+def write_demands(folder, source_demands, sink_demands, offset):
+    """
+    Writes the given demands into the (already allocated and not yet finalized) demand
+    files of a series starting at the given sample offset.
+    """
+    for file_name, values in zip([SOURCE_DEMANDS_FILE, SINK_DEMANDS_FILE], [source_demands, sink_demands]):
+        demands = np.lib.format.open_memmap(path.join(folder, file_name + '.tmp'), mode='r+')
+        demands[offset:offset+len(values)] = values
+        demands.flush()
+        del demands
+
 
+def finalize_demand_files(folder):
+    """
+    Moves the demand files of a fully written series into place. The header is moved last
+    as it marks the series as complete. Files which were already moved are skipped, so an
+    interrupted call can be repeated.
+    """
+    for file_name in [SOURCE_DEMANDS_FILE, SINK_DEMANDS_FILE, DEMANDS_HEADER]:
+        file_path = path.join(folder, file_name)
+        if path.exists(file_path + '.tmp'):
+            os.replace(file_path + '.tmp', file_path)
+
+
+def write_paths(paths, file_path):
+    """
+    Writes a dictionary from (source, sink) to a list of edge-id arrays. Paths are stored
+    back to back in a single edge array and indexed by two levels of offsets: pair_indptr
+    selects the paths of each pair and path_indptr selects the edges of each path.
+    """
+    pairs = list(paths.keys())
+    pair_paths = [paths[pair] for pair in pairs]
+    all_paths = [edge_path for path_list in pair_paths for edge_path in path_list]
+
+    pair_indptr = np.concatenate([[0], np.cumsum([len(path_list) for path_list in pair_paths])])
+    path_indptr = np.concatenate([[0], np.cumsum([len(edge_path) for edge_path in all_paths])])
+    edges = np.concatenate(all_paths) if len(all_paths) > 0 else np.zeros(shape=(0,))
+
+    np.savez(file_path,
+             sources=np.array([source for source, _ in pairs], dtype=np.int64),
+             sinks=np.array([sink for _, sink in pairs], dtype=np.int64),
+             pair_indptr=pair_indptr.astype(np.int64),
+             path_indptr=path_indptr.astype(np.int64),
+             edges=edges.astype(np.int64))
 
-def write(dataset, folder, index):
+
+def read_paths(file_path):
     """
-    Serializes the given matrices  as sparse matrices in a set of files. We use a custom function
-    here because the scipy.sparse.save_npz function only allows for a single sparse matrix.
+    Returns the dictionary from (source, sink) to lists of edge-id arrays written by write_paths.
     """
-    source_data = {str(i): data[0] for i, data in enumerate(dataset)}
-    sink_data = {str(i): data[1] for i, data in enumerate(dataset)}
+    with np.load(file_path) as data:
+        pair_indptr, path_indptr, edges = data['pair_indptr'], data['path_indptr'], data['edges']
+        paths = [edges[start:end] for start, end in zip(path_indptr[:-1], path_indptr[1:])]
+
+        return {(int(source), int(sink)): paths[start:end]
+                for source, sink, start, end in zip(data['sources'], data['sinks'], pair_indptr[:-1], pair_indptr[1:])}
 
-    source_file_path = path.join(folder, 'source-demands-{0}.pkl.gz'.format(index))
-    serialize_dict(dictionary=source_data, file_path=source_file_path)
 
-    sink_file_path = path.join(folder, 'sink-demands-{0}.pkl.gz'.format(index))
-    serialize_dict(dictionary=sink_data, file_path=sink_file_path)
+def has_demand_files(folder):
+    return path.exists(path.join(folder, DEMANDS_HEADER))
 
 
-def read(folder, file_index, sources, sinks, num_nodes):
+def read_demands(folder):
+    """
+    Returns read-only memory maps of the N x K_1 source demands and N x K_2 sink demands
+    along with the header of the given series.
+    """
+    with open(path.join(folder, DEMANDS_HEADER), 'r') as header_file:
+        header = json.load(header_file)
+
+    source_demands = np.load(path.join(folder, SOURCE_DEMANDS_FILE), mmap_mode='r')
+    sink_demands = np.load(path.join(folder, SINK_DEMANDS_FILE), mmap_mode='r')
+    return source_demands, sink_demands, header
+
+
+def read(folder, file_index):
+    """
+    Reads a single shard of the legacy dataset format in which demands are stored as
+    pickled dictionaries. Returns the source and sink demands as N x K arrays.
+    """
 
     def read_dict(folder, name):
         file_path = path.join(folder, name)
@@ -123,20 +256,9 @@ def read(folder, file_index, sources, sinks, num_nodes):
     source_data = read_dict(folder, 'source-demands-{0}.pkl.gz'.format(file_index))
     sink_data = read_dict(folder, 'sink-demands-{0}.pkl.gz'.format(file_index))
 
-    dataset = []
-    for i in range(len(source_data)):
-        index = str(i)
-        source_demands = source_data[index]
-        sink_demands = sink_data[index]
-
-        demands = np.zeros(shape=(num_nodes, 1))
-        demands[sources, 0] = source_demands
-        demands[sinks, 0] = sink_demands
-
-        sp_mat = sp.csr_matrix(demands)
-        dataset.append(sp_mat)
-
-    return dataset
+    source_demands = np.array([source_data[str(i)] for i in range(len(source_data))])
+    sink_demands = np.array([sink_data[str(i)] for i in range(len(sink_data))])
+    return source_demands, sink_demands
 
 
 def load_embeddings(index_path, embedding_size, num_nodes):
@@ -0,0 +1,68 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+class Prefetcher:
+    """
+    Executes tasks on a pool of background threads while keeping up to num_batches
+    results in flight. Tasks are pulled from their iterable on the calling thread and
+    results are returned in submission order, so any sampling performed while producing
+    tasks remains deterministic. Threads are used (rather than processes) because feed
+    dictionaries are keyed by TensorFlow placeholders, which cannot be pickled.
+    """
+
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+        self.executor = None
+        if num_batches > 0:
+            self.executor = ThreadPoolExecutor(max_workers=num_batches, thread_name_prefix='prefetch')
+
+    def prefetch(self, tasks):
+        """
+        Generator over (tag, fn()) pairs for an iterable of (tag, fn) tasks. The next
+        task is requested only when a result is consumed, so tasks are always produced
+        exactly num_batches steps ahead of the consumer.
+        """
+        tasks = iter(tasks)
+
+        # Without prefetching, run every task synchronously
+        if self.executor is None:
+            for tag, fn in tasks:
+                yield tag, fn()
+            return
+
+        queue = deque()
+        try:
+            for tag, fn in islice(tasks, self.num_batches):
+                queue.append((tag, self.executor.submit(fn)))
+
+            while len(queue) > 0:
+                tag, future = queue.popleft()
+                result = future.result()
+
+                # Refill before yielding so that workers stay busy during the consumer's step
+                for next_tag, fn in islice(tasks, 1):
+                    queue.append((next_tag, self.executor.submit(fn)))
+
+                yield tag, result
+        finally:
+            for _, future in queue:
+                future.cancel()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,146 @@
+import osmnx as ox
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from os import path
+from os import mkdir
+from utils.utils import serialize_dict, append_row_to_log, delete_if_exists
+from core.load import save_graph_snapshot
+
+
+# Synthetic coordinates are in meters, so graphs are given a projected reference system
+SYNTHETIC_CRS = '+proj=utm +zone=30 +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
+
+
+def grid_edges(num_nodes, rng, spacing=100.0, jitter=0.2, removal=0.1):
+    """
+    Planar grid of roughly num_nodes intersections. Nodes are moved by up to jitter * spacing
+    and a fraction of the streets is removed.
+    """
+    rows = max(int(np.sqrt(num_nodes)), 2)
+    cols = max(int(np.ceil(num_nodes / rows)), 2)
+
+    row_index, col_index = np.divmod(np.arange(rows * cols), cols)
+    x = (col_index + rng.uniform(low=-jitter, high=jitter, size=rows * cols)) * spacing
+    y = (row_index + rng.uniform(low=-jitter, high=jitter, size=rows * cols)) * spacing
+
+    nodes = np.arange(rows * cols).reshape(rows, cols)
+    horizontal = np.stack([nodes[:, :-1].flatten(), nodes[:, 1:].flatten()], axis=1)
+    vertical = np.stack([nodes[:-1, :].flatten(), nodes[1:, :].flatten()], axis=1)
+    edges = np.concatenate([horizontal, vertical], axis=0)
+
+    keep = rng.uniform(size=len(edges)) >= removal
+    return x, y, edges[keep]
+
+
+def random_geometric_edges(num_nodes, rng, spacing=100.0, avg_degree=6.0):
+    """
+    Nodes placed uniformly at random in a square with one node per spacing^2 on average.
+    Nodes are connected when they are close enough for the expected degree to be avg_degree.
+    """
+    side = spacing * np.sqrt(num_nodes)
+    x = rng.uniform(low=0.0, high=side, size=num_nodes)
+    y = rng.uniform(low=0.0, high=side, size=num_nodes)
+
+    radius = spacing * np.sqrt(avg_degree / np.pi)
+    edges = cKDTree(np.stack([x, y], axis=1)).query_pairs(r=radius, output_type='ndarray')
+    return x, y, edges
+
+
+def ring_radial_edges(num_nodes, rng, spacing=100.0, num_spokes=None):
+    """
+    Concentric ring roads joined by radial roads which meet at a central node. The central
+    node is adjacent to every spoke, so this graph has a large maximum degree.
+    """
+    if num_spokes is None:
+        num_spokes = max(int(np.sqrt(2 * np.pi * num_nodes)), 4)
+    num_rings = max(int(np.ceil((num_nodes - 1) / num_spokes)), 1)
+
+    # Node 0 is the center and node 1 + r * num_spokes + s lies on ring r and spoke s
+    ring_index, spoke_index = np.divmod(np.arange(num_rings * num_spokes), num_spokes)
+    radius = (ring_index + 1) * spacing
+    angle = 2 * np.pi * (spoke_index + rng.uniform(low=-0.25, high=0.25, size=len(spoke_index))) / num_spokes
+    x = np.concatenate([[0.0], radius * np.cos(angle)])
+    y = np.concatenate([[0.0], radius * np.sin(angle)])
+
+    nodes = 1 + np.arange(num_rings * num_spokes).reshape(num_rings, num_spokes)
+    rings = np.stack([nodes.flatten(), np.roll(nodes, shift=-1, axis=1).flatten()], axis=1)
+    radials = np.stack([nodes[:-1, :].flatten(), nodes[1:, :].flatten()], axis=1)
+    center = np.stack([np.zeros(num_spokes, dtype=int), nodes[0, :]], axis=1)
+    return x, y, np.concatenate([rings, radials, center], axis=0)
+
+
+GENERATORS = {
+    'grid': grid_edges,
+    'random_geometric': random_geometric_edges,
+    'ring_radial': ring_radial_edges
+}
+
+
+def directed_edges(edges, rng, one_way):
+    """
+    Turns undirected streets into directed edges. A fraction of streets is one-way in a
+    random direction and the remaining streets are two-way.
+    """
+    is_one_way = rng.uniform(size=len(edges)) < one_way
+    flip = rng.uniform(size=len(edges)) < 0.5
+
+    one_way_edges = edges[is_one_way]
+    one_way_edges[flip[is_one_way]] = one_way_edges[flip[is_one_way]][:, ::-1]
+
+    two_way_edges = edges[~is_one_way]
+    return np.concatenate([one_way_edges, two_way_edges, two_way_edges[:, ::-1]], axis=0)
+
+
+def save_synthetic_graph(graph_name, generator, num_nodes, seed=0, one_way=0.1, **kwargs):
+    """
+    Generates a road network and saves it in the same layout as save_graph, so it can be
+    read with load_graph. Only the largest strongly connected component is kept, so the
+    saved graph may have slightly fewer than num_nodes nodes.
+    """
+    assert generator in GENERATORS, 'Invalid generator {0}'.format(generator)
+
+    rng = np.random.RandomState(seed)
+    x, y, edges = GENERATORS[generator](num_nodes, rng, **kwargs)
+    edges = directed_edges(edges, rng, one_way=one_way)
+
+    # Keep the largest strongly connected component and relabel its nodes
+    adj_mat = sp.csr_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(x), len(x)))
+    _, labels = connected_components(adj_mat, directed=True, connection='strong')
+    component = labels == np.argmax(np.bincount(labels))
+    node_ids = np.cumsum(component) - 1
+
+    edges = edges[component[edges[:, 0]] & component[edges[:, 1]]]
+    x, y = x[component], y[component]
+    src, dst = node_ids[edges[:, 0]], node_ids[edges[:, 1]]
+    lengths = np.linalg.norm(np.stack([x[src] - x[dst], y[src] - y[dst]], axis=1), axis=1)
+
+    graph = nx.MultiDiGraph(crs=SYNTHETIC_CRS, name=graph_name)
+    graph.add_nodes_from((node, {'x': node_x, 'y': node_y})
+                         for node, (node_x, node_y) in enumerate(zip(x.tolist(), y.tolist())))
+    graph.add_edges_from((u, v, 0, {'length': length})
+                         for u, v, length in zip(src.tolist(), dst.tolist(), lengths.tolist()))
+
+    folder_path = path.join('graphs', graph_name)
+    if not path.exists(folder_path):
+        mkdir(folder_path)
+
+    serialize_dict(dictionary=dict(graph.graph), file_path=path.join(folder_path, 'graph_data.pkl.gz'))
+    ox.save_graphml(graph, filepath=path.join(folder_path, 'graph.graphml'))
+    save_graph_snapshot(folder_path)
+
+    # The diameter is left out of the stats as it needs all pairwise distances
+    stats_file = path.join(folder_path, 'stats.csv')
+    delete_if_exists(stats_file)
+
+    n_nodes = graph.number_of_nodes()
+    n_edges = graph.number_of_edges()
+    append_row_to_log(['Number of Nodes', n_nodes], stats_file)
+    append_row_to_log(['Number of Edges', n_edges], stats_file)
+    append_row_to_log(['Average In Degree', n_edges / n_nodes], stats_file)
+    append_row_to_log(['Average Out Degree', n_edges / n_nodes], stats_file)
+    append_row_to_log(['Query', 'Synthetic {0}; Nodes: {1}; Seed: {2}'.format(generator, num_nodes, seed)], stats_file)
+
+    return graph
@@ -10,6 +10,18 @@ class CostFunction:
     def __call__(self, x):
         raise NotImplementedError()
 
+    def derivative(self, x):
+        """
+        Gradient of the total cost, which is the elementwise derivative because costs are separable.
+        """
+        raise NotImplementedError()
+
+    def second_derivative(self, x):
+        """
+        Elementwise second derivative, which is the diagonal of the (diagonal) Hessian.
+        """
+        raise NotImplementedError()
+
 
 class Linear(CostFunction):
 
@@ -21,6 +33,12 @@ class Linear(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * x + self.b)
 
+    def derivative(self, x):
+        return np.full_like(x, self.a, dtype=float)
+
+    def second_derivative(self, x):
+        return np.zeros_like(x, dtype=float)
+
 
 class Quadratic(CostFunction):
 
@@ -33,6 +51,12 @@ class Quadratic(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * np.square(x) + self.b * x + self.c)
 
+    def derivative(self, x):
+        return 2.0 * self.a * x + self.b
+
+    def second_derivative(self, x):
+        return np.full_like(x, 2.0 * self.a, dtype=float)
+
 
 class Cubic(CostFunction):
 
@@ -46,6 +70,12 @@ class Cubic(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * np.power(x, 3) + self.b * np.square(x) + self.c * x + self.d)
 
+    def derivative(self, x):
+        return 3.0 * self.a * np.square(x) + 2.0 * self.b * x + self.c
+
+    def second_derivative(self, x):
+        return 6.0 * self.a * x + 2.0 * self.b
+
 
 class Quartic(CostFunction):
 
@@ -61,6 +91,12 @@ class Quartic(CostFunction):
         return np.sum(self.a * np.power(x, 4) + self.b * np.power(x, 3) +
                       self.c * np.square(x) + self.d * x + self.e)
 
+    def derivative(self, x):
+        return 4.0 * self.a * np.power(x, 3) + 3.0 * self.b * np.square(x) + 2.0 * self.c * x + self.d
+
+    def second_derivative(self, x):
+        return 12.0 * self.a * np.square(x) + 6.0 * self.b * x + 2.0 * self.c
+
 
 class Exp(CostFunction):
 
@@ -74,6 +110,12 @@ class Exp(CostFunction):
     def __call__(self, x):
         return np.sum(np.exp(self.a * x) - 1)
 
+    def derivative(self, x):
+        return self.a * np.exp(self.a * x)
+
+    def second_derivative(self, x):
+        return np.square(self.a) * np.exp(self.a * x)
+
 
 class Log(CostFunction):
 
@@ -86,6 +128,12 @@ class Log(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * np.log(self.b * x + 1) + self.c)
 
+    def derivative(self, x):
+        return self.a * self.b / (self.b * x + 1)
+
+    def second_derivative(self, x):
+        return -self.a * np.square(self.b) / np.square(self.b * x + 1)
+
 
 class LinearSin(CostFunction):
 
@@ -98,6 +146,12 @@ class LinearSin(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * x + self.b * np.sin(self.c * x))
 
+    def derivative(self, x):
+        return self.a + self.b * self.c * np.cos(self.c * x)
+
+    def second_derivative(self, x):
+        return -self.b * np.square(self.c) * np.sin(self.c * x)
+
 
 class Tanh(CostFunction):
 
@@ -110,6 +164,13 @@ class Tanh(CostFunction):
     def __call__(self, x):
         return np.sum(self.a * np.tanh(self.b * x) + self.c)
 
+    def derivative(self, x):
+        return self.a * self.b * (1 - np.square(np.tanh(self.b * x)))
+
+    def second_derivative(self, x):
+        tanh = np.tanh(self.b * x)
+        return -2.0 * self.a * np.square(self.b) * tanh * (1 - np.square(tanh))
+
 
 def get_cost_function(cost_fn):
 
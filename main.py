@@ -4,17 +4,19 @@ import networkx as nx
 import numpy as np
 import json
 import scipy.sparse as sp
-from annoy import AnnoyIndex
 from utils.utils import load_params, restore_params, create_node_embeddings
-from utils.utils import append_row_to_log, create_demands, file_index, find_max_sources_sinks
+from utils.utils import append_row_to_log, file_index, find_max_sources_sinks
 from utils.utils import create_capacities, delete_if_exists, serialize_dict
 from utils.graph_utils import random_walk_neighborhoods, simple_paths
 from utils.graph_utils import random_sources_sinks, farthest_nodes, farthest_sink_nodes
 from utils.constants import *
-from core.load import load_embeddings, write, save_graph, load_graph
+from core.load import load_embeddings, save_graph, load_graph, create_demand_files, finalize_demand_files, write_paths
+from core.generation import SERIES, num_shards, generate_shards, create_train_filter
+from core.generation import load_manifest, write_manifest
 from core.plot import plot_road_flow_graph
 from model_runners.fixed_baseline import FixedBaseline
 from model_runners.optimization_baseline import OptimizationBaseline
+from model_runners.label_runner import LabelRunner
 from model_runners.flow_model_runner import FlowModelRunner
 
 
@@ -27,8 +29,12 @@ def main():
     parser.add_argument('--test', action='store_true', help='Flag to specify testing.')
     parser.add_argument('--slsqp', action='store_true', help='Flag to specify using SLSQP baseline.')
     parser.add_argument('--trust-constr', action='store_true', help='Flag to specify using Trust Constraint baseline.')
+    parser.add_argument('--interior-point', action='store_true', help='Flag to specify using the Interior Point baseline.')
+    parser.add_argument('--label', action='store_true', help='Flag to specify labelling a dataset with optimal costs.')
+    parser.add_argument('--save-flows', action='store_true', help='Flag to specify saving optimal flows when labelling.')
     parser.add_argument('--fixed', action='store_true', help='Flag to specify using the Fixed Proportions baseline.')
     parser.add_argument('--view-params', action='store_true', help='Flag to specify viewing model parameters.')
+    parser.add_argument('--random-walks', action='store_true', help='Flag to specify printing random walk neighborhood sizes.')
     parser.add_argument('--graph-stats', action='store_true')
     parser.add_argument('--model', type=str, help='Path to trained model.')
     args = parser.parse_args()
@@ -48,20 +54,35 @@ def main():
     elif args.generate:
         generate(params['generate'])
     elif args.test:
+        # Keep any other optimizer settings, such as the number of workers
         if args.slsqp:
-            model_params['optimizer'] = {
+            model_params.setdefault('optimizer', {}).update({
                 'use_optimizer': True,
                 'optimizer_name': 'slsqp'
-            }
+            })
         elif args.trust_constr:
-            model_params['optimizer'] = {
+            model_params.setdefault('optimizer', {}).update({
                 'use_optimizer': True,
                 'optimizer_name': 'trust_constr'
-            }
+            })
+        elif args.interior_point:
+            model_params.setdefault('optimizer', {}).update({
+                'use_optimizer': True,
+                'optimizer_name': 'interior_point'
+            })
         mcf_solver = FlowModelRunner(params=model_params)
         mcf_solver.test(args.model)
+    elif args.label:
+        if args.slsqp:
+            optimizer_name = 'slsqp'
+        elif args.trust_constr:
+            optimizer_name = 'trust_constr'
+        else:
+            optimizer_name = 'interior_point'
+        runner = LabelRunner(params=model_params, optimizer_name=optimizer_name, save_flows=args.save_flows)
+        runner.label()
     elif args.random_walks:
-        random_walks(params['generate']['graph_names'][0], params['model']['unique_neighborhoods'])
+        random_walks(model_params['graph_name'], model_params['num_neighborhoods'], model_params['unique_neighborhoods'])
     elif args.graph_stats:
         graph_stats(params['generate']['graph_names'][0])
     elif args.trust_constr:
@@ -70,6 +91,9 @@ def main():
     elif args.slsqp:
         baseline = OptimizationBaseline(params=model_params, optimizer_name='slsqp')
         baseline.optimize()
+    elif args.interior_point:
+        baseline = OptimizationBaseline(params=model_params, optimizer_name='interior_point')
+        baseline.optimize()
     elif args.fixed:
         baseline = FixedBaseline(params=model_params)
         baseline.test(model_path=None)
@@ -97,9 +121,84 @@ def generate(params):
     if not os.path.exists(dataset_folder):
         os.mkdir(dataset_folder)
 
-    # Save parameters
-    serialize_dict(dictionary=params, file_path=os.path.join(dataset_folder, 'params.pkl.gz'))
+    num_workers = params.get('num_workers', 1)
+
+    # The number of workers does not change the generated dataset
+    settings = {key: value for key, value in params.items() if key != 'num_workers'}
+
+    # Resume an interrupted generation with the same settings
+    manifest = load_manifest(dataset_folder)
+    if manifest is not None and manifest['settings'] == settings:
+        sources, sinks = manifest['sources'], manifest['sinks']
+        print('Resuming generation of {0}.'.format(dataset_name))
+    else:
+        # Sources, sinks and demands are all derived from the master seed
+        seed = params['seed'] if 'seed' in params else np.random.randint(low=0, high=2**31 - 1)
+        np.random.seed(seed)
+
+        # Save parameters
+        serialize_dict(dictionary=dict(params, seed=seed), file_path=os.path.join(dataset_folder, 'params.pkl.gz'))
+
+        sources, sinks = select_sources_sinks(graph, params, dataset_folder)
+
+        manifest = {
+            'settings': settings,
+            'seed': int(seed),
+            'sources': [int(source) for source in sources],
+            'sinks': [int(sink) for sink in sinks],
+            'num_samples': {},
+            'completed': {}
+        }
+
+        for series in SERIES:
+            # Create folder to put this data series in
+            series_folder = os.path.join(dataset_folder, series)
+            if not os.path.exists(series_folder):
+                os.mkdir(series_folder)
+
+            num_samples = params['{0}_samples'.format(series)]
+            create_demand_files(folder=series_folder, num_samples=num_samples, sources=sources, sinks=sinks)
+
+            manifest['num_samples'][series] = num_samples
+            manifest['completed'][series] = []
+
+        write_manifest(dataset_folder, manifest)
+
+    # Validation and test demands are kept apart from the training demands, so the
+    # training shards are generated first
+    for stage in [['train'], ['valid', 'test']]:
+        tasks = []
+        for series in stage:
+            num_samples = manifest['num_samples'][series]
+            for shard in range(num_shards(num_samples)):
+                if shard not in manifest['completed'][series]:
+                    tasks.append((series, shard, min(WRITE_THRESHOLD, num_samples - shard * WRITE_THRESHOLD)))
+
+        if len(tasks) > 0:
+            demand_filter = create_train_filter(dataset_folder) if 'train' not in stage else None
+            initargs = (dataset_folder, manifest['seed'], len(sources), len(sinks), demand_filter)
+            generate_shards(tasks, manifest, dataset_folder, initargs, num_workers=num_workers)
+
+        # Every shard of these series is written, so their demand files can be read
+        for series in stage:
+            finalize_demand_files(folder=os.path.join(dataset_folder, series))
+
+    print('Completed {0}.'.format(dataset_name))
+
+
+def random_walks(graph_name, num_neighborhoods, unique_neighborhoods):
+    graph = load_graph(graph_name=graph_name)
+    adj_matrix = graph.adjacency_matrix()
+
+    # Outgoing and incoming neighborhoods are computed in the same way as GraphData
+    for direction, mat in [('Out', adj_matrix), ('In', adj_matrix.transpose(copy=True))]:
+        neighborhoods = random_walk_neighborhoods(mat, k=num_neighborhoods, unique_neighborhoods=unique_neighborhoods)
+        for k, neighborhood in enumerate(neighborhoods):
+            degrees = np.asarray(neighborhood.sum(axis=1)).reshape(-1)
+            print('{0}-Neighborhood {1}: Avg Size {2:.3f}, Max Size {3}'.format(direction, k, np.average(degrees), int(np.max(degrees))))
+
 
+def select_sources_sinks(graph, params, dataset_folder):
     # Generate and save sources and sinks
     if params['source_sink_strategy'] == 'random':
         sources, sinks = random_sources_sinks(graph, num_sources=params['num_sources'], num_sinks=params['num_sinks'])
@@ -108,13 +207,13 @@ def generate(params):
     else:
         sources, sinks = farthest_nodes(graph, num_sources=params['num_sources'], num_sinks=params['num_sinks'])
 
-    G = graph.copy()
+    G = graph.to_networkx().copy()
     for source in sources:
         G.add_node(source, demand=-1)
     for sink in sinks:
         G.add_node(sink, demand=1)
     file_path = os.path.join(dataset_folder, 'graph')
-    plot_road_flow_graph(graph=G, field='zero', graph_name=graph_name, file_path=file_path)
+    plot_road_flow_graph(graph=G, field='zero', graph_name=params['graph_name'], file_path=file_path)
 
     source_sink_dict = {
         'sources': sources,
@@ -122,62 +221,12 @@ def generate(params):
     }
     serialize_dict(dictionary=source_sink_dict, file_path=os.path.join(dataset_folder, 'sources_sinks.pkl.gz'))
 
-    # Generate and save paths between sources and sinks
-    # paths = simple_paths(graph=graph, sources=sources, sinks=sinks, max_num_paths=params['max_num_paths'])
-    # serialize_dict(dictionary=paths, file_path=os.path.join(dataset_folder, 'paths.pkl.gz'))
-
-    demands_thresh = 0.1
-    source_index = AnnoyIndex(len(sources))
-    sink_index = AnnoyIndex(len(sinks))
-
-    file_paths = ['train', 'valid', 'test']
-    samples = [params['train_samples'], params['valid_samples'], params['test_samples']]
-    for file_path, num_samples in zip(file_paths, samples):
-
-        # Create folder to put this data series in
-        series_folder = os.path.join(dataset_folder, file_path)
-        if not os.path.exists(series_folder):
-            os.mkdir(series_folder)
-
-        dataset = []
-        for i in range(num_samples):
-            source_demands, sink_demands = create_demands(sources=sources, sinks=sinks)
-
-            # Ensure training demands not too close to either validation or test demands
-            if file_path == 'train':
-                source_index.add_item(i, source_demands)
-                sink_index.add_item(i, sink_demands)
-            else:
-                _, source_dist = source_index.get_nns_by_vector(source_demands, n=1, include_distances=True)
-                _, sink_dist = source_index.get_nns_by_vector(sink_demands, n=1, include_distances=True)
-
-                retries = 0
-                while source_dist[0] < demands_thresh and sink_dist[0] < demands_thresh:
-                    source_demands, sink_demands = create_demands(sources=sources, sinks=sinks)
-                    _, source_dist = source_index.get_nns_by_vector(source_demands, n=1, include_distances=True)
-                    _, sink_dist = source_index.get_nns_by_vector(sink_demands, n=1, include_distances=True)
-
-                    assert retries < 1000, 'Retried too many times.'
-                    retries += 1
-
-            dataset.append((source_demands, sink_demands))
-
-            # Periodically write to output files
-            if (i+1) % WRITE_THRESHOLD == 0:
-                index, _ = file_index(i)
-                write(dataset=dataset, folder=series_folder, index=index)
-                print('Completed {0}/{1} samples for {2}.'.format(i+1, num_samples, file_path))
-                dataset = []
-
-        if len(dataset) > 0:
-            index, _ = file_index(i)
-            write(dataset=dataset, folder=series_folder, index=index)
-        print('Completed {0}.'.format(file_path))
-
-        if file_path == 'train':
-            source_index.build(10)
-            sink_index.build(10)
+    # Generate and save the shortest paths between sources and sinks
+    if params.get('max_num_paths', 0) > 0:
+        paths = simple_paths(graph=graph, sources=sources, sinks=sinks, max_num_paths=params['max_num_paths'])
+        write_paths(paths=paths, file_path=os.path.join(dataset_folder, PATHS_FILE))
 
+    return sources, sinks
 
 if __name__ == '__main__':
     main()
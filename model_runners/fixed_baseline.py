@@ -55,24 +55,12 @@ class FixedBaseline(ModelRunner):
 
     def create_feed_dict(self, placeholders, batch, batch_size, data_series, **kwargs):
 
-        # Padding parameters
-        max_degree = kwargs['max_degree']
-        max_num_nodes = kwargs['max_num_nodes']
-
-        # Fetch features for each sample in the given batch
-        demands = np.array([sample.demands for sample in batch])
-        adj_lsts = np.array([sample.adj_lst for sample in batch])
-        num_nodes = np.array([sample.num_nodes for sample in batch]).reshape(-1, 1)
+        graph_data = batch.graph_data
+        adj_lsts = np.broadcast_to(graph_data.adj_lst, shape=(batch_size,) + graph_data.adj_lst.shape)
+        num_nodes = np.full(shape=(batch_size, 1), fill_value=graph_data.num_nodes)
 
         # 3D indexing used for flow computation and correction
-        batch_indices = np.arange(start=0, stop=batch_size)
-        batch_indices = np.repeat(batch_indices, adj_lsts.shape[1] * max_degree).reshape((-1, 1))
-
-        in_indices = np.vstack([sample.in_indices for sample in batch])
-        in_indices = np.concatenate([batch_indices, in_indices], axis=1)
-
-        # Add dummy embeddings, features and demands to account for added node
-        demands = np.insert(demands, demands.shape[1], 0, axis=1)
+        in_indices = self.batch_indices(graph_data.in_indices, batch_size)
 
         if kwargs['name'] == 'random':
             flow_proportions = np.random.uniform(size=adj_lsts.shape, low=-1.0, high=1.0)
@@ -82,7 +70,7 @@ class FixedBaseline(ModelRunner):
             flow_proportions = mask / np.clip(out_neighbors, a_min=SMALL_NUMBER, a_max=BIG_NUMBER)
 
         feed_dict = {
-            placeholders['demands']: demands,
+            placeholders['demands']: batch.demands,
             placeholders['adj_lst']: adj_lsts,
             placeholders['num_nodes']: num_nodes,
             placeholders['in_indices']: in_indices,
@@ -36,6 +36,32 @@ class FlowModelRunner(ModelRunner):
                                               shape=demands_shape,
                                               name='demands-ph',
                                               is_sparse=False)
+        dropout_keep_ph = model.create_placeholder(dtype=tf.float32,
+                                                   shape=(),
+                                                   name='dropout-keep-ph',
+                                                   is_sparse=False)
+        true_costs_ph = model.create_placeholder(dtype=tf.float32,
+                                                 shape=(b,),
+                                                 name='true-costs-ph',
+                                                 is_sparse=False)
+
+        placeholders = {
+            'node_features': node_ph,
+            'demands': demands_ph,
+            'dropout_keep_prob': dropout_keep_ph,
+            'max_num_nodes': max_num_nodes,
+            'true_costs': true_costs_ph
+        }
+
+        # The edge list is shared by every sample in a batch, so it is always stored as constants
+        if self.params['inflow_kernel'] == 'sparse':
+            placeholders.update(self.create_edge_constants(model=model))
+
+        # The graph structure is identical for every sample, so it can be uploaded once
+        if self.params['constant_graph']:
+            placeholders.update(self.create_graph_constants(model=model, batch_size=b))
+            return placeholders
+
         adj_ph = model.create_placeholder(dtype=tf.int32,
                                           shape=adj_shape,
                                           name='adj-ph',
@@ -56,10 +82,6 @@ class FlowModelRunner(ModelRunner):
                                                      shape=embedding_shape,
                                                      name='node-embedding-ph',
                                                      is_sparse=False)
-        dropout_keep_ph = model.create_placeholder(dtype=tf.float32,
-                                                   shape=(),
-                                                   name='dropout-keep-ph',
-                                                   is_sparse=False)
         num_nodes_ph = model.create_placeholder(dtype=tf.int32,
                                                 shape=num_nodes_shape,
                                                 name='num-nodes-ph',
@@ -72,10 +94,6 @@ class FlowModelRunner(ModelRunner):
                                                               shape=adj_shape,
                                                               name='norm-edge-lengths-ph',
                                                               is_sparse=False)
-        true_costs_ph = model.create_placeholder(dtype=tf.float32,
-                                                 shape=(b,),
-                                                 name='true-costs-ph',
-                                                 is_sparse=False)
 
         out_neighborhood_phs = []
         in_neighborhood_phs = []
@@ -95,79 +113,119 @@ class FlowModelRunner(ModelRunner):
             out_neighborhood_phs.append(out_ph)
             in_neighborhood_phs.append(in_ph)
 
-        return {
-            'node_features': node_ph,
-            'demands': demands_ph,
+        placeholders.update({
             'adj_lst': adj_ph,
             'inv_adj_lst': inv_adj_ph,
             'out_neighborhoods': out_neighborhood_phs,
             'in_neighborhoods': in_neighborhood_phs,
             'in_indices': in_indices_ph,
             'rev_indices': rev_indices_ph,
-            'dropout_keep_prob': dropout_keep_ph,
             'edge_lengths': edge_lengths_ph,
             'norm_edge_lengths': normalized_edge_lengths_ph,
-            'num_nodes': num_nodes_ph,
-            'max_num_nodes': max_num_nodes,
-            'true_costs': true_costs_ph
-        }
+            'num_nodes': num_nodes_ph
+        })
+        return placeholders
 
-    def create_feed_dict(self, placeholders, batch, batch_size, data_series, **kwargs):
-
-        # Padding parameters
-        max_degree = kwargs['max_degree']
-        max_num_nodes = kwargs['max_num_nodes']
-        max_out_neighborhood_degrees = kwargs['max_out_neighborhood_degrees']
-        max_in_neighborhood_degrees = kwargs['max_in_neighborhood_degrees']
+    def create_graph_constants(self, model, batch_size):
+        graph_data = self.dataset.graph_data
+        num_nodes = np.full(shape=(1,), fill_value=graph_data.num_nodes)
 
-        # Fetch features for each sample in the given batch
-        node_features = np.array([sample.node_features for sample in batch])
-        demands = np.array([sample.demands for sample in batch])
-        adj_lsts = np.array([sample.adj_lst for sample in batch])
-        inv_adj_lsts = np.array([sample.inv_adj_lst for sample in batch])
-        num_nodes = np.array([sample.num_nodes for sample in batch])
-        edge_lengths = np.array([sample.edge_lengths for sample in batch])
-        norm_edge_lengths = np.array([sample.normalized_edge_lengths for sample in batch])
-        dropout_keep = self.params['dropout_keep_prob'] if data_series == Series.TRAIN else 1.0
-        true_costs = np.array([sample.true_cost for sample in batch])
+        out_neighborhoods = []
+        in_neighborhoods = []
+        for i in range(self.params['num_neighborhoods'] + 1):
+            out_neighborhood = model.create_constant(value=graph_data.out_neighborhoods[i],
+                                                     dtype=tf.int32,
+                                                     name='out-neighborhood-{0}'.format(i),
+                                                     batch_size=batch_size)
+            in_neighborhood = model.create_constant(value=graph_data.in_neighborhoods[i],
+                                                    dtype=tf.int32,
+                                                    name='in-neighborhood-{0}'.format(i),
+                                                    batch_size=batch_size)
+            out_neighborhoods.append(out_neighborhood)
+            in_neighborhoods.append(in_neighborhood)
 
-        # 3D indexing used for flow computation and correction
-        batch_indices = np.arange(start=0, stop=batch_size)
-        batch_indices = np.repeat(batch_indices, adj_lsts.shape[1] * max_degree).reshape((-1, 1))
+        return {
+            'adj_lst': model.create_constant(value=graph_data.adj_lst,
+                                             dtype=tf.int32,
+                                             name='adj',
+                                             batch_size=batch_size),
+            'inv_adj_lst': model.create_constant(value=graph_data.inv_adj_lst,
+                                                 dtype=tf.int32,
+                                                 name='inv-adj',
+                                                 batch_size=batch_size),
+            'out_neighborhoods': out_neighborhoods,
+            'in_neighborhoods': in_neighborhoods,
+            'in_indices': model.create_constant(value=self.batch_indices(graph_data.in_indices, batch_size),
+                                                dtype=tf.int32,
+                                                name='in-indices'),
+            'rev_indices': model.create_constant(value=self.batch_indices(graph_data.rev_indices, batch_size),
+                                                 dtype=tf.int32,
+                                                 name='rev-indices'),
+            'edge_lengths': model.create_constant(value=graph_data.edge_lengths,
+                                                  dtype=tf.float32,
+                                                  name='edge-lengths',
+                                                  batch_size=batch_size),
+            'norm_edge_lengths': model.create_constant(value=graph_data.normalized_edge_lengths,
+                                                       dtype=tf.float32,
+                                                       name='norm-edge-lengths',
+                                                       batch_size=batch_size),
+            'num_nodes': model.create_constant(value=num_nodes,
+                                               dtype=tf.int32,
+                                               name='num-nodes',
+                                               batch_size=batch_size)
+        }
 
-        rev_indices = np.vstack([sample.rev_indices for sample in batch])
-        rev_indices = np.concatenate([batch_indices, rev_indices], axis=1)
+    def create_edge_constants(self, model):
+        graph_data = self.dataset.graph_data
+        return {
+            'edge_slots': model.create_constant(value=graph_data.edge_slots,
+                                                dtype=tf.int32,
+                                                name='edge-slots'),
+            'edge_src': model.create_constant(value=graph_data.edge_src,
+                                              dtype=tf.int32,
+                                              name='edge-src'),
+            'edge_dst': model.create_constant(value=graph_data.edge_dst,
+                                              dtype=tf.int32,
+                                              name='edge-dst')
+        }
 
-        in_indices = np.vstack([sample.in_indices for sample in batch])
-        in_indices = np.concatenate([batch_indices, in_indices], axis=1)
+    def create_feed_dict(self, placeholders, batch, batch_size, data_series, **kwargs):
 
-        # Add dummy embeddings, features and demands to account for added node
-        demands = np.insert(demands, demands.shape[1], 0, axis=1)
-        node_features = np.insert(node_features, node_features.shape[1], 0, axis=1)
+        dropout_keep = self.params['dropout_keep_prob'] if data_series == Series.TRAIN else 1.0
 
         feed_dict = {
-            placeholders['node_features']: node_features,
-            placeholders['demands']: demands,
-            placeholders['adj_lst']: adj_lsts,
-            placeholders['inv_adj_lst']: inv_adj_lsts,
-            placeholders['edge_lengths']: edge_lengths,
-            placeholders['norm_edge_lengths']: norm_edge_lengths,
+            placeholders['node_features']: batch.node_features,
+            placeholders['demands']: batch.demands,
             placeholders['dropout_keep_prob']: dropout_keep,
-            placeholders['num_nodes']: np.reshape(num_nodes, [-1, 1]),
-            placeholders['in_indices']: in_indices,
-            placeholders['rev_indices']: rev_indices,
-            placeholders['true_costs']: true_costs
+            placeholders['true_costs']: batch.true_costs
         }
 
-        for i in range(self.params['num_neighborhoods'] + 1):
-            out_neighborhood = [sample.out_neighborhoods[i] for sample in batch]
-            in_neighborhood = [sample.in_neighborhoods[i] for sample in batch]
+        # Graph tensors are already stored as constants within the model
+        if self.params['constant_graph']:
+            return feed_dict
+
+        # Repeat the graph tensors for each sample in the batch
+        graph_data = batch.graph_data
 
+        def repeat(arr):
+            return np.broadcast_to(arr, shape=(batch_size,) + arr.shape)
+
+        feed_dict.update({
+            placeholders['adj_lst']: repeat(graph_data.adj_lst),
+            placeholders['inv_adj_lst']: repeat(graph_data.inv_adj_lst),
+            placeholders['edge_lengths']: repeat(graph_data.edge_lengths),
+            placeholders['norm_edge_lengths']: repeat(graph_data.normalized_edge_lengths),
+            placeholders['num_nodes']: np.full(shape=(batch_size, 1), fill_value=graph_data.num_nodes),
+            placeholders['in_indices']: self.batch_indices(graph_data.in_indices, batch_size),
+            placeholders['rev_indices']: self.batch_indices(graph_data.rev_indices, batch_size)
+        })
+
+        for i in range(self.params['num_neighborhoods'] + 1):
             out_ph = placeholders['out_neighborhoods'][i]
-            feed_dict[out_ph] = out_neighborhood
+            feed_dict[out_ph] = repeat(graph_data.out_neighborhoods[i])
 
             in_ph = placeholders['in_neighborhoods'][i]
-            feed_dict[in_ph] = in_neighborhood
+            feed_dict[in_ph] = repeat(graph_data.in_neighborhoods[i])
 
         return feed_dict
 
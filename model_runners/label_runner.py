@@ -0,0 +1,174 @@
+import numpy as np
+import math
+import os
+import json
+from multiprocessing import Pool
+from model_runners.optimization_baseline import init_worker, optimize_instance
+from utils.utils import append_row_to_log
+from utils.constants import WRITE_THRESHOLD, LABEL_COSTS_FILE, LABEL_FLOWS_FILE, LABEL_MANIFEST
+from core.dataset import DatasetManager, Series
+
+
+class LabelRunner:
+    """
+    Computes optimal flow costs (and optionally flows) for every sample of a dataset. Samples
+    are labelled in shards of WRITE_THRESHOLD samples which are written atomically, so an
+    interrupted run resumes from the first incomplete shard. The settings which produced the
+    shards are recorded in a manifest, and shards from other settings are relabelled. Completed
+    shards are merged into the costs.csv file which is read by DatasetManager.
+    """
+
+    def __init__(self, params, optimizer_name, save_flows=False):
+        self.params = params
+        self.optimizer_name = optimizer_name
+        self.save_flows = save_flows
+        self.num_workers = params.get('optimizer', {}).get('num_workers', 1)
+
+        # Columns match the costs.csv files written by OptimizationBaseline
+        self.headers = ['Index', 'Graph', 'Flow Cost', 'Time (sec)', 'Num Iters']
+        if optimizer_name == 'interior_point':
+            self.headers.append('Duality Gap')
+        self.headers.append('Status')
+
+        self.dataset = DatasetManager(params=params)
+        self.dataset.load_graphs()
+
+    def label(self):
+        for series in [Series.TRAIN, Series.VALID, Series.TEST]:
+            self.label_series(series)
+
+    def label_series(self, series):
+        folder = self.dataset.data_folders[series]
+        num_samples = self.dataset.num_samples[series]
+        num_shards = int(math.ceil(num_samples / WRITE_THRESHOLD))
+
+        # Shards are only reused if they were labelled with the same settings
+        settings = {
+            'optimizer_name': self.optimizer_name,
+            'cost_fn': self.params['cost_fn'],
+            'flow_iters': self.params['flow_iters'],
+            'early_stop_threshold': self.params['early_stop_threshold'],
+            'num_samples': num_samples
+        }
+        if self._load_manifest(folder) != settings:
+            self._remove_shards(folder)
+            self._write_manifest(folder, settings)
+
+        pending = [shard for shard in range(num_shards) if not self._is_shard_complete(folder, shard, num_samples)]
+        print('Labelling {0} of {1} shards for {2}.'.format(len(pending), num_shards, series.name))
+
+        if len(pending) > 0:
+            self.dataset.load(series=series)
+            demands = self.dataset.dataset[series].demands[:, :self.dataset.num_nodes]
+            graph = self.dataset.graph_data.graph
+
+            indices = [i for shard in pending for i in range(shard * WRITE_THRESHOLD, min((shard + 1) * WRITE_THRESHOLD, num_samples))]
+
+            # Labels must not depend on the order of samples, so warm starts are not used
+            if self.num_workers > 1:
+                pool = Pool(processes=self.num_workers,
+                            initializer=init_worker,
+                            initargs=(self.params, self.optimizer_name, graph, demands, None))
+                results = pool.imap(optimize_instance, indices, chunksize=4)
+            else:
+                pool = None
+                init_worker(self.params, self.optimizer_name, graph, demands, None)
+                results = map(optimize_instance, indices)
+
+            try:
+                rows = []
+                flows = []
+                for index, (x, flow_cost, elapsed, num_iters, gap, status) in zip(indices, results):
+                    row = [index, self.params['graph_name'], flow_cost, elapsed, num_iters]
+                    if gap is not None:
+                        row.append(gap)
+                    row.append(status)
+                    rows.append(row)
+
+                    if np.isnan(flow_cost):
+                        print('Optimizer failed on sample {0} with status {1}.'.format(index, status))
+
+                    if self.save_flows:
+                        flows.append(x)
+
+                    # Results are ordered, so a shard is finished when its last sample arrives
+                    if (index + 1) % WRITE_THRESHOLD == 0 or index + 1 == num_samples:
+                        shard = index // WRITE_THRESHOLD
+                        self._write_shard(folder, shard, rows, flows)
+                        print('Completed shard {0}/{1} for {2}.'.format(shard + 1, num_shards, series.name))
+                        rows = []
+                        flows = []
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+
+        self._merge_shards(folder, num_shards)
+
+    def _is_shard_complete(self, folder, shard, num_samples):
+        # The last shard holds the remaining samples
+        shard_size = min(WRITE_THRESHOLD, num_samples - shard * WRITE_THRESHOLD)
+
+        if self.save_flows:
+            flows_path = os.path.join(folder, LABEL_FLOWS_FILE.format(shard))
+            if not os.path.exists(flows_path) or np.load(flows_path, mmap_mode='r').shape[0] != shard_size:
+                return False
+
+        costs_path = os.path.join(folder, LABEL_COSTS_FILE.format(shard))
+        if not os.path.exists(costs_path):
+            return False
+        with open(costs_path, 'r') as costs_file:
+            return sum(1 for _ in costs_file) == shard_size
+
+    def _load_manifest(self, folder):
+        manifest_path = os.path.join(folder, LABEL_MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    def _write_manifest(self, folder, settings):
+        # Written under a temporary name so that an interrupted write leaves no partial manifest
+        manifest_path = os.path.join(folder, LABEL_MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(settings, manifest_file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _remove_shards(self, folder):
+        costs_prefix, costs_suffix = LABEL_COSTS_FILE.split('{0}')
+        flows_prefix, flows_suffix = LABEL_FLOWS_FILE.split('{0}')
+
+        for file_name in os.listdir(folder):
+            for prefix, suffix in [(costs_prefix, costs_suffix), (flows_prefix, flows_suffix)]:
+                shard = file_name[len(prefix):-len(suffix)]
+                if file_name.startswith(prefix) and file_name.endswith(suffix) and shard.isdigit():
+                    os.remove(os.path.join(folder, file_name))
+
+    def _write_shard(self, folder, shard, rows, flows):
+        # Files are written under temporary names and then renamed so that a shard is
+        # either fully present or absent. The costs are written last as they mark completion.
+        if self.save_flows:
+            flows_path = os.path.join(folder, LABEL_FLOWS_FILE.format(shard))
+            with open(flows_path + '.tmp', 'wb') as flows_file:
+                np.save(flows_file, np.array(flows, dtype=np.float32))
+            os.replace(flows_path + '.tmp', flows_path)
+
+        costs_path = os.path.join(folder, LABEL_COSTS_FILE.format(shard))
+        if os.path.exists(costs_path + '.tmp'):
+            os.remove(costs_path + '.tmp')
+        for row in rows:
+            append_row_to_log(row, costs_path + '.tmp')
+        os.replace(costs_path + '.tmp', costs_path)
+
+    def _merge_shards(self, folder, num_shards):
+        costs_path = os.path.join(folder, 'costs.csv')
+        if os.path.exists(costs_path + '.tmp'):
+            os.remove(costs_path + '.tmp')
+
+        append_row_to_log(self.headers, costs_path + '.tmp')
+        with open(costs_path + '.tmp', 'a') as costs_file:
+            for shard in range(num_shards):
+                with open(os.path.join(folder, LABEL_COSTS_FILE.format(shard)), 'r') as shard_file:
+                    costs_file.write(shard_file.read())
+        os.replace(costs_path + '.tmp', costs_path)
@@ -4,13 +4,15 @@ import tensorflow as tf
 import os
 import math
 from datetime import datetime
+from multiprocessing import Pool
 from time import time
 from utils.utils import append_row_to_log, delete_if_exists
 from utils.constants import BIG_NUMBER, LINE
 from utils.graph_utils import add_features
-from core.plot import plot_road_flow_graph
+from core.plot import plot_road_flow_graph, plot_weights
 from core.dataset import DatasetManager, Series
-from models.optimization_models import SLSQP, TrustConstr
+from core.prefetch import Prefetcher
+from model_runners.optimization_baseline import init_worker, refine_instance
 
 
 PRINT_THRESHOLD = 100
@@ -24,6 +26,18 @@ class ModelRunner:
         if 'use_true_cost' not in self.params:
             self.params['use_true_cost'] = False
 
+        if 'constant_graph' not in self.params:
+            self.params['constant_graph'] = False
+
+        if 'prefetch_batches' not in self.params:
+            self.params['prefetch_batches'] = 0
+
+        if 'inflow_kernel' not in self.params:
+            self.params['inflow_kernel'] = 'gather'
+
+        if 'flow_solver' not in self.params:
+            self.params['flow_solver'] = 'picard'
+
         self.timestamp = datetime.now().strftime('%m-%d-%Y-%H-%M-%S')
         cost_fn_name = params['cost_fn']['name']
         normalizer = 'sparsemax' if params['use_sparsemax'] else 'softmax'
@@ -90,90 +104,92 @@ class ModelRunner:
         start_time = datetime.now()
         append_row_to_log(['Start Time', start_time.strftime('%m-%d-%Y-%H-%M-%S')], time_log)
 
-        for epoch in range(self.params['epochs']):
+        def feed_dict_task(series, indices):
+            return lambda: self.create_feed_dict(placeholders=ph_dict,
+                                                 batch=self.dataset.create_batch(series, indices),
+                                                 batch_size=batch_size,
+                                                 data_series=series,
+                                                 max_degree=self.dataset.max_degree,
+                                                 max_num_nodes=self.dataset.num_nodes,
+                                                 max_out_neighborhood_degrees=self.dataset.max_out_neighborhood_degrees,
+                                                 max_in_neighborhood_degrees=self.dataset.max_in_neighborhood_degrees)
 
-            print(LINE)
-            print('Epoch {0}'.format(epoch))
-            print(LINE)
+        def train_tasks(num_batches):
+            # Samples are drawn lazily on this thread, so the sequence depends only on the seed
+            for _ in range(num_batches):
+                indices = self.dataset.sample_train_indices(batch_size=batch_size)
+                yield indices, feed_dict_task(Series.TRAIN, indices)
 
-            # Training Batches
-            num_train_batches = int(math.ceil(self.dataset.num_train_points / batch_size))
-            train_losses = []
-            for i in range(num_train_batches):
+        def valid_tasks():
+            for indices in self.dataset.batch_indices(series=Series.VALID, batch_size=batch_size, shuffle=True):
+                yield indices, feed_dict_task(Series.VALID, indices)
 
-                batch, indices = self.dataset.get_train_batch(batch_size=batch_size)
+        # Feed dictionaries are assembled on background threads while the session runs. The
+        # threads are shut down even if a step fails.
+        with Prefetcher(num_batches=self.params['prefetch_batches']) as prefetcher:
+            for epoch in range(self.params['epochs']):
 
-                feed_dict = self.create_feed_dict(placeholders=ph_dict,
-                                                  batch=batch,
-                                                  batch_size=batch_size,
-                                                  data_series=Series.TRAIN,
-                                                  max_degree=self.dataset.max_degree,
-                                                  max_num_nodes=self.dataset.num_nodes,
-                                                  max_out_neighborhood_degrees=self.dataset.max_out_neighborhood_degrees,
-                                                  max_in_neighborhood_degrees=self.dataset.max_in_neighborhood_degrees)
+                print(LINE)
+                print('Epoch {0}'.format(epoch))
+                print(LINE)
 
-                outputs = model.run_train_step(feed_dict=feed_dict)
-                avg_loss = outputs[0]
-                loss = outputs[1]
+                # Training Batches
+                num_train_batches = int(math.ceil(self.dataset.num_train_points / batch_size))
+                train_losses = []
+                train_batches = prefetcher.prefetch(train_tasks(num_train_batches))
+                for i, (indices, feed_dict) in enumerate(train_batches):
 
-                # summary = outputs[2]
-                # model.train_writer.add_summary(summary, i)
+                    outputs = model.run_train_step(feed_dict=feed_dict)
+                    avg_loss = outputs[0]
+                    loss = outputs[1]
 
-                train_losses.append(avg_loss)
-                self.dataset.report_losses(loss, indices)
+                    # summary = outputs[2]
+                    # model.train_writer.add_summary(summary, i)
 
-                print('Average train loss for batch {0}/{1}: {2}'.format(i+1, num_train_batches, avg_loss))
+                    train_losses.append(avg_loss)
+                    self.dataset.report_losses(loss, indices)
 
-            print(LINE)
+                    print('Average train loss for batch {0}/{1}: {2}'.format(i+1, num_train_batches, avg_loss))
 
-            # Validation Batches
-            valid_batches = self.dataset.create_batches(series=Series.VALID,
-                                                        batch_size=batch_size,
-                                                        shuffle=True)
-            num_valid_batches = self.dataset.num_batches(series=Series.TEST, batch_size=batch_size)
-            valid_losses = []
-            for i, batch in enumerate(valid_batches):
+                print(LINE)
 
-                feed_dict = self.create_feed_dict(placeholders=ph_dict,
-                                                  batch=batch,
-                                                  batch_size=batch_size,
-                                                  data_series=Series.VALID,
-                                                  max_degree=self.dataset.max_degree,
-                                                  max_num_nodes=self.dataset.num_nodes,
-                                                  max_out_neighborhood_degrees=self.dataset.max_out_neighborhood_degrees,
-                                                  max_in_neighborhood_degrees=self.dataset.max_in_neighborhood_degrees)
+                # Validation Batches
+                valid_batches = prefetcher.prefetch(valid_tasks())
+                num_valid_batches = self.dataset.num_batches(series=Series.TEST, batch_size=batch_size)
+                valid_losses = []
+                for i, (_, feed_dict) in enumerate(valid_batches):
 
-                outputs = model.inference(feed_dict=feed_dict)
-                avg_loss = outputs['loss']
-                valid_losses.append(avg_loss)
+                    outputs = model.inference(feed_dict=feed_dict)
+                    avg_loss = outputs['loss']
+                    valid_losses.append(avg_loss)
 
-                print('Average valid loss for batch {0}/{1}: {2}'.format(i+1, num_valid_batches, avg_loss))
+                    print('Average valid loss for batch {0}/{1}: {2}'.format(i+1, num_valid_batches, avg_loss))
 
-            print(LINE)
+                print(LINE)
 
-            avg_train_loss = np.average(train_losses)
-            print('Average training loss: {0}'.format(avg_train_loss))
+                avg_train_loss = np.average(train_losses)
+                print('Average training loss: {0}'.format(avg_train_loss))
 
-            avg_valid_loss = np.average(valid_losses)
-            print('Average validation loss: {0}'.format(avg_valid_loss))
+                avg_valid_loss = np.average(valid_losses)
+                print('Average validation loss: {0}'.format(avg_valid_loss))
 
-            log_row = [epoch, avg_train_loss, avg_valid_loss]
-            append_row_to_log(log_row, log_path)
+                log_row = [epoch, avg_train_loss, avg_valid_loss]
+                append_row_to_log(log_row, log_path)
 
-            # Early Stopping Counters
-            if abs(prev_loss - avg_valid_loss) < self.params['early_stop_threshold']:
-                convergence_count += 1
-            else:
-                convergence_count = 0
+                # Early Stopping Counters
+                if abs(prev_loss - avg_valid_loss) < self.params['early_stop_threshold']:
+                    convergence_count += 1
+                else:
+                    convergence_count = 0
 
-            if avg_valid_loss < prev_loss:
-                print('Saving model...')
-                model.save(self.output_folder)
-                prev_loss = avg_valid_loss
+                if avg_valid_loss < prev_loss:
+                    print('Saving model...')
+                    model.save(self.output_folder)
+                    prev_loss = avg_valid_loss
 
-            if convergence_count >= self.params['patience']:
-                print('Early Stopping.')
-                break
+                if convergence_count >= self.params['patience']:
+                    print('Early Stopping.')
+                    break
 
         # Log ending time
         end_time = datetime.now()
@@ -181,11 +197,20 @@ class ModelRunner:
         append_row_to_log(['Delta', str(end_time - start_time)], time_log)
 
     def test(self, model_path=None):
-        self.params['optimizer']['use_optimizer'] = False
+        use_optimizer = self.params['optimizer']['use_optimizer']
 
         # Load Graphs
         graph = self.dataset.graph_data.graph
 
+        # Refinement workers are started before the TensorFlow session is created so that
+        # no session state is forked into them
+        refine_pool = None
+        if use_optimizer:
+            num_workers = max(self.params['optimizer'].get('num_workers', 1), 1)
+            refine_pool = Pool(processes=num_workers,
+                               initializer=init_worker,
+                               initargs=(self.params, self.params['optimizer']['optimizer_name'], graph))
+
         num_neighborhoods = self.params['num_neighborhoods']
 
         # Initialize model
@@ -219,10 +244,10 @@ class ModelRunner:
                                                    batch_size=batch_size,
                                                    shuffle=False)
         # Iniitalize Testing Log
-        log_headers = ['Test Instance', 'Graph', 'Flow Cost', 'Dual Cost', 'Time (sec)']
+        log_headers = ['Test Instance', 'Graph', 'Flow Cost', 'Dual Cost', 'Time (sec)', 'Flow Iters', 'Dual Iters']
 
-        if self.params['optimizer']['use_optimizer']:
-            log_headers += ['Flow with Optimizer', 'Num Iters']
+        if use_optimizer:
+            log_headers += ['Flow with Optimizer', 'Num Iters', 'Optimizer Time (sec)', 'Optimizer Status']
             log_path = model_path + 'costs-{0}.csv'.format(self.params['optimizer']['optimizer_name'])
         else:
             log_path = model_path + 'costs.csv'
@@ -238,69 +263,38 @@ class ModelRunner:
         step = int(1.0 / self.params['plot_fraction'])
         plot_indices = set(range(0, num_test_samples, step))
 
-        for i, batch in enumerate(test_batches):
-
-            feed_dict = self.create_feed_dict(placeholders=ph_dict,
-                                              batch=batch,
-                                              batch_size=batch_size,
-                                              data_series=Series.TEST,
-                                              max_degree=self.dataset.max_degree,
-                                              max_num_nodes=self.dataset.num_nodes,
-                                              max_out_neighborhood_degrees=self.dataset.max_out_neighborhood_degrees,
-                                              max_in_neighborhood_degrees=self.dataset.max_in_neighborhood_degrees,
-                                              name=self.params['name'])
-
-            start = time()
-            outputs = model.inference(feed_dict=feed_dict)
-            elapsed = time() - start
-
-            avg_time = elapsed / batch_size
+        def log_batch(i, batch, outputs, avg_time, refinement):
+            # Blocks until the optimizer has refined every sample in the batch
+            refined = refinement.get() if refinement is not None else None
 
             for j in range(batch_size):
 
                 index = i * batch_size + j
 
-                graph_name = batch[j].graph_name
+                graph_name = batch.graph_name
 
                 flow = outputs['flow'][j]
                 flow_cost = outputs['flow_cost'][j]
                 pred_weights = outputs['normalized_weights'][j]
                 dual_cost = outputs['dual_cost'][j]
+                flow_iters = outputs['flow_iters'][j]
+                dual_iters = outputs['dual_idx'][j]
 
-                demands = np.array(batch[j].demands)
-
-                if self.params['optimizer']['use_optimizer']:
-                    adj_lst = batch[j].adj_lst
-                    initial = np.zeros(shape=(graph.number_of_edges(),))
-                    edge_index = 0
-                    for i in range(flow.shape[0]):
-                        for j in range(flow.shape[1]):
-                            if adj_lst[i, j] != batch[j].num_nodes:
-                                initial[edge_index] = flow[i, j]
-                                edge_index += 1
-
-                    if self.params['optimizer']['optimizer_name'] == 'trust_constr':
-                        optimizer_model = TrustConstr(params=self.params)
-                    elif self.params['optimizer']['optimizer_name'] == 'slsqp':
-                        optimizer_model = SLSQP(params=self.params)
-
-                    optimizer_demands = demands.reshape(-1)
-                    flows_per_iter, result = optimizer_model.optimize(graph=graph, demands=optimizer_demands, initial=initial)
-                    opt_cost, num_iters = result.fun, result.nit
-
-                node_features = {
-                    'demand': demands
-                }
-                edge_features = {
-                    'flow': flow,
-                    'flow_proportion': pred_weights
-                }
-
-                flow_graph = add_features(graph=graph,
-                                          node_features=node_features,
-                                          edge_features=edge_features)
+                demands = batch.demands[j, :batch.num_nodes]
 
                 if self.params['plot_flows'] and index in plot_indices:
+                    node_features = {
+                        'demand': demands
+                    }
+                    edge_features = {
+                        'flow': flow,
+                        'flow_proportion': pred_weights
+                    }
+
+                    flow_graph = add_features(graph=graph,
+                                              node_features=node_features,
+                                              edge_features=edge_features)
+
                     flow_path = '{0}flows-{1}-{2}'.format(model_path, graph_name, index)
                     prop_path = '{0}flow-prop-{1}-{2}'.format(model_path, graph_name, index)
                     attn_weight_path = '{0}attn-weights-{1}-{2}'.format(model_path, graph_name, index)
@@ -310,18 +304,70 @@ class ModelRunner:
 
                     if 'attn_weights' in outputs:
                         attn_weights = outputs['attn_weights'][j]
-                        num_nodes = batch[j].num_nodes
+                        num_nodes = batch.num_nodes
                         plot_weights(weight_matrix=attn_weights,
                                      file_path=attn_weight_path,
                                      num_samples=self.params['plot_weight_samples'],
                                      num_nodes=num_nodes)
 
                 # Log Outputs
-                row = [index, graph_name, flow_cost, dual_cost, avg_time]
-                if self.params['optimizer']['use_optimizer']:
-                    row += [opt_cost, num_iters]
+                row = [index, graph_name, flow_cost, dual_cost, avg_time, flow_iters, dual_iters]
+                if refined is not None:
+                    opt_cost, opt_time, num_iters, status = refined[j]
+                    row += [opt_cost, num_iters, opt_time, status]
                 append_row_to_log(row, log_path)
 
+        # Batch whose refinement is still running, along with its model outputs
+        pending = None
+
+        try:
+            for i, batch in enumerate(test_batches):
+
+                feed_dict = self.create_feed_dict(placeholders=ph_dict,
+                                                  batch=batch,
+                                                  batch_size=batch_size,
+                                                  data_series=Series.TEST,
+                                                  max_degree=self.dataset.max_degree,
+                                                  max_num_nodes=self.dataset.num_nodes,
+                                                  max_out_neighborhood_degrees=self.dataset.max_out_neighborhood_degrees,
+                                                  max_in_neighborhood_degrees=self.dataset.max_in_neighborhood_degrees,
+                                                  name=self.params['name'])
+
+                start = time()
+                outputs = model.inference(feed_dict=feed_dict)
+                elapsed = time() - start
+
+                avg_time = elapsed / batch_size
+
+                refinement = None
+                if use_optimizer:
+                    # Padded flows are gathered into edge vectors which warm start the optimizer
+                    edge_flows = outputs['flow'][:batch_size].reshape(batch_size, -1)[:, batch.graph_data.edge_slots]
+                    demands = batch.demands[:batch_size, :batch.num_nodes, 0]
+                    tasks = list(zip(demands.astype(float), edge_flows.astype(float)))
+                    refinement = refine_pool.map_async(refine_instance, tasks)
+
+                # The previous batch is logged while this batch is refined
+                if pending is not None:
+                    log_batch(*pending)
+                pending = (i, batch, outputs, avg_time, refinement)
+
+            if pending is not None:
+                log_batch(*pending)
+        finally:
+            if refine_pool is not None:
+                refine_pool.terminate()
+                refine_pool.join()
+
+    def batch_indices(self, indices, batch_size):
+        """
+        Prepends the batch index to the given V*D x 2 gather indices. The result is
+        a B*V*D x 3 array used for 3D gathering within tensorflow.
+        """
+        batch_index = np.repeat(np.arange(start=0, stop=batch_size), indices.shape[0]).reshape((-1, 1))
+        tiled_indices = np.tile(indices, reps=(batch_size, 1))
+        return np.concatenate([batch_index, tiled_indices], axis=1)
+
     def create_placeholders(self, model, **kwargs):
         raise NotImplementedError()
 
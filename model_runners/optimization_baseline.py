@@ -2,16 +2,73 @@ import numpy as np
 import pickle
 import gzip
 import networkx as nx
+from multiprocessing import Pool
 from time import time
-from models.optimization_models import TrustConstr, SLSQP
+from models.optimization_models import TrustConstr, SLSQP, InteriorPoint
 from utils.utils import features_to_demands, append_row_to_log
-from utils.constants import PARAMS_FILE, WRITE_THRESHOLD
+from utils.constants import PARAMS_FILE, WRITE_THRESHOLD, CHAIN_FLOWS_FILE
 from core.plot import plot_road_flow_graph
 from core.dataset import DatasetManager, Series
-from os import mkdir, remove
+from os import mkdir, remove, replace
 from os.path import exists
 
 
+WARM_STARTS = ['chain', 'reference', 'none']
+
+OPTIMIZERS = {
+    'trust_constr': TrustConstr,
+    'slsqp': SLSQP,
+    'interior_point': InteriorPoint
+}
+
+# Per-process state of each pool worker. This is set once by init_worker so that the
+# graph and demands are not sent along with every instance.
+_worker_state = {}
+
+
+def create_optimizer(params, optimizer_name):
+    assert optimizer_name in OPTIMIZERS, 'Invalid Optimizer {0}'.format(optimizer_name)
+    return OPTIMIZERS[optimizer_name](params=params)
+
+
+def init_worker(params, optimizer_name, graph, demands=None, initial=None):
+    _worker_state['optimizer'] = create_optimizer(params, optimizer_name)
+    _worker_state['graph'] = graph
+    _worker_state['demands'] = demands
+    _worker_state['initial'] = initial
+
+
+def optimize_instance(index):
+    state = _worker_state
+    demands = state['demands'][index].astype(float)
+
+    start = time()
+    _, result = state['optimizer'].optimize(graph=state['graph'], demands=demands, initial=state['initial'])
+    end = time()
+
+    # Only the interior point method certifies optimality with a duality gap
+    return result.x, solution_cost(result), end - start, result.nit, result.get('gap'), result.status
+
+
+def refine_instance(task):
+    """
+    Optimizes a single (demands, initial flows) pair. This is used to refine the flows
+    predicted by a trained model, so each task carries its own warm start.
+    """
+    demands, initial = task
+
+    start = time()
+    _, result = _worker_state['optimizer'].optimize(graph=_worker_state['graph'], demands=demands, initial=initial)
+    end = time()
+
+    return solution_cost(result), end - start, result.nit, result.status
+
+
+def solution_cost(result):
+    # Failed solves are logged as NaN so that they are not mistaken for optimal costs
+    return result.fun if result.success else np.nan
+
+
 class OptimizationBaseline:
 
     def __init__(self, params, optimizer_name):
@@ -25,11 +82,17 @@ class OptimizationBaseline:
         self.dataset = DatasetManager(params=params)
         self.dataset.load_graphs()
 
-        assert optimizer_name == 'trust_constr' or optimizer_name == 'slsqp', 'Invalid Optimizer {0}'.format(optimizer_name)
-        if optimizer_name == 'trust_constr':
-            self.optimizer = TrustConstr(params=params)
-        elif optimizer_name == 'slsqp':
-            self.optimizer = SLSQP(params=params)
+        self.optimizer_name = optimizer_name
+        self.optimizer = create_optimizer(params, optimizer_name)
+
+        optimizer_params = params.get('optimizer', {})
+        self.num_workers = optimizer_params.get('num_workers', 1)
+        self.warm_start = optimizer_params.get('warm_start', 'chain')
+
+        if self.warm_start not in WARM_STARTS:
+            raise ValueError('Unknown warm start {0}. Expected one of {1}.'.format(self.warm_start, WARM_STARTS))
+        if self.warm_start == 'chain' and self.num_workers > 1:
+            raise ValueError('Chained warm starts are sequential and require a single worker.')
 
     def optimize(self):
         if not exists(self.output_folder):
@@ -38,62 +101,146 @@ class OptimizationBaseline:
         test_graph = self.dataset.graph_data.graph
 
         cost_headers = ['Index', 'Graph', 'Flow Cost', 'Time (sec)', 'Num Iters']
+        if self.optimizer_name == 'interior_point':
+            cost_headers.append('Duality Gap')
+        cost_headers.append('Status')
         costs_path = self.output_folder + 'costs.csv'
 
-        if exists(costs_path):
-            remove(costs_path)
+        # Pick up after the last logged instance if this run was interrupted
+        params_path = PARAMS_FILE.format(self.output_folder)
+        start_index = self._completed_instances(costs_path, params_path)
 
-        append_row_to_log(cost_headers, costs_path)
+        if start_index == 0:
+            if exists(costs_path):
+                remove(costs_path)
+            if exists(self.output_folder + CHAIN_FLOWS_FILE):
+                remove(self.output_folder + CHAIN_FLOWS_FILE)
+            append_row_to_log(cost_headers, costs_path)
+        else:
+            print('Resuming from instance {0}.'.format(start_index))
 
         # Save parameters
-        params_path = PARAMS_FILE.format(self.output_folder)
         with gzip.GzipFile(params_path, 'wb') as out_file:
             pickle.dump(self.params, out_file)
 
         # Load test dataset
         series = Series.TEST
         self.dataset.load(series=series)
-        test_samples = [sample for sample in self.dataset.dataset[series] if sample.graph_name == self.graph_name]
+        num_test_samples = len(self.dataset.dataset[series])
+
+        demands = self.dataset.dataset[series].demands[:, :self.dataset.num_nodes]
 
         step = int(1.0 / self.params['plot_fraction'])
-        plot_indices = set(range(0, len(test_samples), step))
+        plot_indices = set(range(0, num_test_samples, step))
 
+        # Every instance starts from the solution for the mean demand, which is itself
+        # a valid demand vector as flow conservation is linear
         initial = None
-
-        for index, sample in enumerate(test_samples):
-            demands = np.array(sample.demands.todense())
-            demands = np.reshape(demands, newshape=(demands.shape[0],))
-
-            start = time()
-            flows_per_iter, result = self.optimizer.optimize(graph=test_graph, demands=demands, initial=initial)
-            end = time()
-
-            flows = flows_per_iter[-1]
-            flow_mat = self._flow_matrix(test_graph, flows)
-            initial = flows
-
-            append_row_to_log([index, self.graph_name, result.fun, end - start, result.nit], costs_path)
-
-            # Add demands to graph
-            flow_graph = test_graph.copy()
-            for i, node in enumerate(test_graph.nodes()):
-                flow_graph.add_node(node, demand=float(demands[i]))
-
-            for src, dst, key in flow_graph.edges(keys=True, data=False):
-                flow_graph.add_edge(src, dst, key=key, flow=flow_mat[src, dst])
-
-            if self.params['plot_flows'] and index in plot_indices:
-                file_path = '{0}flows-{1}-{2}'.format(self.output_folder, self.graph_name, index)
-                plot_road_flow_graph(flow_graph, graph_name=self.params['graph_title'], field='flow', file_path=file_path)
-
-            if (index + 1) % WRITE_THRESHOLD == 0:
-                print('Completed {0} instances.'.format(index + 1))
-
-    def _flow_matrix(self, graph, flows):
-        num_nodes = graph.number_of_nodes()
-        flow_mat = np.zeros(shape=(num_nodes, num_nodes), dtype=float)
-
-        for i, (src, dest) in enumerate(graph.edges()):
-            flow_mat[src, dest] = flows[i]
-
-        return flow_mat
+        if self.warm_start == 'reference':
+            mean_demands = np.mean(demands, axis=0).astype(float)
+            _, reference = self.optimizer.optimize(graph=test_graph, demands=mean_demands, initial=None)
+            initial = reference.x
+        elif self.warm_start == 'chain' and start_index > 0:
+            initial = self._chain_initial(test_graph, demands, start_index)
+
+        indices = range(start_index, num_test_samples)
+
+        if self.num_workers > 1:
+            pool = Pool(processes=self.num_workers,
+                        initializer=init_worker,
+                        initargs=(self.params, self.optimizer_name, test_graph, demands, initial))
+            results = pool.imap(optimize_instance, indices)
+        else:
+            pool = None
+            init_worker(self.params, self.optimizer_name, test_graph, demands, initial)
+            results = map(optimize_instance, indices)
+
+        try:
+            # Results arrive in index order, so rows are appended as soon as they are ready
+            for index, (flows, flow_cost, elapsed, num_iters, gap, status) in zip(indices, results):
+                row = [index, self.graph_name, flow_cost, elapsed, num_iters]
+                if gap is not None:
+                    row.append(gap)
+                row.append(status)
+                append_row_to_log(row, costs_path)
+
+                # The chain continues from the last successful solve
+                if self.warm_start == 'chain':
+                    if not np.isnan(flow_cost):
+                        _worker_state['initial'] = flows
+                    if _worker_state['initial'] is not None:
+                        self._save_chain_flows(index, _worker_state['initial'])
+
+                if self.params['plot_flows'] and index in plot_indices:
+                    self._plot_flows(test_graph, demands[index], flows, index)
+
+                if (index + 1) % WRITE_THRESHOLD == 0:
+                    print('Completed {0} instances.'.format(index + 1))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _completed_instances(self, costs_path, params_path):
+        """
+        Returns the number of instances logged by a previous run with the same parameters.
+        Partially written rows are removed from the log.
+        """
+        if not exists(costs_path) or not exists(params_path):
+            return 0
+
+        with gzip.GzipFile(params_path, 'rb') as params_file:
+            saved_params = pickle.load(params_file)
+
+        # The number of workers does not affect the results
+        if self._without_workers(saved_params) != self._without_workers(self.params):
+            return 0
+
+        with open(costs_path, 'r') as costs_file:
+            lines = costs_file.readlines()
+
+        # A row without a line terminator was interrupted while being written
+        if len(lines) > 0 and not lines[-1].endswith('\n'):
+            lines = lines[:-1]
+            with open(costs_path, 'w') as costs_file:
+                costs_file.writelines(lines)
+
+        return max(len(lines) - 1, 0)
+
+    def _save_chain_flows(self, index, flows):
+        # Written under a temporary name so that an interrupted write leaves the old flows intact
+        flows_path = self.output_folder + CHAIN_FLOWS_FILE
+        with open(flows_path + '.tmp', 'wb') as flows_file:
+            np.savez(flows_file, index=index, flows=flows)
+        replace(flows_path + '.tmp', flows_path)
+
+    def _chain_initial(self, graph, demands, start_index):
+        """
+        Returns the flows which chained warm starts continue from after the last logged instance.
+        If the saved flows belong to another instance, that instance is solved again.
+        """
+        flows_path = self.output_folder + CHAIN_FLOWS_FILE
+        if exists(flows_path):
+            with np.load(flows_path) as chain_flows:
+                if int(chain_flows['index']) == start_index - 1:
+                    return chain_flows['flows']
+
+        print('Solving instance {0} to continue the warm start chain.'.format(start_index - 1))
+        _, result = self.optimizer.optimize(graph=graph, demands=demands[start_index - 1].astype(float), initial=None)
+        return result.x if result.success else None
+
+    def _without_workers(self, params):
+        params = dict(params)
+        params['optimizer'] = {k: v for k, v in params.get('optimizer', {}).items() if k != 'num_workers'}
+        return params
+
+    def _plot_flows(self, graph, demands, flows, index):
+        # Add demands and flows to a networkx copy of the graph. Flows are indexed by edge id.
+        flow_graph = graph.to_networkx().copy()
+        nx.set_node_attributes(flow_graph, dict(enumerate(demands.astype(float).tolist())), name='demand')
+
+        edge_keys = zip(graph.edge_src.tolist(), graph.indices.tolist(), [0] * graph.num_edges)
+        nx.set_edge_attributes(flow_graph, dict(zip(edge_keys, flows.tolist())), name='flow')
+
+        file_path = '{0}flows-{1}-{2}'.format(self.output_folder, self.graph_name, index)
+        plot_road_flow_graph(flow_graph, graph_name=self.params['graph_title'], field='flow', file_path=file_path)
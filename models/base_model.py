@@ -61,6 +61,19 @@ class Model:
                 return tf.sparse.placeholder(dtype, shape=shape, name=name)
             return tf.placeholder(dtype, shape=shape, name=name)
 
+    def create_constant(self, value, dtype, name, batch_size=None):
+        """
+        Creates a constant tensor from the given array. If a batch size is given, the constant
+        is tiled along a new leading batch dimension.
+        """
+        with self._sess.graph.as_default():
+            const = tf.constant(value, dtype=dtype, name=name)
+            if batch_size is None:
+                return const
+
+            multiples = [batch_size] + [1 for _ in range(len(const.get_shape()))]
+            return tf.tile(tf.expand_dims(const, axis=0), multiples=multiples, name='{0}-tiled'.format(name))
+
     def save(self, output_folder):
         params_path = PARAMS_FILE.format(output_folder)
         with gzip.GzipFile(params_path, 'wb') as out_file:
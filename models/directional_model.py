@@ -149,10 +149,10 @@ class DirectionalModel(Model):
                 else:
                     normalized_weights = tf.nn.softmax(pred_weights, axis=-1)
 
-                flow, pflow = mcf_solver(pred_weights=normalized_weights,
-                                         demand=demands,
-                                         in_indices=in_indices,
-                                         max_iters=self.params['flow_iters'])
+                flow, pflow, flow_iters = mcf_solver(pred_weights=normalized_weights,
+                                                     demand=demands,
+                                                     in_indices=in_indices,
+                                                     max_iters=self.params['flow_iters'])
 
                 cost_tensor = self.cost_fn.apply(flow, edge_lengths) if self.use_edge_lengths else self.cost_fn.apply(flow)
                 flow_cost = tf.reduce_sum(cost_tensor, axis=[1, 2])
@@ -185,14 +185,14 @@ class DirectionalModel(Model):
                 dual_diff = dual_tr - dual
 
                 # B x V x D
-                dual_flows = dual_flow(dual_diff=dual_diff,
-                                       adj_mask=mask,
-                                       cost_fn=self.cost_fn,
-                                       edge_lengths=edge_lengths,
-                                       should_use_edges=self.use_edge_lengths,
-                                       step_size=self.params['dual_step_size'],
-                                       momentum=self.params['dual_momentum'],
-                                       max_iters=self.params['dual_iters'])
+                dual_flows, dual_idx = dual_flow(dual_diff=dual_diff,
+                                                 adj_mask=mask,
+                                                 cost_fn=self.cost_fn,
+                                                 edge_lengths=edge_lengths,
+                                                 should_use_edges=self.use_edge_lengths,
+                                                 step_size=self.params['dual_step_size'],
+                                                 momentum=self.params['dual_momentum'],
+                                                 max_iters=self.params['dual_iters'])
 
                 dual_demand = tf.reduce_sum(dual_vars * demands, axis=[1, 2])
 
@@ -213,5 +213,7 @@ class DirectionalModel(Model):
                 self.output_ops['normalized_weights'] = normalized_weights
                 self.output_ops['dual_cost'] = dual_cost
                 self.output_ops['pred_weights'] = pred_weights
+                self.output_ops['flow_iters'] = flow_iters
+                self.output_ops['dual_idx'] = dual_idx
 
                 self.optimizer_op = self._build_optimizer_op()
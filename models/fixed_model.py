@@ -43,10 +43,11 @@ class FixedModel(Model):
             else:
                 normalized_weights = tf.nn.softmax(masked_proportions, axis=-1)
 
-            flow, pflow = mcf_solver(pred_weights=normalized_weights,
-                                     demand=demands,
-                                     in_indices=in_indices,
-                                     max_iters=self.params['flow_iters'])
+            flow, pflow, flow_iters = mcf_solver(pred_weights=normalized_weights,
+                                                 demand=demands,
+                                                 in_indices=in_indices,
+                                                 max_iters=self.params['flow_iters'],
+                                                 solver=self.params['flow_solver'])
 
             flow_cost = tf.reduce_sum(self.cost_fn.apply(flow), axis=[1, 2])
             self.loss = flow_cost
@@ -57,3 +58,5 @@ class FixedModel(Model):
             self.output_ops['flow_cost'] = flow_cost
             self.output_ops['normalized_weights'] = normalized_weights
             self.output_ops['dual_cost'] = tf.zeros_like(flow_cost)
+            self.output_ops['flow_iters'] = flow_iters
+            self.output_ops['dual_idx'] = tf.zeros_like(flow_iters)
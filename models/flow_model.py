@@ -3,7 +3,7 @@ from models.base_model import Model
 from core.layers import MLP, GRU, SparseMax
 from utils.constants import BIG_NUMBER, SMALL_NUMBER, FLOW_THRESHOLD
 from utils.tf_utils import masked_gather
-from utils.flow_utils import mcf_solver, dual_flow, destination_attn
+from utils.flow_utils import mcf_solver, sparse_mcf_solver, dual_flow, destination_attn
 from cost_functions.cost_functions import get_cost_function
 from models.aggregators import Neighborhood, GAT, GGNN
 
@@ -161,10 +161,22 @@ class FlowModel(Model):
 
                 normalized_weights = tf.debugging.check_numerics(normalized_weights, 'Normalized Weights has Inf or NaN.')
 
-                flow, pflow = mcf_solver(pred_weights=normalized_weights,
-                                         demand=demands,
-                                         in_indices=in_indices,
-                                         max_iters=self.params['flow_iters'])
+                if self.params['inflow_kernel'] == 'sparse':
+                    flow, pflow, flow_iters = sparse_mcf_solver(pred_weights=normalized_weights,
+                                                                demand=demands,
+                                                                edge_slots=kwargs['edge_slots'],
+                                                                edge_src=kwargs['edge_src'],
+                                                                edge_dst=kwargs['edge_dst'],
+                                                                max_iters=self.params['flow_iters'],
+                                                                solver=self.params['flow_solver'])
+                elif self.params['inflow_kernel'] == 'gather':
+                    flow, pflow, flow_iters = mcf_solver(pred_weights=normalized_weights,
+                                                         demand=demands,
+                                                         in_indices=in_indices,
+                                                         max_iters=self.params['flow_iters'],
+                                                         solver=self.params['flow_solver'])
+                else:
+                    raise ValueError('Inflow kernel with name {0} does not exist.'.format(self.params['inflow_kernel']))
 
                 flow = tf.debugging.check_numerics(flow, 'Flow has Inf or NaN.')
 
@@ -187,7 +199,8 @@ class FlowModel(Model):
                     self.output_ops['dual_cost'] = true_costs
                     self.output_ops['pred_weights'] = pred_weights
                     self.output_ops['dual_flow'] = tf.zeros_like(flow)
-                    self.output_ops['dual_idx'] = tf.zeros_like(flow_cost)
+                    self.output_ops['flow_iters'] = flow_iters
+                    self.output_ops['dual_idx'] = tf.zeros_like(flow_iters)
 
                     self.optimizer_op = self._build_optimizer_op()
                     return
@@ -252,6 +265,7 @@ class FlowModel(Model):
                 self.output_ops['dual_cost'] = dual_cost
                 self.output_ops['pred_weights'] = pred_weights
                 self.output_ops['dual_flow'] = dual_flows
+                self.output_ops['flow_iters'] = flow_iters
                 self.output_ops['dual_idx'] = dual_idx
 
                 self.optimizer_op = self._build_optimizer_op()
@@ -1,8 +1,22 @@
 import numpy as np
+import scipy.sparse as sp
 from scipy import optimize
+from scipy.sparse.linalg import factorized
 from cost_functions.np_cost_functions import get_cost_function
+from utils.graph_utils import incidence_matrix
 
 
+# Minimum initial flow used by the barrier methods, which stall when started on the bounds
+INTERIOR_OFFSET = 1e-3
+
+# Parameters of the primal-dual interior point method
+CENTERING = 0.1
+STEP_FRACTION = 0.99
+WARM_START_CENTERING = 1e-3
+WARM_START_FRACTION = 0.5
+ARMIJO_FACTOR = 1e-2
+MAX_BACKTRACKS = 30
+
 class OptimizeBaseline:
 
     def __init__(self, params):
@@ -10,28 +24,43 @@ class OptimizeBaseline:
         self.threshold = min(params['early_stop_threshold'], 1e-7)
         self.cost_fn = get_cost_function(params['cost_fn'])
 
+        # Incidence matrices of the most recently used graph. Every instance shares
+        # the same graph, so the matrices are only built once.
+        self._graph = None
+        self._incidence = None
+        self._dense_incidence = None
+
     def optimize(self, graph, demands, initial):
         raise NotImplementedError()
 
-    # Returns the constraint which enforces that solutions are flow
-    def _constraint(self, graph, demands, as_dict=False):
-        num_nodes = graph.number_of_nodes()
-        num_edges = graph.number_of_edges()
-        A = np.zeros(shape=(num_nodes, num_edges), dtype=float)
-        for i, node in enumerate(graph.nodes()):
-            for j, (src, dest) in enumerate(graph.edges()):
-                if node == src:
-                    A[i, j] = 1.0
-                elif node == dest:
-                    A[i, j] = -1.0
+    def incidence_matrix(self, graph, dense=False):
+        if self._graph is not graph:
+            self._graph = graph
+            self._incidence = incidence_matrix(graph)
+            self._dense_incidence = None
+
+        if not dense:
+            return self._incidence
+
+        if self._dense_incidence is None:
+            self._dense_incidence = self._incidence.toarray()
+        return self._dense_incidence
 
+    # Returns the constraint which enforces that solutions are flow. The rows of the incidence
+    # matrix sum to zero, so the first node is grounded to give the solvers a full rank Jacobian.
+    def _constraint(self, graph, demands, as_dict=False):
         if not as_dict:
-            demands = -1 * demands
+            A = self.incidence_matrix(graph)[1:]
+            demands = -1 * demands[1:]
             return optimize.LinearConstraint(A, lb=demands, ub=demands)
         else:
+            # SLSQP only accepts dense Jacobians
+            A = self.incidence_matrix(graph, dense=True)[1:]
+            demands = demands[1:]
             return {
                 'type': 'eq',
-                'fun': lambda x: A.dot(x) + demands
+                'fun': lambda x: A.dot(x) + demands,
+                'jac': lambda x: A
             }
 
 
@@ -39,11 +68,12 @@ class TrustConstr(OptimizeBaseline):
 
     def optimize(self, graph, demands, initial=None):
         options = {
-            'maxiter': self.max_iters,
-            'factorization_method': 'SVDFactorization'
+            'maxiter': self.max_iters
         }
 
-        initial = initial if initial is not None else np.zeros(shape=(graph.number_of_edges(),), dtype=float)
+        # Cold starts are moved off the bounds. Warm starts are kept as given.
+        if initial is None:
+            initial = np.full(shape=(graph.num_edges,), fill_value=INTERIOR_OFFSET, dtype=float)
         bounds = optimize.Bounds(lb=0, ub=np.inf)
         constraint = self._constraint(graph, demands)
 
@@ -53,14 +83,17 @@ class TrustConstr(OptimizeBaseline):
             flows_per_iter.append(x)
             return False
 
-        hess = optimize.BFGS()
+        # Costs are separable, so the Hessian is diagonal
+        def hess(x):
+            return sp.diags(self.cost_fn.second_derivative(x))
+
         result = optimize.minimize(fun=self.cost_fn,
                                    x0=initial,
                                    callback=callback,
                                    bounds=bounds,
                                    method='trust-constr',
                                    constraints=[constraint],
-                                   jac='2-point',
+                                   jac=self.cost_fn.derivative,
                                    hess=hess,
                                    options=options)
 
@@ -75,7 +108,8 @@ class SLSQP(OptimizeBaseline):
             'ftol': self.threshold
         }
 
-        initial = initial if initial is not None else np.zeros(shape=(graph.number_of_edges(),), dtype=float)
+        # SLSQP's line search can fail when started from zero flow on every edge
+        initial = initial if initial is not None else np.ones(shape=(graph.num_edges,), dtype=float)
         bounds = optimize.Bounds(lb=0, ub=np.inf)
         constraint = self._constraint(graph, demands, as_dict=True)
 
@@ -89,9 +123,128 @@ class SLSQP(OptimizeBaseline):
                                    x0=initial,
                                    bounds=bounds,
                                    method='SLSQP',
-                                   jac='2-point',
+                                   jac=self.cost_fn.derivative,
                                    constraints=[constraint],
                                    callback=callback,
                                    options=options)
 
         return np.array(flows_per_iter), result
+
+
+class InteriorPoint(OptimizeBaseline):
+    """
+    Infeasible-start primal-dual interior point method for separable costs. The Hessian of
+    the cost is diagonal, so eliminating the flow and bound multiplier steps from the
+    Newton-KKT system leaves a V x V weighted graph Laplacian A D A^T. One node is grounded
+    to remove the constant null space, and the remaining sparse system is factorized directly.
+    """
+
+    def optimize(self, graph, demands, initial=None):
+        A = self.incidence_matrix(graph).tocsc()
+        A_T = A.transpose().tocsr()
+
+        # Flow conservation is A x + demands = 0. The first node is grounded because the
+        # rows of A sum to zero.
+        A_grounded = A[1:]
+        A_grounded_T = A_grounded.transpose().tocsc()
+
+        num_edges = A.shape[1]
+        if initial is None:
+            x = np.ones(shape=(num_edges,), dtype=float)
+            z = np.ones(shape=(num_edges,), dtype=float)
+            y = np.zeros(shape=(A.shape[0],), dtype=float)
+        else:
+            x, y, z = self._warm_start(initial, demands, A_grounded, A_grounded_T, A_T)
+
+        def residuals(x, y, z, mu):
+            r_dual = self.cost_fn.derivative(x) - z + A_T.dot(y)
+            r_primal = A.dot(x) + demands
+            r_center = x * z - mu
+            return r_dual, r_primal, r_center
+
+        def residual_norm(r_dual, r_primal, r_center):
+            return np.sqrt(np.sum(np.square(r_dual)) + np.sum(np.square(r_primal)) + np.sum(np.square(r_center)))
+
+        flows_per_iter = []
+        status, message = 1, 'Maximum number of iterations has been exceeded.'
+
+        nit = 0
+        gap = np.dot(x, z)
+        while nit < self.max_iters:
+            gap = np.dot(x, z)
+            mu = CENTERING * gap / num_edges
+            r_dual, r_primal, r_center = residuals(x, y, z, mu)
+
+            primal_error = np.max(np.abs(r_primal))
+            dual_error = np.max(np.abs(r_dual))
+            if primal_error < self.threshold and dual_error < self.threshold and gap < self.threshold:
+                status, message = 0, 'Optimization terminated successfully.'
+                break
+
+            # Nonconvex portions of the cost are handled by the barrier term alone
+            hessian = np.maximum(self.cost_fn.second_derivative(x), 0.0) + z / x
+            D = 1.0 / hessian
+            r = r_dual + r_center / x
+
+            laplacian = A_grounded.dot(sp.diags(D)).dot(A_grounded_T)
+            solve = factorized(laplacian.tocsc())
+
+            dy = np.zeros_like(y)
+            dy[1:] = solve((r_primal - A.dot(D * r))[1:])
+            dx = -D * (r + A_T.dot(dy))
+            dz = -(r_center + z * dx) / x
+
+            # Largest step which keeps flows and multipliers strictly positive
+            alpha = 1.0
+            for v, dv in [(x, dx), (z, dz)]:
+                decreasing = dv < 0
+                if np.any(decreasing):
+                    alpha = min(alpha, STEP_FRACTION * np.min(-v[decreasing] / dv[decreasing]))
+
+            # Backtrack until the KKT residual decreases sufficiently
+            norm = residual_norm(r_dual, r_primal, r_center)
+            for _ in range(MAX_BACKTRACKS):
+                next_norm = residual_norm(*residuals(x + alpha * dx, y + alpha * dy, z + alpha * dz, mu))
+                if next_norm <= (1.0 - ARMIJO_FACTOR * alpha) * norm:
+                    break
+                alpha *= 0.5
+
+            x = x + alpha * dx
+            y = y + alpha * dy
+            z = z + alpha * dz
+            nit += 1
+
+            flows_per_iter.append(x)
+
+        result = optimize.OptimizeResult(x=x,
+                                         fun=self.cost_fn(x),
+                                         nit=nit,
+                                         gap=gap,
+                                         status=status,
+                                         success=status == 0,
+                                         message=message)
+        return np.array(flows_per_iter), result
+
+    def _warm_start(self, initial, demands, A_grounded, A_grounded_T, A_T):
+        """
+        Moves the given flows inside the bounds and towards the flow conservation constraint,
+        as warm starts often come from other demands. The correction is weighted by the flows
+        and keeps at least WARM_START_FRACTION of each flow. The node potentials y are then the
+        flow-weighted least squares fit of the dual residual, so edges which carry flow have
+        small reduced costs. The bound multipliers are the remaining reduced costs, raised so
+        that every x * z is at least a small mu.
+        """
+        x = np.maximum(initial, INTERIOR_OFFSET)
+
+        laplacian = A_grounded.dot(sp.diags(x)).dot(A_grounded_T)
+        correction = A_grounded_T.dot(factorized(laplacian.tocsc())(A_grounded.dot(x) + demands[1:]))
+        x = np.maximum(x - x * correction, WARM_START_FRACTION * x)
+
+        derivative = self.cost_fn.derivative(x)
+        laplacian = A_grounded.dot(sp.diags(x)).dot(A_grounded_T)
+        y = np.zeros(shape=(A_grounded.shape[0] + 1,), dtype=float)
+        y[1:] = factorized(laplacian.tocsc())(-A_grounded.dot(x * derivative))
+
+        mu = WARM_START_CENTERING * np.mean(x)
+        z = np.maximum(derivative + A_T.dot(y), mu / x)
+        return x, y, z
@@ -0,0 +1,88 @@
+import numpy as np
+import argparse
+import os
+from time import time
+from core.load import load_graph
+from core.dataset import GraphData
+from utils.graph_utils import pad_adj_list
+
+GRAPHS_FOLDER = 'graphs'
+
+
+def legacy_edge_indices(adj_lst, inv_adj_lst, max_degree, num_nodes):
+    """
+    Reference implementation which computes the gather indices with nested loops.
+    """
+    dim0 = np.prod(adj_lst.shape)
+
+    in_indices = np.zeros(shape=(dim0, 2))
+    rev_indices = np.zeros(shape=(dim0, 2))
+    opp_indices = np.zeros(shape=(dim0, 2))
+
+    index_a = 0
+    index_b = 0
+    for x in range(adj_lst.shape[0]):
+        for y in inv_adj_lst[x]:
+            indexof = np.where(adj_lst[y] == x)[0]
+
+            if len(indexof) > 0:
+                in_indices[index_a] = [y, indexof[0]]
+            else:
+                in_indices[index_a] = [num_nodes, max_degree - 1]
+
+            index_a += 1
+
+        for y in adj_lst[x]:
+            indexof = np.where(inv_adj_lst[y] == x)[0]
+
+            if len(indexof) > 0:
+                rev_indices[index_b] = [y, indexof[0]]
+            else:
+                rev_indices[index_b] = [num_nodes, max_degree - 1]
+
+            indexof = np.where(adj_lst[y] == x)[0]
+
+            if len(indexof) > 0:
+                opp_indices[index_b] = [y, indexof[0]]
+            else:
+                opp_indices[index_b] = [num_nodes, max_degree - 1]
+
+            index_b += 1
+
+    return in_indices, rev_indices, opp_indices
+
+
+parser = argparse.ArgumentParser(description='Checks and times the edge index builder on the bundled graphs.')
+parser.add_argument('--graphs', nargs='+', help='Names of graphs to use. Defaults to every graph.')
+parser.add_argument('--trials', type=int, default=5, help='Number of timing trials.')
+args = parser.parse_args()
+
+graph_names = args.graphs if args.graphs is not None else sorted(os.listdir(GRAPHS_FOLDER))
+
+print('Graph,Nodes,Max Degree,Legacy (sec),Vectorized (sec),Speedup')
+for graph_name in graph_names:
+    graph = load_graph(graph_name=graph_name)
+    graph_data = GraphData(graph=graph, graph_name=graph_name, k=1, unique_neighborhoods=True)
+
+    num_nodes = graph.num_nodes
+    max_degree = int(max(np.max(graph.out_degrees()), np.max(graph.in_degrees())))
+
+    adj_lst = pad_adj_list(graph_data.adj_lst, max_degree, num_nodes, num_nodes)
+    inv_adj_lst = pad_adj_list(graph_data.inv_adj_lst, max_degree, num_nodes, num_nodes)
+
+    start = time()
+    for _ in range(args.trials):
+        expected = legacy_edge_indices(adj_lst, inv_adj_lst, max_degree, num_nodes)
+    legacy_time = (time() - start) / args.trials
+
+    start = time()
+    for _ in range(args.trials):
+        graph_data.set_edge_indices(adj_lst, inv_adj_lst, max_degree, num_nodes)
+    vectorized_time = (time() - start) / args.trials
+
+    actual = (graph_data.in_indices, graph_data.rev_indices, graph_data.opp_indices)
+    for name, exp, act in zip(['in', 'rev', 'opp'], expected, actual):
+        assert np.array_equal(exp, act), 'Mismatch in {0} indices for {1}.'.format(name, graph_name)
+
+    print('{0},{1},{2},{3:.6f},{4:.6f},{5:.1f}'.format(graph_name, num_nodes, max_degree, legacy_time,
+                                                       vectorized_time, legacy_time / vectorized_time))
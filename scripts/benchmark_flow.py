@@ -0,0 +1,112 @@
+import numpy as np
+import tensorflow as tf
+import argparse
+import itertools
+import os
+from time import time
+from scipy.special import softmax
+from core.load import load_graph
+from core.dataset import GraphData
+from utils.constants import BIG_NUMBER
+from utils.graph_utils import pad_adj_list
+from utils.flow_utils import mcf_solver, sparse_mcf_solver
+
+GRAPHS_FOLDER = 'graphs'
+
+
+def batch_indices(indices, batch_size):
+    batch_index = np.repeat(np.arange(start=0, stop=batch_size), indices.shape[0]).reshape((-1, 1))
+    tiled_indices = np.tile(indices, reps=(batch_size, 1))
+    return np.concatenate([batch_index, tiled_indices], axis=1)
+
+
+def random_inputs(adj_lst, num_nodes, batch_size, num_sources, num_sinks):
+    """
+    Creates normalized flow proportions over the real edges of each node along with
+    balanced demands for randomly chosen sources and sinks.
+    """
+    mask = (adj_lst == num_nodes).astype(float)
+    logits = np.random.normal(size=(batch_size,) + adj_lst.shape) - BIG_NUMBER * mask
+    weights = softmax(logits, axis=-1)
+
+    demands = np.zeros(shape=(batch_size, num_nodes + 1, 1))
+    for i in range(batch_size):
+        nodes = np.random.choice(num_nodes, size=num_sources + num_sinks, replace=False)
+        demands[i, nodes[:num_sources], 0] = -softmax(np.random.normal(size=num_sources))
+        demands[i, nodes[num_sources:], 0] = softmax(np.random.normal(size=num_sinks))
+
+    return weights, demands
+
+
+KERNELS = ['gather', 'sparse']
+SOLVERS = ['picard', 'anderson']
+
+parser = argparse.ArgumentParser(description='Compares inflow kernels and flow solvers on the bundled graphs.')
+parser.add_argument('--graphs', nargs='+', help='Names of graphs to use. Defaults to every graph.')
+parser.add_argument('--batch-size', type=int, default=100, help='Number of samples per batch.')
+parser.add_argument('--iters', type=int, default=1000, help='Maximum number of flow iterations.')
+parser.add_argument('--trials', type=int, default=5, help='Number of timing trials.')
+args = parser.parse_args()
+
+graph_names = args.graphs if args.graphs is not None else sorted(os.listdir(GRAPHS_FOLDER))
+
+print('Graph,Nodes,Edges,Max Degree,Kernel,Solver,Time (sec),Avg Iters,Max Iters,Max Abs Diff')
+for graph_name in graph_names:
+    graph = load_graph(graph_name=graph_name)
+    graph_data = GraphData(graph=graph, graph_name=graph_name, k=1, unique_neighborhoods=True)
+
+    num_nodes = graph.num_nodes
+    max_degree = int(max(np.max(graph.out_degrees()), np.max(graph.in_degrees())))
+
+    adj_lst = pad_adj_list(graph_data.adj_lst, max_degree, num_nodes, num_nodes)
+    inv_adj_lst = pad_adj_list(graph_data.inv_adj_lst, max_degree, num_nodes, num_nodes)
+    graph_data.set_edge_indices(adj_lst, inv_adj_lst, max_degree, num_nodes)
+
+    weights, demands = random_inputs(adj_lst, num_nodes, args.batch_size, num_sources=4, num_sinks=4)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        weights_ph = tf.placeholder(dtype=tf.float32, shape=weights.shape)
+        demands_ph = tf.placeholder(dtype=tf.float32, shape=demands.shape)
+
+        in_indices = tf.constant(batch_indices(graph_data.in_indices, args.batch_size), dtype=tf.int32)
+        edge_slots = tf.constant(graph_data.edge_slots, dtype=tf.int32)
+        edge_src = tf.constant(graph_data.edge_src, dtype=tf.int32)
+        edge_dst = tf.constant(graph_data.edge_dst, dtype=tf.int32)
+
+        outputs = {}
+        for kernel, solver in itertools.product(KERNELS, SOLVERS):
+            if kernel == 'sparse':
+                flow, _, iters = sparse_mcf_solver(pred_weights=weights_ph,
+                                                   demand=demands_ph,
+                                                   edge_slots=edge_slots,
+                                                   edge_src=edge_src,
+                                                   edge_dst=edge_dst,
+                                                   max_iters=args.iters,
+                                                   solver=solver)
+            else:
+                flow, _, iters = mcf_solver(pred_weights=weights_ph,
+                                            demand=demands_ph,
+                                            in_indices=in_indices,
+                                            max_iters=args.iters,
+                                            solver=solver)
+            outputs[(kernel, solver)] = (flow, iters)
+
+        feed_dict = {weights_ph: weights, demands_ph: demands}
+
+        # All configurations are compared against the original gather kernel with plain iteration
+        expected, _ = sess.run(outputs[(KERNELS[0], SOLVERS[0])], feed_dict=feed_dict)
+
+        for (kernel, solver), ops in outputs.items():
+            # Warm up before timing
+            actual, iters = sess.run(ops, feed_dict=feed_dict)
+
+            start = time()
+            for _ in range(args.trials):
+                sess.run(ops, feed_dict=feed_dict)
+            elapsed = (time() - start) / args.trials
+
+            max_diff = np.max(np.abs(expected - actual))
+            print('{0},{1},{2},{3},{4},{5},{6:.6f},{7:.1f},{8},{9:.3e}'.format(graph_name, num_nodes,
+                                                                             len(graph_data.edge_slots), max_degree,
+                                                                             kernel, solver, elapsed, np.mean(iters),
+                                                                             np.max(iters), max_diff))
@@ -0,0 +1,32 @@
+import argparse
+import os
+from time import time
+from core.load import load_graph
+from utils.graph_utils import random_walk_neighborhoods
+
+GRAPHS_FOLDER = 'graphs'
+
+
+parser = argparse.ArgumentParser(description='Times unique neighborhood computations on the bundled graphs.')
+parser.add_argument('--graphs', nargs='+', help='Names of graphs to use. Defaults to every graph.')
+parser.add_argument('--ks', nargs='+', type=int, default=[2, 3, 4, 5, 6], help='Numbers of neighborhood levels.')
+parser.add_argument('--trials', type=int, default=5, help='Number of timing trials.')
+args = parser.parse_args()
+
+graph_names = args.graphs if args.graphs is not None else sorted(os.listdir(GRAPHS_FOLDER))
+
+print('Graph,Nodes,Direction,K,Entries,Time (sec)')
+for graph_name in graph_names:
+    graph = load_graph(graph_name=graph_name)
+    adj_mat = graph.adjacency_matrix()
+
+    # GraphData computes both outgoing and incoming neighborhoods
+    for direction, mat in [('out', adj_mat), ('in', adj_mat.transpose(copy=True))]:
+        for k in args.ks:
+            start = time()
+            for _ in range(args.trials):
+                neighborhoods = random_walk_neighborhoods(mat, k, unique_neighborhoods=True)
+            elapsed = (time() - start) / args.trials
+
+            num_entries = sum(level.nnz for level in neighborhoods)
+            print('{0},{1},{2},{3},{4},{5:.6f}'.format(graph_name, graph.num_nodes, direction, k, num_entries, elapsed))
@@ -0,0 +1,142 @@
+import argparse
+import multiprocessing
+import resource
+import sys
+import os
+from time import time
+from core.synthetic import save_synthetic_graph, GENERATORS
+from core.load import graph_cache_path
+from core.dataset import DatasetManager
+from utils.utils import load_params, delete_if_exists
+from model_runners.flow_model_runner import FlowModelRunner
+from main import generate
+
+GRAPHS_FOLDER = 'graphs'
+STAGES = ['preprocess', 'epoch', 'inference']
+
+
+def peak_memory():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_stage(connection, stage, params, model_path):
+    """
+    Runs a single stage in a fresh process so that the peak memory only covers this stage.
+    Sends the elapsed time, the peak memory and the stage output through the connection.
+    """
+    # Only the results of the parent process are printed
+    sys.stdout = open(os.devnull, 'w')
+
+    if stage == 'preprocess':
+        # Preprocessing is skipped when graph data is cached
+        delete_if_exists(graph_cache_path(graph_name=params['graph_name'],
+                                          num_neighborhoods=params['num_neighborhoods'],
+                                          unique_neighborhoods=params['unique_neighborhoods']))
+        start = time()
+        dataset = DatasetManager(params=params)
+        dataset.load_graphs()
+        output = (dataset.num_nodes, len(dataset.graph_data.edge_slots), dataset.max_degree)
+    elif stage == 'epoch':
+        runner = FlowModelRunner(params=params)
+        start = time()
+        runner.train()
+        output = runner.output_folder
+    else:
+        runner = FlowModelRunner(params=params)
+        start = time()
+        runner.test(model_path=model_path)
+        output = None
+
+    connection.send((time() - start, peak_memory(), output))
+    connection.close()
+
+
+def run_in_process(stage, params, model_path=None):
+    """
+    Returns the results of the stage, or None if the process failed (e.g. it ran out of memory).
+    """
+    context = multiprocessing.get_context('spawn')
+    parent_connection, child_connection = context.Pipe(duplex=False)
+
+    process = context.Process(target=run_stage, args=(child_connection, stage, params, model_path))
+    process.start()
+    child_connection.close()
+
+    try:
+        result = parent_connection.recv()
+    except EOFError:
+        result = None
+
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures preprocessing, training and inference on synthetic graphs of increasing size.')
+    parser.add_argument('--params', type=str, default='params.json', help='Parameters JSON file with the model to benchmark.')
+    parser.add_argument('--generators', nargs='+', default=sorted(GENERATORS.keys()), help='Synthetic graph generators.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 3000, 10000, 30000, 100000], help='Number of nodes.')
+    parser.add_argument('--train-samples', type=int, default=1000, help='Number of training samples.')
+    parser.add_argument('--test-samples', type=int, default=200, help='Number of validation and test samples.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for graphs and demands.')
+    args = parser.parse_args()
+
+    model_params = load_params(args.params)['model']
+
+    print('Generator,Requested Nodes,Nodes,Edges,Max Degree,Padded Entries,Stage,Time (sec),Peak Memory (MB)')
+    for generator in args.generators:
+        for size in args.sizes:
+            graph_name = 'synthetic-{0}-{1}'.format(generator, size)
+            if not os.path.exists(os.path.join(GRAPHS_FOLDER, graph_name)):
+                save_synthetic_graph(graph_name=graph_name, generator=generator, num_nodes=size, seed=args.seed)
+
+            generate_params = {
+                'train_samples': args.train_samples,
+                'valid_samples': args.test_samples,
+                'test_samples': args.test_samples,
+                'graph_name': graph_name,
+                'osm_query': None,
+                'is_address': True,
+                'dataset_name': graph_name,
+                'num_sources': 4,
+                'num_sinks': 4,
+                'source_sink_strategy': 'random',
+                'seed': args.seed
+            }
+            generate(generate_params)
+
+            params = dict(model_params)
+            params.update({
+                'graph_name': graph_name,
+                'graph_title': graph_name,
+                'dataset_name': graph_name,
+                'epochs': 1,
+                'use_true_cost': False,
+                'plot_flows': False,
+                'optimizer': dict(model_params.get('optimizer', {}), use_optimizer=False),
+                'seed': args.seed
+            })
+
+            # Graph sizes are reported by the preprocessing stage
+            num_nodes, num_edges, max_degree, padded_entries = '', '', '', ''
+            model_path = None
+            for stage in STAGES:
+                result = None
+                if stage != 'inference' or model_path is not None:
+                    result = run_in_process(stage, params, model_path)
+
+                if result is None:
+                    print('{0},{1},{2},{3},{4},{5},{6},failed,failed'.format(generator, size, num_nodes, num_edges,
+                                                                          max_degree, padded_entries, stage))
+                    continue
+
+                elapsed, memory, output = result
+                if stage == 'preprocess':
+                    num_nodes, num_edges, max_degree = output
+                    padded_entries = (num_nodes + 1) * max_degree
+                elif stage == 'epoch':
+                    model_path = output
+
+                print('{0},{1},{2},{3},{4},{5},{6},{7:.3f},{8:.1f}'.format(generator, size, num_nodes, num_edges, max_degree,
+                                                                         padded_entries, stage, elapsed, memory))
@@ -0,0 +1,104 @@
+import numpy as np
+import networkx as nx
+import argparse
+import os
+from time import time
+from core.load import load_graph
+from utils.constants import BIG_NUMBER
+from utils.graph_utils import farthest_nodes, farthest_sink_nodes
+
+GRAPHS_FOLDER = 'graphs'
+
+
+def legacy_farthest_nodes(graph, num_sources, num_sinks):
+    """
+    Reference implementation which computes pairwise distances with networkx.
+    """
+    n_nodes = graph.number_of_nodes()
+    start = np.random.randint(low=0, high=n_nodes)
+    nodes = [start]
+
+    lengths = {}
+    threshold = min(n_nodes, num_sources + num_sinks)
+    while len(nodes) < threshold:
+
+        max_node = None
+        max_len = -BIG_NUMBER
+        for u in graph.nodes():
+
+            min_len = BIG_NUMBER
+            for v in nodes:
+                if (u, v) in lengths:
+                    length = lengths[(u, v)]
+                elif (v, u) in lengths:
+                    length = lengths[(v, u)]
+                else:
+                    forward_path_length = nx.shortest_path_length(graph, source=u, target=v)
+                    backward_path_length = nx.shortest_path_length(graph, source=v, target=u)
+                    path_length = min(forward_path_length, backward_path_length)
+
+                    lengths[(u, v)] = path_length
+                    length = path_length
+                min_len = min(min_len, length)
+
+            if min_len > max_len:
+                max_len = min_len
+                max_node = u
+
+        nodes.append(max_node)
+
+    return nodes[:num_sources], nodes[num_sources:]
+
+
+def legacy_farthest_sink_nodes(graph, num_sources, num_sinks):
+    """
+    Reference implementation which runs one networkx search per (node, source) pair.
+    """
+    sources = np.random.choice(a=list(graph.nodes()), replace=False, size=num_sources)
+
+    node_distances = []
+    for u in sorted(graph.nodes()):
+        distances = [nx.shortest_path_length(graph, source=u, target=v) for v in sources]
+        node_distances.append(distances)
+
+    min_distances = np.amin(a=node_distances, axis=-1)
+    sinks = np.argsort(-min_distances)[:num_sinks]
+
+    return sources, sinks
+
+
+STRATEGIES = {
+    'farthest': (legacy_farthest_nodes, farthest_nodes),
+    'farthest_sink': (legacy_farthest_sink_nodes, farthest_sink_nodes)
+}
+
+parser = argparse.ArgumentParser(description='Checks and times the source/sink selection strategies on the bundled graphs.')
+parser.add_argument('--graphs', nargs='+', help='Names of graphs to use. Defaults to every graph.')
+parser.add_argument('--num-sources', type=int, default=4, help='Number of sources.')
+parser.add_argument('--num-sinks', type=int, default=4, help='Number of sinks.')
+parser.add_argument('--seed', type=int, default=0, help='Random seed shared by both implementations.')
+args = parser.parse_args()
+
+graph_names = args.graphs if args.graphs is not None else sorted(os.listdir(GRAPHS_FOLDER))
+
+print('Graph,Nodes,Strategy,Legacy (sec),Vectorized (sec),Speedup')
+for graph_name in graph_names:
+    graph = load_graph(graph_name=graph_name)
+    nx_graph = graph.to_networkx()
+
+    for strategy, (legacy_fn, fn) in STRATEGIES.items():
+        np.random.seed(args.seed)
+        start = time()
+        expected = legacy_fn(nx_graph, num_sources=args.num_sources, num_sinks=args.num_sinks)
+        legacy_time = time() - start
+
+        np.random.seed(args.seed)
+        start = time()
+        actual = fn(graph, num_sources=args.num_sources, num_sinks=args.num_sinks)
+        vectorized_time = time() - start
+
+        for exp, act in zip(expected, actual):
+            assert np.array_equal(exp, act), 'Mismatch for {0} on {1}.'.format(strategy, graph_name)
+
+        print('{0},{1},{2},{3:.6f},{4:.6f},{5:.1f}'.format(graph_name, graph.num_nodes, strategy, legacy_time,
+                                                           vectorized_time, legacy_time / vectorized_time))
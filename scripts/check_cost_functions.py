@@ -0,0 +1,39 @@
+import numpy as np
+import tensorflow as tf
+import cost_functions.cost_functions as tf_cost_functions
+import cost_functions.np_cost_functions as np_cost_functions
+
+# Cost functions and options which are checked
+COST_FUNCTIONS = [
+    ('linear', {'a': 2.0, 'b': 1.0}),
+    ('quadratic', {'a': 1.0, 'b': 0.5, 'c': 0.0}),
+    ('cubic', {'a': 1.0, 'b': 0.5, 'c': 0.25, 'd': 0.0}),
+    ('quartic', {'a': 1.0, 'b': 0.5, 'c': 0.25, 'd': 0.1, 'e': 0.0}),
+    ('exp', {'a': 1.0}),
+    ('log', {'a': 1.0, 'b': 2.0, 'c': 0.0}),
+    ('linear_sin', {'a': 1.0, 'b': 0.5, 'c': 2.0})
+]
+
+STEP = 1e-6
+
+x = np.random.uniform(low=0.0, high=2.0, size=(1000,))
+
+print('Cost Function,Max TF Diff,Max Gradient Error,Max Hessian Error')
+for name, options in COST_FUNCTIONS:
+    cost_fn = {'name': name, 'options': options, 'use_edges': False}
+    np_fn = np_cost_functions.get_cost_function(cost_fn)
+    tf_fn = tf_cost_functions.get_cost_function(cost_fn)
+
+    with tf.Graph().as_default(), tf.Session() as sess:
+        # Some derivatives are constants, so they are broadcast to the shape of the input
+        tf_x = tf.constant(x, dtype=tf.float64)
+        tf_derivative = sess.run(tf.ones_like(tf_x) * tf_fn.derivative(tf_x))
+
+    # Costs are separable, so central differences of each term give the full gradient
+    numerical_gradient = np.array([np_fn(x_i + STEP) - np_fn(x_i - STEP) for x_i in x]) / (2 * STEP)
+    numerical_hessian = (np_fn.derivative(x + STEP) - np_fn.derivative(x - STEP)) / (2 * STEP)
+
+    tf_diff = np.max(np.abs(np_fn.derivative(x) - tf_derivative))
+    gradient_error = np.max(np.abs(np_fn.derivative(x) - numerical_gradient))
+    hessian_error = np.max(np.abs(np_fn.second_derivative(x) - numerical_hessian))
+    print('{0},{1:.3e},{2:.3e},{3:.3e}'.format(name, tf_diff, gradient_error, hessian_error))
@@ -0,0 +1,55 @@
+import numpy as np
+import argparse
+from core.load import load_graph
+from models.optimization_models import SLSQP, TrustConstr, InteriorPoint
+
+COST_FUNCTIONS = [
+    ('quadratic', {'a': 1.0, 'b': 0.5, 'c': 0.0}),
+    ('cubic', {'a': 1.0, 'b': 0.5, 'c': 0.0, 'd': 0.0}),
+    ('exp', {'a': 1.0})
+]
+
+# Largest accepted relative differences to the interior point cost. trust-constr stops on
+# its scaled optimality measure, which leaves a small gap in the cost.
+SLSQP_TOLERANCE = 1e-6
+TRUST_CONSTR_TOLERANCE = 5e-3
+
+
+def random_demands(num_nodes, num_sources, num_sinks, rng):
+    nodes = rng.choice(num_nodes, size=num_sources + num_sinks, replace=False)
+    demands = np.zeros(shape=(num_nodes,), dtype=float)
+    demands[nodes[:num_sources]] = -1.0 / num_sources
+    demands[nodes[num_sources:]] = 1.0 / num_sinks
+    return demands
+
+
+parser = argparse.ArgumentParser(description='Checks that SLSQP and trust-constr reach the interior point optimum.')
+parser.add_argument('--graph', type=str, default='sf-market-500', help='Name of the graph to use.')
+parser.add_argument('--trials', type=int, default=10, help='Number of demands per cost function.')
+parser.add_argument('--seed', type=int, default=0, help='Random seed for demands.')
+args = parser.parse_args()
+
+graph = load_graph(graph_name=args.graph)
+rng = np.random.RandomState(args.seed)
+
+print('Cost Function,Trial,Interior Point Cost,SLSQP Gap,Trust-Constr Gap')
+for name, options in COST_FUNCTIONS:
+    params = {
+        'flow_iters': 1000,
+        'early_stop_threshold': 1e-5,
+        'cost_fn': {'name': name, 'options': options, 'use_edges': False}
+    }
+    optimizers = [InteriorPoint(params=params), SLSQP(params=params), TrustConstr(params=params)]
+
+    for trial in range(args.trials):
+        demands = random_demands(graph.num_nodes, num_sources=4, num_sinks=4, rng=rng)
+        results = [optimizer.optimize(graph=graph, demands=demands, initial=None)[1] for optimizer in optimizers]
+
+        assert all(result.success for result in results), 'No convergence for {0}.'.format(name)
+
+        reference = results[0].fun
+        gaps = [(result.fun - reference) / reference for result in results[1:]]
+        assert abs(gaps[0]) < SLSQP_TOLERANCE, 'SLSQP differs from the optimum for {0}.'.format(name)
+        assert abs(gaps[1]) < TRUST_CONSTR_TOLERANCE, 'trust-constr differs from the optimum for {0}.'.format(name)
+
+        print('{0},{1},{2:.8f},{3:.3e},{4:.3e}'.format(name, trial, reference, gaps[0], gaps[1]))
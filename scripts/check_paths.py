@@ -0,0 +1,28 @@
+import numpy as np
+import os
+import tempfile
+from core.load import write_paths, read_paths
+
+# Path dictionaries which are written and read back
+CASES = [
+    ('empty', {}),
+    ('single-edge', {(0, 1): [np.array([5])]}),
+    ('no-paths', {(2, 3): []}),
+    ('mixed', {(0, 1): [np.array([5]), np.array([2, 7, 9])], (2, 3): [], (4, 1): [np.array([0, 3])]})
+]
+
+print('Case,Pairs,Paths,Round Trip')
+with tempfile.TemporaryDirectory() as folder:
+    for name, paths in CASES:
+        file_path = os.path.join(folder, '{0}.npz'.format(name))
+        write_paths(paths=paths, file_path=file_path)
+        result = read_paths(file_path=file_path)
+
+        assert list(result.keys()) == list(paths.keys()), 'Pairs differ for {0}.'.format(name)
+        for pair, path_list in paths.items():
+            assert len(result[pair]) == len(path_list), 'Number of paths differs for {0} in {1}.'.format(pair, name)
+            for expected, actual in zip(path_list, result[pair]):
+                assert np.array_equal(expected, actual), 'Path differs for {0} in {1}.'.format(pair, name)
+
+        num_paths = sum(len(path_list) for path_list in result.values())
+        print('{0},{1},{2},ok'.format(name, len(result), num_paths))
@@ -0,0 +1,57 @@
+import numpy as np
+import argparse
+import os
+from core.load import load_graph
+from models.optimization_models import InteriorPoint
+
+GRAPHS_FOLDER = 'graphs'
+
+COST_FUNCTIONS = [
+    ('quadratic', {'a': 1.0, 'b': 0.5, 'c': 0.0}),
+    ('cubic', {'a': 1.0, 'b': 0.5, 'c': 0.0, 'd': 0.0}),
+    ('exp', {'a': 1.0})
+]
+
+
+def random_demands(num_nodes, num_sources, num_sinks, rng):
+    nodes = rng.choice(num_nodes, size=num_sources + num_sinks, replace=False)
+    demands = np.zeros(shape=(num_nodes,), dtype=float)
+    demands[nodes[:num_sources]] = -1.0 / num_sources
+    demands[nodes[num_sources:]] = 1.0 / num_sinks
+    return demands
+
+
+parser = argparse.ArgumentParser(description='Checks that the interior point method converges faster from warm starts.')
+parser.add_argument('--graphs', nargs='+', help='Names of graphs to use. Defaults to every graph.')
+parser.add_argument('--trials', type=int, default=5, help='Number of demands per graph and cost function.')
+parser.add_argument('--seed', type=int, default=0, help='Random seed for demands.')
+args = parser.parse_args()
+
+graph_names = args.graphs if args.graphs is not None else sorted(os.listdir(GRAPHS_FOLDER))
+rng = np.random.RandomState(args.seed)
+
+print('Graph,Cost Function,Trial,Cold Iters,Optimum Iters,Perturbed Iters,Max Cost Diff')
+for graph_name in graph_names:
+    graph = load_graph(graph_name=graph_name)
+
+    for name, options in COST_FUNCTIONS:
+        params = {
+            'flow_iters': 500,
+            'early_stop_threshold': 1e-5,
+            'cost_fn': {'name': name, 'options': options, 'use_edges': False}
+        }
+        optimizer = InteriorPoint(params=params)
+
+        for trial in range(args.trials):
+            demands = random_demands(graph.num_nodes, num_sources=4, num_sinks=4, rng=rng)
+
+            _, cold = optimizer.optimize(graph=graph, demands=demands, initial=None)
+            _, optimum = optimizer.optimize(graph=graph, demands=demands, initial=cold.x)
+            _, perturbed = optimizer.optimize(graph=graph, demands=demands, initial=0.9 * cold.x)
+
+            assert cold.success and optimum.success and perturbed.success, 'No convergence on {0}.'.format(graph_name)
+            assert optimum.nit < cold.nit, 'Warm start from the optimum is not faster on {0}.'.format(graph_name)
+
+            cost_diff = max(abs(optimum.fun - cold.fun), abs(perturbed.fun - cold.fun))
+            print('{0},{1},{2},{3},{4},{5},{6:.3e}'.format(graph_name, name, trial, cold.nit, optimum.nit,
+                                                           perturbed.nit, cost_diff))
@@ -0,0 +1,50 @@
+import numpy as np
+import argparse
+import math
+import os
+from core.load import read, create_demand_files, write_demands, finalize_demand_files, has_demand_files
+from utils.utils import deserialize_dict
+from utils.constants import WRITE_THRESHOLD
+
+DATASETS_FOLDER = 'datasets'
+SERIES = ['train', 'valid', 'test']
+
+
+def convert_series(series_folder, num_samples, sources, sinks):
+    create_demand_files(folder=series_folder, num_samples=num_samples, sources=sources, sinks=sinks)
+
+    num_files = int(math.ceil(num_samples / WRITE_THRESHOLD))
+    for file_index in range(num_files):
+        source_demands, sink_demands = read(folder=series_folder, file_index=file_index)
+        write_demands(folder=series_folder,
+                      source_demands=source_demands,
+                      sink_demands=sink_demands,
+                      offset=file_index * WRITE_THRESHOLD)
+
+    finalize_demand_files(folder=series_folder)
+
+
+parser = argparse.ArgumentParser(description='Converts pickled demand shards into the columnar dataset format.')
+parser.add_argument('--datasets', nargs='+', help='Names of datasets to convert. Defaults to every dataset.')
+parser.add_argument('--overwrite', action='store_true', help='Convert series which are already converted.')
+args = parser.parse_args()
+
+dataset_names = args.datasets if args.datasets is not None else sorted(os.listdir(DATASETS_FOLDER))
+
+for dataset_name in dataset_names:
+    dataset_folder = os.path.join(DATASETS_FOLDER, dataset_name)
+    params = deserialize_dict(os.path.join(dataset_folder, 'params.pkl.gz'))
+    source_sink_dict = deserialize_dict(os.path.join(dataset_folder, 'sources_sinks.pkl.gz'))
+
+    for series in SERIES:
+        series_folder = os.path.join(dataset_folder, series)
+        if has_demand_files(series_folder) and not args.overwrite:
+            print('Skipping {0}/{1}: already converted.'.format(dataset_name, series))
+            continue
+
+        num_samples = params['{0}_samples'.format(series)]
+        convert_series(series_folder=series_folder,
+                       num_samples=num_samples,
+                       sources=source_sink_dict['sources'],
+                       sinks=source_sink_dict['sinks'])
+        print('Converted {0} samples for {1}/{2}.'.format(num_samples, dataset_name, series))
@@ -4,12 +4,34 @@ SMALL_NUMBER = 1e-9
 FLOW_THRESHOLD = 1e-5
 WRITE_THRESHOLD = 1000
 
+DEMANDS_THRESHOLD = 0.1
+MAX_DEMAND_RETRIES = 1000
+
 EXP_MIN = -20
 EXP_MAX = 5
 COST_MAX = 1000
 FLOW_MAX = 10000
 
+ANDERSON_HISTORY = 5
+ANDERSON_REG = 1e-4
+
 PARAMS_FILE = '{0}params.pkl.gz'
+GRAPH_SNAPSHOT_FILE = 'graph.npz'
+GRAPH_CACHE_FILE = 'graph-data-k{0}-{1}-v{2}.npz'
+GRAPH_CACHE_VERSION = 2
+
+DEMANDS_HEADER = 'header.json'
+SOURCE_DEMANDS_FILE = 'source-demands.npy'
+SINK_DEMANDS_FILE = 'sink-demands.npy'
+DEMANDS_DTYPE = 'float32'
+GENERATION_MANIFEST = 'manifest.json'
+PATHS_FILE = 'paths.npz'
 MODEL_FILE = '{0}model.ckpt'
 
+CHAIN_FLOWS_FILE = 'chain-flows.npz'
+
+LABEL_COSTS_FILE = 'costs-{0}.csv'
+LABEL_FLOWS_FILE = 'flows-{0}.npy'
+LABEL_MANIFEST = 'label-manifest.json'
+
 LINE = '-' * 50
@@ -1,18 +1,21 @@
 import tensorflow as tf
 from utils.constants import BIG_NUMBER, FLOW_THRESHOLD, SMALL_NUMBER, FLOW_MAX
+from utils.constants import ANDERSON_HISTORY, ANDERSON_REG
 from utils.tf_utils import masked_gather
 
 
-def mcf_solver(pred_weights, demand, in_indices, max_iters, name='mcf-solver'):
+def mcf_solver(pred_weights, demand, in_indices, max_iters, solver='picard', name='mcf-solver'):
     """
     pred_weights: B x V x D tensor
     demand: B x V x 1 tensor
     inv_adj_list: B x V x D tensor
+    solver: Either 'picard' (plain fixed point iteration) or 'anderson' (see anderson_solver)
 
-    Returns: B x V x D tensor containing flow volumes
+    Returns: B x V x D tensor containing flow volumes and a B tensor containing
+    the number of iterations each sample needed to converge
     """
 
-    def body(flow, prev_flow):
+    def step(flow):
         # Get incoming flows, B * (V+1) * D x 1  tensor
         inflow = tf.gather_nd(flow, in_indices)
         inflow = tf.reshape(inflow, tf.shape(pred_weights))
@@ -23,25 +26,198 @@ def mcf_solver(pred_weights, demand, in_indices, max_iters, name='mcf-solver'):
         adjusted_inflow = tf.nn.relu(total_inflow - demand)
 
         # Determine outgoing flows using computed weights, B x (V+1) x D tensor
-        prev_flow = flow
-        flow = tf.clip_by_value(pred_weights * adjusted_inflow, 0, FLOW_MAX)
-        return [flow, prev_flow]
+        return tf.clip_by_value(pred_weights * adjusted_inflow, 0, FLOW_MAX)
 
-    def cond(flow, prev_flow):
+    if solver == 'anderson':
+        weights_shape = tf.shape(pred_weights)
+        flat_shape = [weights_shape[0], -1]
+
+        def flat_step(flow):
+            return tf.reshape(step(tf.reshape(flow, weights_shape)), flat_shape)
+
+        flow, pflow, iters = anderson_solver(step=flat_step,
+                                             initial=tf.zeros_like(tf.reshape(pred_weights, flat_shape)),
+                                             max_iters=max_iters,
+                                             name=name)
+        return tf.reshape(flow, weights_shape), tf.reshape(pflow, weights_shape), iters
+
+    def body(flow, prev_flow, iters):
+        # Samples which have not yet converged, B tensor
+        active = tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD, axis=[1, 2])
+
+        next_flow = step(flow)
+
+        # Freeze converged samples so that each result does not depend on the rest of the batch
+        next_flow = tf.where(active, next_flow, flow)
+        prev_flow = tf.where(active, flow, prev_flow)
+        return [next_flow, prev_flow, iters + tf.cast(active, tf.int32)]
+
+    def cond(flow, prev_flow, iters):
         return tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD)
 
     # Iteratively computes flows from flow proportions
     flow = tf.zeros_like(pred_weights, dtype=tf.float32)
     prev_flow = flow + BIG_NUMBER
-    shape_invariants = [flow.get_shape(), prev_flow.get_shape()]
-    flow, pflow = tf.while_loop(cond=cond,
-                                body=body,
-                                loop_vars=[flow, prev_flow],
-                                parallel_iterations=1,
-                                shape_invariants=shape_invariants,
-                                maximum_iterations=max_iters,
-                                name='{0}-while-loop'.format(name))
-    return flow, pflow
+    iters = tf.zeros(shape=[tf.shape(pred_weights)[0]], dtype=tf.int32)
+    shape_invariants = [flow.get_shape(), prev_flow.get_shape(), tf.TensorShape([None])]
+    flow, pflow, iters = tf.while_loop(cond=cond,
+                                       body=body,
+                                       loop_vars=[flow, prev_flow, iters],
+                                       parallel_iterations=1,
+                                       shape_invariants=shape_invariants,
+                                       maximum_iterations=max_iters,
+                                       name='{0}-while-loop'.format(name))
+    return flow, pflow, iters
+
+
+def sparse_mcf_solver(pred_weights, demand, edge_slots, edge_src, edge_dst, max_iters, solver='picard',
+                      name='sparse-mcf-solver'):
+    """
+    pred_weights: B x V x D tensor
+    demand: B x V x 1 tensor
+    edge_slots: E tensor of flattened (node, neighbor) positions of each edge within pred_weights
+    edge_src: E tensor of source nodes
+    edge_dst: E tensor of destination nodes
+    solver: Either 'picard' (plain fixed point iteration) or 'anderson' (see anderson_solver)
+
+    Computes the same fixed point as mcf_solver, but iterates over the E real edges
+    instead of every padded slot of the adjacency lists. Flows are held as E x B tensors
+    so that inflow is a segment sum over destination nodes.
+
+    Returns: B x V x D tensor containing flow volumes and a B tensor containing
+    the number of iterations each sample needed to converge
+    """
+    weights_shape = tf.shape(pred_weights)
+    batch_size, num_nodes = weights_shape[0], weights_shape[1]
+
+    # E x B tensor of flow proportions for each real edge
+    flat_weights = tf.transpose(tf.reshape(pred_weights, [batch_size, -1]))
+    edge_weights = tf.gather(flat_weights, edge_slots)
+
+    # V x B tensor of node demands
+    node_demand = tf.transpose(tf.squeeze(demand, axis=-1))
+
+    def step(flow):
+        # Sum incoming flows for each node, V x B tensor
+        total_inflow = tf.unsorted_segment_sum(flow, edge_dst, num_segments=num_nodes)
+
+        # Adjust flow by demand, V x B tensor
+        adjusted_inflow = tf.nn.relu(total_inflow - node_demand)
+
+        # Determine outgoing flows using computed weights, E x B tensor
+        return tf.clip_by_value(edge_weights * tf.gather(adjusted_inflow, edge_src), 0, FLOW_MAX)
+
+    def body(flow, prev_flow, iters):
+        # Samples which have not yet converged, E x B tensor
+        active = tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD, axis=0, keepdims=True)
+        active = tf.tile(active, multiples=(tf.shape(flow)[0], 1))
+
+        next_flow = step(flow)
+
+        # Freeze converged samples so that each result does not depend on the rest of the batch
+        next_flow = tf.where(active, next_flow, flow)
+        prev_flow = tf.where(active, flow, prev_flow)
+        return [next_flow, prev_flow, iters + tf.cast(active[0], tf.int32)]
+
+    def cond(flow, prev_flow, iters):
+        return tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD)
+
+    if solver == 'anderson':
+        # The accelerated solver keeps the batch along the first dimension
+        def batch_step(flow):
+            return tf.transpose(step(tf.transpose(flow)))
+
+        flow, pflow, iters = anderson_solver(step=batch_step,
+                                             initial=tf.zeros_like(tf.transpose(edge_weights)),
+                                             max_iters=max_iters,
+                                             name=name)
+        flow, pflow = tf.transpose(flow), tf.transpose(pflow)
+    else:
+        # Iteratively computes flows from flow proportions
+        flow = tf.zeros_like(edge_weights, dtype=tf.float32)
+        prev_flow = flow + BIG_NUMBER
+        iters = tf.zeros(shape=[batch_size], dtype=tf.int32)
+        shape_invariants = [flow.get_shape(), prev_flow.get_shape(), tf.TensorShape([None])]
+        flow, pflow, iters = tf.while_loop(cond=cond,
+                                           body=body,
+                                           loop_vars=[flow, prev_flow, iters],
+                                           parallel_iterations=1,
+                                           shape_invariants=shape_invariants,
+                                           maximum_iterations=max_iters,
+                                           name='{0}-while-loop'.format(name))
+
+    # Scatter edge flows back into the padded B x V x D layout
+    flat_shape = [tf.shape(flat_weights)[0], batch_size]
+    slots = tf.expand_dims(edge_slots, axis=-1)
+    flow = tf.reshape(tf.transpose(tf.scatter_nd(slots, flow, flat_shape)), weights_shape)
+    pflow = tf.reshape(tf.transpose(tf.scatter_nd(slots, pflow, flat_shape)), weights_shape)
+    return flow, pflow, iters
+
+
+def anderson_solver(step, initial, max_iters, history_size=ANDERSON_HISTORY, name='anderson'):
+    """
+    step: Function mapping B x N tensors to B x N tensors
+    initial: B x N tensor
+
+    Solves x = step(x) using Anderson mixing. Each iteration combines the most recent
+    evaluations of step using the weights (summing to one) which minimize the norm of the
+    combined residual. This reaches the fixed point of the plain iteration x <- step(x) in
+    far fewer steps when that iteration contracts slowly. All operations are differentiable.
+
+    Returns: B x N tensor containing step applied to the solution, the B x N solution itself
+    and a B tensor containing the number of iterations each sample needed to converge
+    """
+    batch_size = tf.shape(initial)[0]
+
+    # B x H x N histories of iterates and their images under step. Repeated entries
+    # receive equal weights, so padding the history with the initial point is harmless.
+    x_hist = tf.tile(tf.expand_dims(initial, axis=1), multiples=(1, history_size, 1))
+    g_hist = tf.tile(tf.expand_dims(step(initial), axis=1), multiples=(1, history_size, 1))
+
+    ones = tf.ones(shape=[batch_size, history_size, 1], dtype=tf.float32)
+    eye = tf.eye(history_size, batch_shape=[batch_size], dtype=tf.float32)
+
+    def body(x, residual, x_hist, g_hist, iters):
+        g = step(x)
+
+        # Samples which have not yet converged, B tensor
+        residual = tf.reduce_max(tf.abs(g - x), axis=-1)
+        active = residual > FLOW_THRESHOLD
+
+        x_hist = tf.concat([x_hist[:, 1:], tf.expand_dims(x, axis=1)], axis=1)
+        g_hist = tf.concat([g_hist[:, 1:], tf.expand_dims(g, axis=1)], axis=1)
+
+        # B x H x H Gram matrix of residuals, regularized relative to its scale
+        r_hist = g_hist - x_hist
+        gram = tf.matmul(r_hist, r_hist, transpose_b=True)
+        scale = tf.reduce_mean(tf.matrix_diag_part(gram), axis=-1) + SMALL_NUMBER
+        gram = gram + ANDERSON_REG * tf.reshape(scale, [-1, 1, 1]) * eye
+
+        # B x H x 1 tensor of mixing weights
+        alpha = tf.matrix_solve(gram, ones)
+        alpha = alpha / tf.reduce_sum(alpha, axis=1, keepdims=True)
+
+        next_x = tf.clip_by_value(tf.reduce_sum(alpha * g_hist, axis=1), 0, FLOW_MAX)
+
+        # Freeze converged samples so that each result does not depend on the rest of the batch
+        next_x = tf.where(active, next_x, x)
+        return [next_x, residual, x_hist, g_hist, iters + tf.cast(active, tf.int32)]
+
+    def cond(x, residual, x_hist, g_hist, iters):
+        return tf.reduce_any(residual > FLOW_THRESHOLD)
+
+    residual = tf.fill(dims=[batch_size], value=BIG_NUMBER)
+    iters = tf.zeros(shape=[batch_size], dtype=tf.int32)
+    shape_invariants = [initial.get_shape(), tf.TensorShape([None]), x_hist.get_shape(),
+                        g_hist.get_shape(), tf.TensorShape([None])]
+    x, _, _, _, iters = tf.while_loop(cond=cond,
+                                      body=body,
+                                      loop_vars=[initial, residual, x_hist, g_hist, iters],
+                                      parallel_iterations=1,
+                                      shape_invariants=shape_invariants,
+                                      maximum_iterations=max_iters,
+                                      name='{0}-anderson-while-loop'.format(name))
+    return step(x), x, iters
 
 
 def directional_mcf_solver(pred_weights, demand, in_indices, num_in_neighbors, max_iters, name='dir-mcf-solver'):
@@ -97,8 +273,15 @@ def directional_mcf_solver(pred_weights, demand, in_indices, num_in_neighbors, m
 
 
 def dual_flow(dual_diff, adj_mask, cost_fn, edge_lengths, should_use_edges, step_size, momentum, max_iters, name='dual-flow'):
+    """
+    Returns: B x V x D tensor containing dual flows and a B tensor containing
+    the number of iterations each sample needed to converge
+    """
+
+    def body(iters, flow, moving_avg, prev_flow):
+        # Samples which have not yet converged, B tensor
+        active = tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD, axis=[1, 2])
 
-    def body(idx, flow, moving_avg, prev_flow):
         # RMSProp Step
         if should_use_edges:
             derivative = cost_fn.derivative(flow, edge_lengths) + dual_diff
@@ -108,24 +291,29 @@ def dual_flow(dual_diff, adj_mask, cost_fn, edge_lengths, should_use_edges, step
         next_avg = momentum * moving_avg + (1.0 - momentum) * tf.square(derivative)
         next_flow = flow - (step_size / (tf.sqrt(next_avg) + SMALL_NUMBER)) * derivative
         next_flow = tf.nn.relu(adj_mask * next_flow)
-        return [idx + 1, next_flow, next_avg, flow]
 
-    def cond(idx, flow, moving_avg, prev_flow):
+        # Freeze converged samples so that each result does not depend on the rest of the batch
+        next_flow = tf.where(active, next_flow, flow)
+        next_avg = tf.where(active, next_avg, moving_avg)
+        prev_flow = tf.where(active, flow, prev_flow)
+        return [iters + tf.cast(active, tf.int32), next_flow, next_avg, prev_flow]
+
+    def cond(iters, flow, moving_avg, prev_flow):
         return tf.reduce_any(tf.abs(flow - prev_flow) > FLOW_THRESHOLD)
 
-    idx = tf.constant(0, dtype=tf.int32)
+    iters = tf.zeros(shape=[tf.shape(dual_diff)[0]], dtype=tf.int32)
     dual_flows = tf.zeros_like(dual_diff, dtype=tf.float32)
     moving_avg = tf.fill(dims=tf.shape(dual_flows), value=0.1)
     prev_dual_flows = dual_flows + BIG_NUMBER
-    shape_invariants = [idx.get_shape(), dual_flows.get_shape(), moving_avg.get_shape(), prev_dual_flows.get_shape()]
-    idx, dual_flows, _, _ = tf.while_loop(cond, body,
-                                          loop_vars=[idx, dual_flows, moving_avg, prev_dual_flows],
-                                          parallel_iterations=1,
-                                          shape_invariants=shape_invariants,
-                                          maximum_iterations=max_iters,
-                                          name='{0}-while-loop'.format(name))
-
-    return dual_flows, idx
+    shape_invariants = [tf.TensorShape([None]), dual_flows.get_shape(), moving_avg.get_shape(), prev_dual_flows.get_shape()]
+    iters, dual_flows, _, _ = tf.while_loop(cond, body,
+                                            loop_vars=[iters, dual_flows, moving_avg, prev_dual_flows],
+                                            parallel_iterations=1,
+                                            shape_invariants=shape_invariants,
+                                            maximum_iterations=max_iters,
+                                            name='{0}-while-loop'.format(name))
+
+    return dual_flows, iters
 
 
 def destination_attn(node_weights, in_indices, rev_indices, mask, name='dest-attn'):
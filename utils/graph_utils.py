@@ -2,18 +2,20 @@ import numpy as np
 import networkx as nx
 import scipy.sparse as sp
 import itertools
+import heapq
+from scipy.sparse.csgraph import shortest_path, dijkstra
 from joblib import Parallel, delayed
 from utils.constants import BIG_NUMBER
 
 
 def add_features(graph, node_features, edge_features):
     """
-    Adds given features to the provided base graph. This function creates a copy of the graph.
+    Returns a networkx copy of the given compact graph with the given features added for plotting.
     Each edge 'feature' input is a dictionary mapping feature names to a V x D matrix. This matrix
     holds feature values in a padded-adjacency-list format. The pad value is equal to
     to the number of nodes in the graph.
     """
-    graph = graph.copy()
+    nx_graph = graph.to_networkx().copy()
 
     # Simple error handling
     if node_features is None:
@@ -24,22 +26,17 @@ def add_features(graph, node_features, edge_features):
 
     # Add node features
     for name, values in node_features.items():
-        values = values.flatten()
-        for node in graph.nodes():
-            v = {name: float(values[node])}
-            graph.add_node(node, **v)
-
-    # Add edge features
-    adj_lst, _ = adjacency_list(graph)
-    edge_attr = {(src, dst, 0): {} for src, dst in graph.edges()}
+        values = values.flatten()[:graph.num_nodes].astype(float)
+        nx.set_node_attributes(nx_graph, dict(enumerate(values.tolist())), name=name)
+
+    # Add edge features. Each edge's column in the padded list is its offset within its CSR row.
+    edge_keys = list(zip(graph.edge_src.tolist(), graph.indices.tolist(), [0] * graph.num_edges))
+    positions = np.arange(graph.num_edges) - graph.indptr[graph.edge_src]
     for name, values in edge_features.items():
-        for node in graph.nodes():
-            lst = adj_lst[node]
-            for i, neighbor in enumerate(lst):
-                v = {name: float(values[node, i])}
-                graph.add_edge(node, neighbor, key=0, **v)
+        edge_values = values[graph.edge_src, positions].astype(float)
+        nx.set_edge_attributes(nx_graph, dict(zip(edge_keys, edge_values.tolist())), name=name)
 
-    return graph
+    return nx_graph
 
 
 def max_degrees(graphs, k, unique_neighborhoods=True):
@@ -125,24 +122,155 @@ def random_walk_neighborhoods(adj_matrix, k, unique_neighborhoods=True):
     return neighborhoods
 
 
+def neighbor_positions(adj_lst, lookup_lst, mask_number, max_degree):
+    """
+    For every entry y = adj_lst[x, j], finds the first position of x within lookup_lst[y].
+    Returns a V*D x 2 array of (y, position) coordinates in row-major order of adj_lst. Entries
+    for which x does not appear in lookup_lst[y] are mapped to (mask_number, max_degree - 1).
+
+    All lookups are answered at once by sorting the linearized (row, value) keys of lookup_lst
+    and using a single searchsorted over the query keys.
+    """
+    num_rows, row_length = lookup_lst.shape
+    rows = adj_lst.reshape(-1).astype(np.int64)
+    values = np.repeat(np.arange(adj_lst.shape[0], dtype=np.int64), adj_lst.shape[1])
+
+    base = int(max(np.max(lookup_lst), np.max(values))) + 1
+    keys = np.repeat(np.arange(num_rows, dtype=np.int64), row_length) * base + lookup_lst.reshape(-1)
+
+    # A stable sort ensures that the first occurrence of a key has the smallest position
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    queries = rows * base + values
+    key_index = np.minimum(np.searchsorted(sorted_keys, queries, side='left'), len(sorted_keys) - 1)
+    found = (sorted_keys[key_index] == queries) & (rows < num_rows)
+
+    indices = np.empty(shape=(len(queries), 2), dtype=np.int64)
+    indices[:, 0] = np.where(found, rows, mask_number)
+    indices[:, 1] = np.where(found, order[key_index] % row_length, max_degree - 1)
+    return indices
+
+
 def adjacency_list(graph):
-    adj_lst = list(map(lambda x: list(sorted(x)), iter(graph.adj.values())))
-    max_degree = max(map(lambda x: len(x), adj_lst))
+    adj_lst = [graph.successors(node).tolist() for node in range(graph.num_nodes)]
+    max_degree = int(np.max(graph.out_degrees()))
     return adj_lst, max_degree
 
 
+def incidence_matrix(graph):
+    """
+    Returns a V x E sparse (CSR) matrix with a 1 at the source node and a -1
+    at the destination node of each edge. Columns follow the edge ids of the graph.
+    """
+    return graph.incidence_matrix()
+
+
+def shortest_edge_path(graph, source, sink, keep=None):
+    """
+    Returns the edge ids of the shortest path (by edge length) from source to sink using only
+    the edges marked in keep, or None if the sink is unreachable.
+    """
+    # Edges are stored in CSR order, so the lengths are the matrix data. Removed edges are
+    # given an infinite length which keeps the sparsity structure unchanged.
+    lengths = graph.edge_lengths if keep is None else np.where(keep, graph.edge_lengths, np.inf)
+    lengths = sp.csr_matrix((lengths, graph.indices, graph.indptr), shape=(graph.num_nodes, graph.num_nodes))
+    dist, predecessors = dijkstra(csgraph=lengths, directed=True, indices=source, return_predecessors=True)
+    if np.isinf(dist[sink]):
+        return None
+
+    return tree_path(graph, predecessors, source, sink)
+
+
+def shortest_path_trees(graph, sources):
+    """
+    Returns an S x V matrix of predecessors which holds a shortest path tree (by edge length)
+    rooted at each source. Unreachable nodes have a predecessor of -9999.
+    """
+    lengths = sp.csr_matrix((graph.edge_lengths, graph.indices, graph.indptr), shape=(graph.num_nodes, graph.num_nodes))
+    _, predecessors = dijkstra(csgraph=lengths, directed=True, indices=sources, return_predecessors=True)
+    return predecessors.reshape(len(sources), -1)
+
+
+def tree_path(graph, predecessors, source, sink):
+    """
+    Returns the edge ids of the path from source to sink in the shortest path tree given
+    by the predecessors of each node. Raises a ValueError if the sink is not in the tree.
+    """
+    nodes = [sink]
+    while nodes[-1] != source:
+        # Nodes outside the tree have a negative predecessor (-9999)
+        if predecessors[nodes[-1]] < 0:
+            raise ValueError('Node {0} is not reachable from node {1}.'.format(sink, source))
+        nodes.append(predecessors[nodes[-1]])
+    nodes = nodes[::-1]
+
+    return graph.edge_ids(nodes[:-1], nodes[1:])
+
+
+def k_shortest_paths(graph, source, sink):
+    """
+    Yields the simple paths from source to sink in order of total edge length using Yen's
+    algorithm. Each path is an array of edge ids. Paths are only computed as they are
+    requested, so callers can stop after any number of paths.
+    """
+    path = shortest_edge_path(graph, source, sink)
+    if path is None:
+        return
+
+    found = [path]
+    candidates = []
+    seen = {tuple(path)}
+    counter = itertools.count()
+
+    while True:
+        yield path
+
+        nodes = np.append(graph.edge_src[path], sink)
+        for i in range(len(path)):
+            keep = np.ones(shape=(graph.num_edges,), dtype=bool)
+
+            # Leave the spur node along an edge which no shorter path with the same root uses
+            root = path[:i]
+            for prev_path in found:
+                if len(prev_path) > i and np.array_equal(prev_path[:i], root):
+                    keep[prev_path[i]] = False
+
+            # Spur paths must not revisit the nodes on the root path
+            removed_nodes = np.zeros(shape=(graph.num_nodes,), dtype=bool)
+            removed_nodes[nodes[:i]] = True
+            keep &= ~(removed_nodes[graph.edge_src] | removed_nodes[graph.indices])
+
+            spur_path = shortest_edge_path(graph, nodes[i], sink, keep)
+            if spur_path is None:
+                continue
+
+            candidate = np.concatenate([root, spur_path]).astype(int)
+            if tuple(candidate) not in seen:
+                seen.add(tuple(candidate))
+                length = np.sum(graph.edge_lengths[candidate])
+                heapq.heappush(candidates, (length, next(counter), candidate))
+
+        if len(candidates) == 0:
+            return
+
+        _, _, path = heapq.heappop(candidates)
+        found.append(path)
+
+
 def simple_paths(graph, sources, sinks, max_num_paths):
-    cutoff = nx.diameter(graph)
+    """
+    Returns a dictionary from (source, sink) to a list of at most max_num_paths shortest
+    simple paths. Paths are arrays of edge ids ordered by total edge length.
+    """
+    def compute_paths(source, sink, max_num_paths):
+        paths = list(itertools.islice(k_shortest_paths(graph, source, sink), max_num_paths))
+        return {(source, sink): paths}
 
     # Dictionary from (source, sink) to list of paths
     all_paths = {}
 
-    def compute_paths(source, sink, cutoff, max_num_paths):
-        paths = list(nx.all_simple_paths(graph, source, sink, cutoff=cutoff))
-        paths = sorted(paths, key=len)[:max_num_paths]
-        return {(source, sink): paths}
-
-    result = Parallel(n_jobs=-1)(delayed(compute_paths)(source, sink, cutoff, max_num_paths) for source, sink in itertools.product(sources, sinks))
+    result = Parallel(n_jobs=-1)(delayed(compute_paths)(source, sink, max_num_paths) for source, sink in itertools.product(sources, sinks))
 
     for paths in result:
         all_paths.update(paths)
@@ -151,52 +279,47 @@ def simple_paths(graph, sources, sinks, max_num_paths):
 
 
 def random_sources_sinks(graph, num_sources, num_sinks):
-    nodes = np.random.choice(a=list(graph.nodes()), size=num_sources+num_sinks, replace=False)
+    nodes = np.random.choice(a=np.arange(graph.num_nodes), size=num_sources+num_sinks, replace=False)
     return nodes[:num_sources], nodes[num_sources:]
 
 
+def hop_distances(adj_matrix, sources):
+    """
+    Returns an S x V matrix of unweighted shortest path lengths from each source along the
+    edges of the given adjacency matrix. Unreachable nodes have an infinite distance.
+    """
+    return shortest_path(csgraph=adj_matrix, directed=True, unweighted=True, indices=sources).reshape(len(sources), -1)
+
+
 def farthest_nodes(graph, num_sources, num_sinks):
     """
     Returns a list of sources and sinks in which the total distance between all nodes
     is maximizes. Distance refers to unweighted shortest path length.
     """
-    n_nodes = graph.number_of_nodes()
+    n_nodes = graph.num_nodes
     start = np.random.randint(low=0, high=n_nodes)
     nodes = [start]
 
-    lengths = {}
+    adj_matrix = graph.adjacency_matrix()
+    adj_matrix_T = adj_matrix.transpose().tocsr()
+
+    # Minimum distance (in either direction) from each node to any of the selected nodes.
+    # Distances are only computed from each node once, when it is selected.
+    min_lengths = np.full(shape=(n_nodes,), fill_value=np.inf)
+
     threshold = min(n_nodes, num_sources + num_sinks)
     while len(nodes) < threshold:
+        forward_lengths = hop_distances(adj_matrix_T, [nodes[-1]])[0]
+        backward_lengths = hop_distances(adj_matrix, [nodes[-1]])[0]
+        min_lengths = np.minimum(min_lengths, np.minimum(forward_lengths, backward_lengths))
 
-        max_node = None
-        max_len = -BIG_NUMBER
-        for u in graph.nodes():
-
-            # Minimum distance to any of the already-selected nodes
-            min_len = BIG_NUMBER
-            for v in nodes:
-                if (u, v) in lengths:
-                    length = lengths[(u, v)]
-                elif (v, u) in lengths:
-                    length = lengths[(v, u)]
-                else:
-                    forward_path_length = nx.shortest_path_length(graph, source=u, target=v)
-                    backward_path_length = nx.shortest_path_length(graph, source=v, target=u)
-                    path_length = min(forward_path_length, backward_path_length)
-
-                    lengths[(u, v)] = path_length
-                    length = path_length
-                min_len = min(min_len, length)
-
-            # Select node whose closest distance to any selected vertex
-            # is maximized
-            if min_len > max_len:
-                max_len = min_len
-                max_node = u
+        # Select node whose closest distance to any selected vertex
+        # is maximized. Ties are broken by the smallest node index.
+        max_node = int(np.argmax(min_lengths))
+        max_len = int(min_lengths[max_node])
 
         print('{0}, Len: {1}'.format(max_node, max_len))
 
-        assert max_node is not None, 'No node found.'
         nodes.append(max_node)
 
     return nodes[:num_sources], nodes[num_sources:]
@@ -209,14 +332,14 @@ def farthest_sink_nodes(graph, num_sources, num_sinks):
     a large pairwise distance between sources (or sinks) themselves.
     """
 
-    sources = np.random.choice(a=list(graph.nodes()), replace=False, size=num_sources)
+    sources = np.random.choice(a=np.arange(graph.num_nodes), replace=False, size=num_sources)
 
-    node_distances = []
-    for u in sorted(graph.nodes()):
-        distances = [nx.shortest_path_length(graph, source=u, target=v) for v in sources]
-        node_distances.append(distances)
+    # Distances from every node to each source are found with one search per source
+    # along reversed edges
+    adj_matrix_T = graph.adjacency_matrix().transpose().tocsr()
+    node_distances = hop_distances(adj_matrix_T, sources)
 
-    min_distances = np.amin(a=node_distances, axis=-1)
+    min_distances = np.amin(a=node_distances, axis=0).astype(int)
     sinks = np.argsort(-min_distances)[:num_sinks]
 
     return sources, sinks
@@ -7,6 +7,8 @@ import gzip
 import pickle
 import csv
 import scipy.sparse as sp
+from scipy.spatial import cKDTree
+from utils.graph_utils import shortest_path_trees, tree_path
 from os.path import exists
 from os import remove
 from utils.constants import *
@@ -60,13 +62,11 @@ def features_to_demands(node_features):
 
 
 def demands_to_features(demands):
-    features = np.zeros(shape=(demands.shape[0], 2), dtype=float)
-    for i in range(demands.shape[0]):
-        if demands[i, 0] > 0:
-            features[i, 0] = demands[i, 0]
-        elif demands[i, 0] < 0:
-            features[i, 1] = demands[i, 0]
-    return features
+    """
+    Splits a ... x 1 array of demands into a ... x 2 array of features in which
+    the first channel holds positive demands and the second holds negative demands.
+    """
+    return np.concatenate([np.maximum(demands, 0), np.minimum(demands, 0)], axis=-1)
 
 
 def create_demands(sources, sinks):
@@ -79,34 +79,141 @@ def create_demands(sources, sinks):
     return source_demands, sink_demands
 
 
-def create_capacities(graph, demands):
-    num_edges = graph.number_of_edges()
+def create_demand_batch(num_sources, num_sinks, num_samples, rng=np.random):
+    """
+    Returns N x S source demands and N x K sink demands. Each row is drawn in the same
+    manner as create_demands.
+    """
+    source_demands = -batch_softmax(rng.normal(size=(num_samples, num_sources)))
+    sink_demands = batch_softmax(rng.normal(size=(num_samples, num_sinks)))
+    return source_demands, sink_demands
+
+
+def balance_demands(source_demands, sink_demands):
+    """
+    Returns N x S source demands and N x K sink demands as float64 arrays in which the sinks
+    of each sample are rescaled to exactly absorb the supply of its sources. Demands stored
+    at a lower precision otherwise leave a small imbalance which makes the flow conservation
+    constraint infeasible.
+    """
+    source_demands = np.asarray(source_demands, dtype=np.float64)
+    sink_demands = np.asarray(sink_demands, dtype=np.float64)
+
+    supply = -np.sum(source_demands, axis=-1, keepdims=True)
+    return source_demands, sink_demands * (supply / np.sum(sink_demands, axis=-1, keepdims=True))
 
-    abs_demands = np.abs(demands)
-    min_capacity = 0.5 * np.min(abs_demands)
-    max_capacity = 2.0 * np.max(abs_demands)
 
-    adj_matrix = nx.adjacency_matrix(graph)
-    init_capacities = np.random.uniform(low=min_capacity, high=max_capacity, size=(num_edges,))
-    capacities = sp.csr_matrix((init_capacities, adj_matrix.indices, adj_matrix.indptr))
+class DemandFilter:
+    """
+    Rejects demands which are too close to a training demand. The distance between two
+    demand vectors is the angular distance ||u/|u| - v/|v|||, and a sample is rejected when
+    both its source and its sink demands are within the threshold of the same training
+    sample. Such a sample lies within sqrt(2) * threshold of the sample's concatenated
+    normalized demands, so candidates are found exactly with a KD-tree ball query.
+    """
+
+    def __init__(self, source_demands, sink_demands, threshold=DEMANDS_THRESHOLD):
+        self.threshold = threshold
+        self.source_demands = normalize_rows(source_demands)
+        self.sink_demands = normalize_rows(sink_demands)
+        self.tree = cKDTree(np.concatenate([self.source_demands, self.sink_demands], axis=-1))
+
+    def is_valid(self, source_demands, sink_demands):
+        source_demands = normalize_rows(source_demands)
+        sink_demands = normalize_rows(sink_demands)
+
+        candidates = self.tree.query_ball_point(np.concatenate([source_demands, sink_demands], axis=-1),
+                                                r=np.sqrt(2) * self.threshold)
+
+        # Flatten the (sample, training sample) candidate pairs
+        counts = np.array([len(c) for c in candidates], dtype=int)
+        samples = np.repeat(np.arange(len(candidates)), counts)
+        neighbors = np.concatenate([np.array(c, dtype=int) for c in candidates])
 
-    sources = np.transpose(np.where(demands < 0))
-    sinks = np.transpose(np.where(demands > 0))
+        source_dist = np.linalg.norm(source_demands[samples] - self.source_demands[neighbors], axis=-1)
+        sink_dist = np.linalg.norm(sink_demands[samples] - self.sink_demands[neighbors], axis=-1)
+        too_close = np.logical_and(source_dist < self.threshold, sink_dist < self.threshold)
+
+        valid = np.ones(shape=(len(candidates),), dtype=bool)
+        valid[samples[too_close]] = False
+        return valid
+
+
+def create_filtered_demands(num_sources, num_sinks, num_samples, demand_filter, rng=np.random):
+    """
+    Draws demands in batches and keeps those accepted by the filter until there are num_samples.
+    """
+    source_batches, sink_batches = [], []
+    num_accepted = 0
 
-    for source in sources:
-        source_demand = abs_demands[source[0]][source[1]]
+    retries = 0
+    while num_accepted < num_samples:
+        source_demands, sink_demands = create_demand_batch(num_sources, num_sinks, num_samples - num_accepted, rng)
+        valid = demand_filter.is_valid(source_demands, sink_demands)
+
+        source_batches.append(source_demands[valid])
+        sink_batches.append(sink_demands[valid])
+        num_accepted += np.sum(valid)
+
+        assert retries < MAX_DEMAND_RETRIES, 'Retried too many times.'
+        retries += 1
+
+    return np.vstack(source_batches), np.vstack(sink_batches)
+
+
+def create_capacities(graph, demands, rng=np.random):
+    """
+    Returns an N x E matrix of edge capacities (indexed by edge id) for N x V node demands.
+    Capacities are drawn uniformly for each sample. Every source then routes its demand to
+    each sink along a shortest path, and the capacities along that path are raised to carry
+    it. This ensures that a feasible solution exists. Raises a ValueError if a sample has a
+    sink which is unreachable from one of its sources.
+    """
+    demands = np.atleast_2d(demands)
+    num_samples = demands.shape[0]
+
+    abs_demands = np.abs(demands)
+    min_capacity = 0.5 * np.min(abs_demands, axis=-1, keepdims=True)
+    max_capacity = 2.0 * np.max(abs_demands, axis=-1, keepdims=True)
+    capacities = rng.uniform(low=min_capacity, high=max_capacity, size=(num_samples, graph.num_edges))
+
+    # Paths are shared by all samples with the same sources and sinks, so there is a single
+    # shortest path tree per source
+    sources = np.flatnonzero(np.any(demands < 0, axis=0))
+    sinks = np.flatnonzero(np.any(demands > 0, axis=0))
+    predecessors = shortest_path_trees(graph, sources)
+
+    pair_sources, pair_sinks = [], []
+    path_edges, path_pairs = [], []
+    for i, source in enumerate(sources):
         for sink in sinks:
-            path_gen = nx.all_simple_paths(graph, source=source[0], target=sink[0])
-            path = list(path_gen.__next__())
+            if source == sink:
+                continue
+
+            # Unreachable pairs are skipped unless a sample needs them
+            if predecessors[i, sink] < 0:
+                unreachable = np.flatnonzero((demands[:, source] < 0) & (demands[:, sink] > 0))
+                if len(unreachable) > 0:
+                    raise ValueError('Sink {0} is unreachable from source {1} in sample {2}.'.format(sink, source, unreachable[0]))
+                continue
+
+            path_edges.append(tree_path(graph, predecessors[i], source, sink))
+            path_pairs.append(np.full(shape=(len(path_edges[-1]),), fill_value=len(pair_sources)))
+            pair_sources.append(source)
+            pair_sinks.append(sink)
 
-            # Increase capacity so at least one path can carry the source's flow to the sink.
-            # This process ensures that a feasible solution exists
-            for i in range(len(path)-1):
-                edge = (path[i], path[i+1])
-                capacities[edge] = max(capacities[edge], source_demand + 1e-3)
+    if len(pair_sources) == 0:
+        return capacities
 
-            edge = (path[i], path[i+1])
-            capacities[edge] = max(capacities[edge], source_demand + 1e-3)
+    path_edges = np.concatenate(path_edges)
+    path_pairs = np.concatenate(path_pairs)
+
+    # Capacity needed by each (sample, pair) which is zero if the pair is not used by the sample
+    is_used = (demands[:, pair_sources] < 0) & (demands[:, pair_sinks] > 0)
+    required = np.where(is_used, abs_demands[:, pair_sources] + 1e-3, 0.0)
+
+    sample_index = np.arange(num_samples).reshape(-1, 1)
+    np.maximum.at(capacities, (sample_index, path_edges.reshape(1, -1)), required[:, path_pairs])
 
     return capacities
 
@@ -116,27 +223,17 @@ def create_node_embeddings(graph, neighborhoods):
     Creates node "embeddings" based on the degrees of neighboring vertices and approximate
     centrality measures
     """
-    num_nodes = graph.number_of_nodes()
+    num_nodes = graph.num_nodes
     embeddings = np.zeros(shape=(num_nodes, 2 * (len(neighborhoods) - 1) + 2), dtype=float)
 
-    eigen = nx.eigenvector_centrality_numpy(graph)
-    pagerank = nx.pagerank_scipy(graph, alpha=0.85)
-
-    out_neighbors = []
-    in_neighbors = []
-    for i in range(1, len(neighborhoods)):
-        out_neighbors.append(neighborhoods[i].sum(axis=1, dtype=float))
-        in_neighbors.append(neighborhoods[i].sum(axis=0, dtype=float))
+    for j in range(1, len(neighborhoods)):
+        embeddings[:, 2*(j-1)] = np.asarray(neighborhoods[j].sum(axis=1, dtype=float)).reshape(-1) / num_nodes
+        embeddings[:, 2*(j-1)+1] = np.asarray(neighborhoods[j].sum(axis=0, dtype=float)).reshape(-1) / num_nodes
 
-    for i, node in enumerate(graph.nodes()):
-        for j in range(len(out_neighbors)):
-            embeddings[i][2*j] = out_neighbors[j][i, 0] / graph.number_of_nodes()
-            embeddings[i][2*j+1] = in_neighbors[j][0, i] / graph.number_of_nodes()
+    embeddings[:, -2] = graph.eigenvector_centrality()
+    embeddings[:, -1] = graph.pagerank(alpha=0.85)
 
-        embeddings[i][-2] = eigen[node]
-        embeddings[i][-1] = pagerank[node]
-
-    return np.array(embeddings)
+    return embeddings
 
 
 def create_obs_indices(dim1, dim2):
@@ -156,6 +253,18 @@ def softmax(arr):
     return exp_arr / np.sum(exp_arr)
 
 
+def batch_softmax(arr):
+    """
+    Softmax over the last axis.
+    """
+    exp_arr = np.exp(arr - np.max(arr, axis=-1, keepdims=True))
+    return exp_arr / np.sum(exp_arr, axis=-1, keepdims=True)
+
+
+def normalize_rows(arr):
+    return arr / np.linalg.norm(arr, axis=-1, keepdims=True)
+
+
 def sparse_matrix_to_tensor(sparse_mat):
     mat = sparse_mat.tocoo()
     indices = np.mat([mat.row, mat.col]).transpose()